@@ -8,8 +8,11 @@ from stacks.vpc import VpcStack
 from stacks.security_groups import SecurityGroupsStack
 from stacks.functions import FunctionsStack
 from stacks.rds import RDSStack
+from stacks.cache import CacheStack
+from stacks.artifact import ArtifactStack
 from stacks.bastion import BastionStack
 from stacks.webservers import WebServersStack
+from stacks.workers import WorkersStack
 # importing util functions
 from utils import getBuildConfigs
 
@@ -72,14 +75,44 @@ rdsStack = RDSStack(
   env=_env,
   vpc=vpcStack.getVpc,
   sg=securityGroupsStack.getRdsSg,
+  proxySg=securityGroupsStack.getRdsProxySg,
+  buildConfigs=buildConfigs,
+)
+
+# provisioning our Redis cache stack
+cacheStack = CacheStack(
+  app,
+  f"{stackName}-cache",
+  env=_env,
+  vpc=vpcStack.getVpc,
+  sg=securityGroupsStack.getCacheSg,
+  buildConfigs=buildConfigs,
+)
+
+# provisioning our Magento release artifact stack
+artifactStack = ArtifactStack(
+  app,
+  f"{stackName}-artifact",
+  env=_env,
+  vpc=vpcStack.getVpc,
+  sg=securityGroupsStack.getWebserverEc2Sg,
+  mysqlAddress=rdsStack.getRdsEndpointAddress,
+  mysqlSecret=rdsStack.getMySqlSecret,
   buildConfigs=buildConfigs,
 )
 
 userDataVarMappings = {
   "__AWS_ACCOUNT_ID__": _account,
   "__AWS_REGION__": _region,
-  "__MYSQL_INSTANCE_ADDRESS__": rdsStack.getRds.db_instance_endpoint_address,
+  "__MYSQL_INSTANCE_ADDRESS__": rdsStack.getRdsEndpointAddress,
   "__MYSQL_SECRET_NAME__": rdsStack.getMySqlSecret.secret_name,
+  "__MYSQL_PROXY_ADDRESS__": rdsStack.getProxyAddress,
+  "__REDIS_ENDPOINT_ADDRESS__": cacheStack.getRedisEndpointAddress,
+  "__REDIS_ENDPOINT_PORT__": cacheStack.getRedisEndpointPort,
+  "__MAGENTO_ARTIFACT_BUCKET__": artifactStack.getArtifactBucket.bucket_name,
+  "__MAGENTO_RELEASE__": artifactStack.getRelease,
+  "__MAGENTO_CRYPT_KEY_SECRET_NAME__": artifactStack.getCryptKeySecret.secret_name,
+  "__WEBSHOP_CONTENT_BUCKET__": functionsStack.getWebShopContentBucket.bucket_name,
 }
 
 bastionStack = BastionStack(
@@ -101,6 +134,23 @@ webServersStack = WebServersStack(
   webserverAlbSG=securityGroupsStack.getWebserverAlbSg,
   mappings=userDataVarMappings,
   mysqlSecret=rdsStack.getMySqlSecret,
+  contentBucket=functionsStack.getWebShopContentBucket,
+  contentOriginAccessIdentity=functionsStack.getWebShopContentOriginAccessIdentity,
+  staticBucket=artifactStack.getStaticBucket,
+  staticOriginAccessIdentity=artifactStack.getStaticOriginAccessIdentity,
+  buildConfigs=buildConfigs,
+)
+
+# provisioning the worker running Magento's cron, indexers and
+# queue consumers with the web server role and security group
+workersStack = WorkersStack(
+  app,
+  f"{stackName}-workers",
+  env=_env,
+  vpc=vpcStack.getVpc,
+  workerEc2SG=securityGroupsStack.getWebserverEc2Sg,
+  role=webServersStack.getWebserverRole,
+  mappings=userDataVarMappings,
   buildConfigs=buildConfigs,
 )
 
@@ -108,4 +158,12 @@ functionsStack.getWebShopContentBucket.grant_read_write(
   webServersStack.getWebserverRole ,
 )
 
+artifactStack.getArtifactBucket.grant_read(
+  webServersStack.getWebserverRole,
+)
+
+artifactStack.getCryptKeySecret.grant_read(
+  webServersStack.getWebserverRole,
+)
+
 app.synth()
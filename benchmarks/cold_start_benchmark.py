@@ -0,0 +1,148 @@
+# Measures the cold start of the content moderator function: the
+# time to import the handler module (the Lambda init phase), the
+# first event of a fresh process and a warm event. From these it
+# estimates the Lambda cost per 1k images. Run it against another
+# checkout with --src to compare before and after a change, e.g.
+#
+#   $ git worktree add /tmp/before HEAD~1
+#   $ python benchmarks/cold_start_benchmark.py --src /tmp/before/functions/src
+#   $ python benchmarks/cold_start_benchmark.py
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+benchmarksDirName = os.path.dirname(os.path.abspath(__file__))
+defaultSrcDirName = os.path.join(benchmarksDirName, "..", "functions", "src")
+
+# us-east-1 list prices, override them for other regions
+X86_64_PRICE_PER_GB_SECOND = 0.0000166667
+ARM64_PRICE_PER_GB_SECOND = 0.0000133334
+PRICE_PER_REQUEST = 0.0000002
+
+def runChild(args):
+  # runs in a fresh interpreter, prints the measurements as JSON
+  os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+  os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+  os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+  os.environ["LOG_LEVEL"] = "WARNING"
+  os.environ["EVENT_LOG_SAMPLE_RATE"] = "0"
+  os.environ["MAX_WORKERS"] = str(args.workers)
+  sys.path.insert(0, args.src)
+
+  startedAt = time.perf_counter()
+  import content_moderator
+  initMs = (time.perf_counter() - startedAt) * 1000
+
+  import logging
+  import boto3
+  from moto import mock_aws
+  sys.path.insert(0, benchmarksDirName)
+  from moderator_benchmark import BUCKET_NAME, JPEG_HEADER, StubRekognition, buildEvent
+
+  logging.getLogger().addHandler(logging.NullHandler())
+  content_moderator.disableMetrics()
+
+  with mock_aws():
+    s3Client = boto3.client("s3")
+    s3Client.create_bucket(Bucket=BUCKET_NAME)
+    payload = JPEG_HEADER + os.urandom(args.object_size_kb * 1024)
+    events = []
+    for eventIndex in range(2):
+      keys = [f"media/cold-start/{eventIndex}/{recordIndex}.jpg" for recordIndex in range(args.batch_size)]
+      for key in keys:
+        s3Client.put_object(Bucket=BUCKET_NAME, Key=key, Body=payload, ContentType="image/jpeg")
+      events.append(buildEvent(keys))
+
+    # only the handler's S3 and Rekognition clients are replaced, the
+    # other clients are still built the way the module builds them
+    content_moderator.configureClients(
+      s3Client=s3Client,
+      rekognitionClient=StubRekognition(args.rekognition_latency_ms, 0, 0, 0, 1),
+    )
+
+    durations = []
+    for event in events:
+      startedAt = time.perf_counter()
+      content_moderator.lambda_handler(event, None)
+      durations.append((time.perf_counter() - startedAt) * 1000)
+
+  print(json.dumps({
+    "initMs": initMs,
+    "firstEventMs": durations[0],
+    "warmEventMs": durations[1],
+  }))
+
+def median(values):
+  ordered = sorted(values)
+  return ordered[len(ordered) // 2]
+
+def parseArgs(argv):
+  parser = argparse.ArgumentParser(
+    description="Measures the content moderator init duration and estimates the cost per 1k images",
+  )
+  parser.add_argument("--src", default=defaultSrcDirName, help="directory of content_moderator.py")
+  parser.add_argument("--runs", type=int, default=10, help="number of fresh processes")
+  parser.add_argument("--batch-size", type=int, default=10, help="S3 records per event")
+  parser.add_argument("--object-size-kb", type=int, default=256)
+  parser.add_argument("--workers", type=int, default=8)
+  parser.add_argument("--rekognition-latency-ms", type=float, default=150)
+  parser.add_argument("--memory-mb", type=int, default=256, help="function memory size")
+  parser.add_argument("--architecture", default="arm64", choices=["arm64", "x86_64"])
+  parser.add_argument("--cold-start-rate", type=float, default=0.1, help="share of invocations that are cold starts")
+  parser.add_argument("--price-per-gb-second", type=float, help="defaults to the us-east-1 price of the architecture")
+  parser.add_argument("--child", action="store_true", help=argparse.SUPPRESS)
+  return parser.parse_args(argv)
+
+def main(argv=None):
+  args = parseArgs(argv)
+  args.src = os.path.abspath(args.src)
+  if args.child:
+    runChild(args)
+    return
+
+  childArgs = [
+    "--child",
+    "--src", args.src,
+    "--batch-size", str(args.batch_size),
+    "--object-size-kb", str(args.object_size_kb),
+    "--workers", str(args.workers),
+    "--rekognition-latency-ms", str(args.rekognition_latency_ms),
+  ]
+  runs = []
+  for _ in range(args.runs):
+    output = subprocess.run(
+      [sys.executable, os.path.abspath(__file__)] + childArgs,
+      check=True,
+      capture_output=True,
+      text=True,
+    ).stdout
+    runs.append(json.loads(output.strip().splitlines()[-1]))
+
+  initMs = median([run["initMs"] for run in runs])
+  firstEventMs = median([run["firstEventMs"] for run in runs])
+  warmEventMs = median([run["warmEventMs"] for run in runs])
+
+  # Lambda bills the init phase together with the invocation
+  pricePerGbSecond = args.price_per_gb_second or (
+    ARM64_PRICE_PER_GB_SECOND if args.architecture == "arm64" else X86_64_PRICE_PER_GB_SECOND
+  )
+  invocationsPer1k = 1000 / args.batch_size
+  coldMs = initMs + firstEventMs
+  averageMs = args.cold_start_rate * coldMs + (1 - args.cold_start_rate) * warmEventMs
+  costPer1k = invocationsPer1k * (
+    PRICE_PER_REQUEST + averageMs / 1000 * args.memory_mb / 1024 * pricePerGbSecond
+  )
+
+  print(f"source: {args.src}")
+  print(f"median of {args.runs} runs, {args.batch_size} images per event, Rekognition stubbed at {args.rekognition_latency_ms}ms")
+  print(f"  init (module import)  {initMs:9.1f} ms")
+  print(f"  first event           {firstEventMs:9.1f} ms")
+  print(f"  warm event            {warmEventMs:9.1f} ms")
+  print(f"  Lambda cost per 1k images at {args.memory_mb}MB {args.architecture}, "
+        f"{args.cold_start_rate:.0%} cold starts: ${costPer1k:.6f}")
+
+if __name__ == "__main__":
+  main()
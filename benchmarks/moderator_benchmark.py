@@ -0,0 +1,186 @@
+# Drives content_moderator.lambda_handler with synthetic S3 events
+# against moto S3 and a stubbed Rekognition client, and reports the
+# per event latency percentiles, peak RSS and throughput for each
+# concurrency level. Every level runs in a fresh process so that its
+# peak RSS is not inflated by the previous levels
+#
+#   $ pip install -r benchmarks/requirements.txt
+#   $ python benchmarks/moderator_benchmark.py --events 20 --batch-size 25 --concurrency 1,4,16
+import argparse
+import json
+import logging
+import multiprocessing
+import os
+import random
+import resource
+import sys
+import threading
+import time
+
+srcDirName = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "functions", "src")
+
+BUCKET_NAME = "benchmark-content-bucket"
+JPEG_HEADER = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00"
+
+class StubRekognition:
+  # answers DetectModerationLabels after an injected latency and
+  # throttles a share of the calls like the real API would
+  def __init__(self, latencyMs, jitterMs, throttleRate, labelRate, seed):
+    self._latencyMs = latencyMs
+    self._jitterMs = jitterMs
+    self._throttleRate = throttleRate
+    self._labelRate = labelRate
+    self._random = random.Random(seed)
+    self._lock = threading.Lock()
+
+  def detect_moderation_labels(self, Image, MinConfidence):
+    from botocore.exceptions import ClientError
+
+    with self._lock:
+      latency = max(0.0, self._latencyMs + self._random.uniform(-self._jitterMs, self._jitterMs))
+      throttled = self._random.random() < self._throttleRate
+      labeled = self._random.random() < self._labelRate
+    time.sleep(latency / 1000)
+
+    if throttled:
+      raise ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}},
+        "DetectModerationLabels",
+      )
+    labels = [{"Name": "Suggestive", "Confidence": 95.0}] if labeled else []
+    return {"ModerationLabels": labels}
+
+def percentile(values, percent):
+  if not values:
+    return 0.0
+  ordered = sorted(values)
+  index = min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))
+  return ordered[index]
+
+def buildEvent(keys):
+  return {
+    "Records": [
+      {
+        "eventSource": "aws:s3",
+        "eventName": "ObjectCreated:Put",
+        "s3": {
+          "bucket": {"name": BUCKET_NAME},
+          "object": {"key": key},
+        },
+      } for key in keys
+    ]
+  }
+
+def runLevel(args, concurrency):
+  # runs in a child process, returns the measurements of one level
+  os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+  os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+  os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+  os.environ["LOG_LEVEL"] = "WARNING"
+  os.environ["EVENT_LOG_SAMPLE_RATE"] = "0"
+  os.environ["IMAGE_SOURCE"] = args.image_source
+  os.environ["MAX_WORKERS"] = str(concurrency)
+  sys.path.insert(0, srcDirName)
+  # throttled records are expected, keep their errors off the report
+  logging.getLogger().addHandler(logging.NullHandler())
+
+  import boto3
+  from botocore.config import Config
+  from moto import mock_aws
+
+  with mock_aws():
+    s3Client = boto3.client("s3", config=Config(max_pool_connections=concurrency))
+    s3Client.create_bucket(Bucket=BUCKET_NAME)
+
+    objectSize = args.object_size_kb * 1024
+    payload = JPEG_HEADER + os.urandom(max(0, objectSize - len(JPEG_HEADER)))
+    events = []
+    for eventIndex in range(args.events):
+      keys = [f"media/benchmark/{eventIndex}/{recordIndex}.jpg" for recordIndex in range(args.batch_size)]
+      for key in keys:
+        s3Client.put_object(Bucket=BUCKET_NAME, Key=key, Body=payload, ContentType="image/jpeg")
+      events.append(buildEvent(keys))
+
+    import content_moderator
+    content_moderator.configureClients(
+      s3Client=s3Client,
+      rekognitionClient=StubRekognition(
+        args.rekognition_latency_ms,
+        args.rekognition_jitter_ms,
+        args.throttle_rate,
+        args.label_rate,
+        args.seed,
+      ),
+    )
+    content_moderator.disableMetrics()
+
+    latencies = []
+    throttledEvents = 0
+    startedAt = time.perf_counter()
+    for event in events:
+      eventStartedAt = time.perf_counter()
+      try:
+        content_moderator.lambda_handler(event, None)
+      except content_moderator.ThrottledObjects:
+        throttledEvents += 1
+      latencies.append((time.perf_counter() - eventStartedAt) * 1000)
+    elapsed = time.perf_counter() - startedAt
+
+  images = args.events * args.batch_size
+  return {
+    "concurrency": concurrency,
+    "events": args.events,
+    "images": images,
+    "throttledEvents": throttledEvents,
+    "p50Ms": percentile(latencies, 50),
+    "p90Ms": percentile(latencies, 90),
+    "p99Ms": percentile(latencies, 99),
+    "maxMs": max(latencies) if latencies else 0.0,
+    "imagesPerSecond": images / elapsed if elapsed else 0.0,
+    # ru_maxrss is reported in KiB on Linux
+    "peakRssMiB": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+  }
+
+def parseArgs(argv):
+  parser = argparse.ArgumentParser(
+    description="Benchmarks the content moderator handler against moto S3 and a stubbed Rekognition",
+  )
+  parser.add_argument("--events", type=int, default=20, help="number of events per concurrency level")
+  parser.add_argument("--batch-size", type=int, default=10, help="S3 records per event")
+  parser.add_argument("--object-size-kb", type=int, default=256, help="size of the synthetic images")
+  parser.add_argument("--concurrency", default="1,4,8,16", help="comma separated MAX_WORKERS levels")
+  parser.add_argument("--image-source", default="S3Object", choices=["S3Object", "Bytes"])
+  parser.add_argument("--rekognition-latency-ms", type=float, default=150, help="mean injected Rekognition latency")
+  parser.add_argument("--rekognition-jitter-ms", type=float, default=50, help="uniform jitter around the latency")
+  parser.add_argument("--throttle-rate", type=float, default=0.0, help="share of Rekognition calls throttled")
+  parser.add_argument("--label-rate", type=float, default=0.05, help="share of images labeled inappropriate")
+  parser.add_argument("--seed", type=int, default=1)
+  parser.add_argument("--json", help="also write the results to this file")
+  return parser.parse_args(argv)
+
+def main(argv=None):
+  args = parseArgs(argv)
+  levels = [int(level) for level in args.concurrency.split(",")]
+
+  results = []
+  context = multiprocessing.get_context("spawn")
+  for concurrency in levels:
+    with context.Pool(1) as pool:
+      results.append(pool.apply(runLevel, (args, concurrency)))
+
+  print(f"{args.events} events x {args.batch_size} images of {args.object_size_kb}KiB, "
+        f"{args.image_source} mode, Rekognition {args.rekognition_latency_ms}±{args.rekognition_jitter_ms}ms, "
+        f"throttle rate {args.throttle_rate}")
+  print(f"{'workers':>8} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9} {'images/s':>9} {'RSS MiB':>8} {'throttled':>9}")
+  for result in results:
+    print(
+      f"{result['concurrency']:>8} {result['p50Ms']:>9.1f} {result['p90Ms']:>9.1f} {result['p99Ms']:>9.1f} "
+      f"{result['maxMs']:>9.1f} {result['imagesPerSecond']:>9.1f} {result['peakRssMiB']:>8.1f} {result['throttledEvents']:>9}"
+    )
+
+  if args.json:
+    with open(args.json, mode="w") as file:
+      json.dump(results, file, indent=2)
+
+if __name__ == "__main__":
+  main()
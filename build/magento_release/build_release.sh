@@ -0,0 +1,91 @@
+#!/bin/bash -xe
+
+# Builds a ready-to-run Magento release once and uploads it to the
+# artifact bucket as releases/<MAGENTO_RELEASE>/magento.tar.gz.
+# Web servers only download and extract this tarball on boot. The
+# static content is uploaded to the static bucket instead, which
+# CloudFront serves directly.
+#
+# The following variables are provided by the CodeBuild project:
+# MAGENTO_VERSION, MAGENTO_RELEASE, ARTIFACT_BUCKET, STATIC_BUCKET,
+# MYSQL_INSTANCE_ADDRESS, MYSQL_USER, MYSQL_PWD and MAGENTO_CRYPT_KEY
+
+if [[ -z "${MAGENTO_RELEASE}" ]]; then
+  echo 1>&2 "MAGENTO_RELEASE is empty. Pass it as an environment variable override."
+  exit 1
+fi
+
+BUILD_DIR=$(mktemp -d)
+
+# download the requested magento version and extract its content
+wget -c https://github.com/magento/magento2/archive/refs/tags/${MAGENTO_VERSION}.tar.gz -O - | tar -xz --directory ${BUILD_DIR} --strip 1
+cd ${BUILD_DIR}
+
+# installing magento 2 dependencies
+COMPOSER_ALLOW_SUPERUSER=1 composer install --no-interaction
+
+chmod u+x bin/magento
+
+# install magento on a fresh database, otherwise only write the
+# deployment configuration and upgrade the existing schema
+if mysql -h ${MYSQL_INSTANCE_ADDRESS} -u ${MYSQL_USER} -p${MYSQL_PWD} \
+  -e "SELECT 1 FROM webshop.core_config_data LIMIT 1" > /dev/null 2>&1; then
+  php bin/magento setup:config:set --no-interaction \
+  --db-host=${MYSQL_INSTANCE_ADDRESS} \
+  --db-name=webshop \
+  --db-user=${MYSQL_USER} \
+  --db-password=${MYSQL_PWD} \
+  --key=${MAGENTO_CRYPT_KEY} \
+  --backend-frontname=admin
+  php bin/magento setup:upgrade --keep-generated
+else
+  php bin/magento setup:install \
+  --db-host=${MYSQL_INSTANCE_ADDRESS} \
+  --db-name=webshop \
+  --db-user=${MYSQL_USER} \
+  --db-password=${MYSQL_PWD} \
+  --key=${MAGENTO_CRYPT_KEY} \
+  --backend-frontname=admin \
+  --admin-firstname=admin \
+  --admin-lastname=admin \
+  --admin-email=admin@admin.com \
+  --admin-user=admin \
+  --admin-password=${MYSQL_PWD}@ \
+  --language=en_US \
+  --currency=USD \
+  --timezone=America/Chicago \
+  --use-rewrites=1
+fi
+
+# compile dependency injection and deploy static assets once per
+# release instead of on every web server boot
+php bin/magento setup:di:compile
+php bin/magento setup:static-content:deploy -f
+
+# upload the static content to the versioned prefix Magento signs
+# static URLs with. Every release gets its own prefix, so the
+# objects never change and web servers still running the previous
+# release keep finding theirs
+static_version=$(cat pub/static/deployed_version.txt)
+aws s3 sync pub/static s3://${STATIC_BUCKET}/static/version${static_version}/ \
+  --exclude "*.htaccess" \
+  --exclude deployed_version.txt \
+  --cache-control "public, max-age=31536000, immutable"
+
+# web servers neither build nor serve static content, they only
+# need the deployed version to sign the static URLs
+find pub/static -mindepth 1 -maxdepth 1 \
+  ! -name deployed_version.txt ! -name .htaccess \
+  -exec rm -rf {} +
+
+# package the release without the environment specific
+# configuration and runtime caches
+tar -czf /tmp/magento.tar.gz \
+  --exclude=./app/etc/env.php \
+  --exclude=./var/cache \
+  --exclude=./var/page_cache \
+  --exclude=./var/session \
+  .
+
+aws s3 cp /tmp/magento.tar.gz s3://${ARTIFACT_BUCKET}/releases/${MAGENTO_RELEASE}/magento.tar.gz
+echo "Magento release ${MAGENTO_RELEASE} has been uploaded to s3://${ARTIFACT_BUCKET}/releases/${MAGENTO_RELEASE}/"
@@ -0,0 +1,182 @@
+# Moderates the objects already stored in the content bucket. Keys
+# are listed from the bucket or read from an S3 Inventory manifest
+# and moderated on a thread pool with the same logic as the
+# content moderator function. Completed keys are appended to a
+# checkpoint file so an interrupted run can be resumed
+import argparse
+import boto3
+import csv
+import gzip
+import io
+import json
+import logging
+import os
+import sys
+import time
+from botocore.config import Config
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from urllib.parse import quote_plus, unquote_plus, urlparse
+
+import content_moderator
+from rate_limiter import TokenBucket
+
+TAG_KEY = "InappropriateContent"
+
+def listKeys(s3Client, bucketName, prefix):
+  paginator = s3Client.get_paginator("list_objects_v2")
+  for page in paginator.paginate(Bucket=bucketName, Prefix=prefix):
+    for obj in page.get("Contents", []):
+      yield obj["Key"]
+
+def readS3Url(s3Client, url):
+  parsedUrl = urlparse(url)
+  fileObj = s3Client.get_object(
+    Bucket=parsedUrl.netloc,
+    Key=parsedUrl.path.lstrip("/"),
+  )
+  return fileObj["Body"].read()
+
+def listManifestKeys(s3Client, manifestUrl, bucketName, prefix):
+  # reading the keys from the CSV files of an S3 Inventory report
+  manifest = json.loads(readS3Url(s3Client, manifestUrl))
+  if manifest.get("fileFormat", "CSV") != "CSV":
+    raise ValueError(f"unsupported inventory format {manifest['fileFormat']}, only CSV is supported")
+
+  columns = [column.strip() for column in manifest["fileSchema"].split(",")]
+  bucketColumn = columns.index("Bucket")
+  keyColumn = columns.index("Key")
+  inventoryBucket = urlparse(manifestUrl).netloc
+
+  for inventoryFile in manifest["files"]:
+    content = readS3Url(s3Client, f"s3://{inventoryBucket}/{inventoryFile['key']}")
+    with gzip.open(io.BytesIO(content), mode="rt", newline="") as rows:
+      for row in csv.reader(rows):
+        # object keys are URL encoded in inventory reports
+        key = unquote_plus(row[keyColumn])
+        if row[bucketColumn] == bucketName and key.startswith(prefix):
+          yield key
+
+def loadCheckpoint(path):
+  if not path or not os.path.exists(path):
+    return set()
+  with open(path, mode="r") as file:
+    return set(line.rstrip("\n") for line in file if line.strip())
+
+def isTagged(s3Client, bucketName, objectKey):
+  res = s3Client.get_object_tagging(
+    Bucket=bucketName,
+    Key=objectKey,
+  )
+  return any(tag["Key"] == TAG_KEY for tag in res["TagSet"])
+
+def backfillObject(s3Client, bucketName, objectKey, force):
+  if not force and isTagged(s3Client, bucketName, objectKey):
+    return {"key": objectKey, "status": "tagged"}
+  return content_moderator.processRecord({
+    "s3": {
+      "bucket": {"name": bucketName},
+      # processRecord expects URL encoded keys like S3 events
+      "object": {"key": quote_plus(objectKey, safe="/")},
+    }
+  })
+
+def backfill(s3Client, bucketName, keys, workers, checkpointPath=None, force=False, reportEvery=100, output=sys.stdout):
+  # returns the number of objects per status
+  completedKeys = loadCheckpoint(checkpointPath)
+  checkpoint = open(checkpointPath, mode="a") if checkpointPath else None
+  counts = {}
+  startedAt = time.monotonic()
+
+  def report():
+    processed = sum(counts.values())
+    elapsed = max(time.monotonic() - startedAt, 0.001)
+    print(f"{processed} objects in {elapsed:.1f}s ({processed / elapsed:.1f} objects/s) {counts}", file=output)
+    if checkpoint is not None:
+      checkpoint.flush()
+
+  def collect(futures):
+    for future in futures:
+      result = future.result()
+      counts[result["status"]] = counts.get(result["status"], 0) + 1
+      # failed objects are not checkpointed so a rerun retries them
+      if checkpoint is not None and result["status"] != "failed":
+        checkpoint.write(result["key"] + "\n")
+      if sum(counts.values()) % reportEvery == 0:
+        report()
+
+  try:
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+      pending = set()
+      for key in keys:
+        if key in completedKeys:
+          counts["resumed"] = counts.get("resumed", 0) + 1
+          continue
+        # keeping a bounded number of keys in flight, so listing
+        # large buckets doesn't queue every key in memory
+        if len(pending) >= workers * 4:
+          done, pending = wait(pending, return_when=FIRST_COMPLETED)
+          collect(done)
+        pending.add(executor.submit(backfillObject, s3Client, bucketName, key, force))
+      collect(wait(pending).done)
+    report()
+  finally:
+    if checkpoint is not None:
+      checkpoint.close()
+
+  return counts
+
+def parseArgs(argv):
+  parser = argparse.ArgumentParser(
+    description="Moderates the objects already stored in the webshop content bucket",
+  )
+  parser.add_argument("--bucket", required=True, help="content bucket name")
+  parser.add_argument("--prefix", default="", help="only moderate keys below this prefix")
+  parser.add_argument("--manifest", help="s3:// URL of an S3 Inventory manifest.json to read the keys from")
+  parser.add_argument("--workers", type=int, default=16, help="number of objects moderated concurrently")
+  parser.add_argument("--checkpoint", default="backfill.checkpoint", help="file tracking the completed keys")
+  parser.add_argument("--rekognition-tps", type=int, default=5, help="Rekognition requests per second, 0 to disable")
+  parser.add_argument("--force", action="store_true", help="moderate objects that are already tagged")
+  return parser.parse_args(argv)
+
+def main(argv=None, s3Client=None, rekognitionClient=None, dynamodbClient=None):
+  args = parseArgs(argv)
+  logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
+  # the default clients share a connection pool sized to the workers
+  clientConfig = Config(
+    max_pool_connections=args.workers,
+    retries={
+      "max_attempts": 8,
+      "mode": "adaptive",
+    },
+  )
+  s3Client = s3Client or boto3.client("s3", config=clientConfig)
+  rekognitionClient = rekognitionClient or boto3.client("rekognition", config=clientConfig)
+  dynamodbClient = dynamodbClient or boto3.client("dynamodb", config=clientConfig)
+
+  content_moderator.configureClients(
+    s3Client=s3Client,
+    rekognitionClient=rekognitionClient,
+    dynamodbClient=dynamodbClient,
+  )
+  content_moderator.disableMetrics()
+  content_moderator.configureRateLimiters(
+    rekognitionRateLimiter=TokenBucket(args.rekognition_tps) if args.rekognition_tps > 0 else None,
+  )
+
+  if args.manifest:
+    keys = listManifestKeys(s3Client, args.manifest, args.bucket, args.prefix)
+  else:
+    keys = listKeys(s3Client, args.bucket, args.prefix)
+
+  counts = backfill(
+    s3Client,
+    args.bucket,
+    keys,
+    workers=args.workers,
+    checkpointPath=args.checkpoint,
+    force=args.force,
+  )
+  return 1 if counts.get("failed") else 0
+
+if __name__ == "__main__":
+  sys.exit(main())
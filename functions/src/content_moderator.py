@@ -1,38 +1,264 @@
 # This function is triggered by an S3 PutObject event notification.
 # It reads the file from the bucket and uses Amazon Rekognition
 # DetectModerationLabels API to moderate the content. If a content
-# is inappropriate, the object is tag with 
-# "inappropriateContent: true" tag
+# is inappropriate, the object is tag with
+# "inappropriateContent: true" tag. All records of an event are
+# moderated concurrently on a bounded thread pool. The S3 events
+# are either delivered directly or buffered on an SQS queue.
+# Objects are pre-screened with a HEAD request and a header sniff,
+# so non-images never reach Rekognition, and results are cached by
+# object content so that duplicate images are not analyzed again
 import boto3
+import importlib.util
+import io
 import json
 import logging
 import os
+import random
+import tempfile
+import threading
+from botocore.config import Config
+from botocore.exceptions import ClientError
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote_plus
+from metrics import MetricsBuffer
+from moderation_cache import getCacheKey, getCachedLabels, putCachedLabels
+from rate_limiter import RateLimitExceeded, createRateLimiter
 
-_s3_client = boto3.client('s3')
-_rekognition_client = boto3.client("rekognition")
+# Pillow is optional, without it oversized images are passed as an
+# S3Object reference when they fit its limit and skipped otherwise.
+# It is only imported once an image has to be downscaled
+PILLOW_AVAILABLE = importlib.util.find_spec("PIL") is not None
+
+# the X-Ray SDK is optional as well. Without it the invocations are
+# still traced, but the AWS calls don't show up as subsegments
+xray_recorder = None
+if os.getenv("TRACING_ENABLED", "false") == "true":
+  try:
+    from aws_xray_sdk.core import patch, xray_recorder
+    patch(["botocore"])
+  except ImportError:
+    xray_recorder = None
+
+MAX_WORKERS = int(os.getenv("MAX_WORKERS", "8"))
+# "S3Object" lets Rekognition read the object from S3 itself,
+# "Bytes" downloads it into the function first
+IMAGE_SOURCE = os.getenv("IMAGE_SOURCE", "S3Object")
+MAX_IMAGE_DIMENSION = int(os.getenv("MAX_IMAGE_DIMENSION", "2048"))
+# logging every event in full is expensive for large batches
+EVENT_LOG_SAMPLE_RATE = float(os.getenv("EVENT_LOG_SAMPLE_RATE", "0.01"))
+EVENT_LOG_MAX_BYTES = int(os.getenv("EVENT_LOG_MAX_BYTES", "2048"))
+# objects derived from moderated objects, e.g. image variants, are
+# not moderated again
+SKIP_PREFIXES = [prefix for prefix in os.getenv("SKIP_PREFIXES", "").split(",") if prefix]
+
+# Rekognition DetectModerationLabels image size limits
+BYTES_MAX_SIZE = 5 * 1024 * 1024
+S3_OBJECT_MAX_SIZE = 15 * 1024 * 1024
+# downloads of oversized images spill to /tmp beyond this size
+SPOOL_MAX_SIZE = 8 * 1024 * 1024
+
+# Rekognition only supports JPEG and PNG images
+SUPPORTED_CONTENT_TYPES = ["image/jpeg", "image/jpg", "image/png"]
+# uploads without a specific content type are sniffed as well
+GENERIC_CONTENT_TYPES = ["", "binary/octet-stream", "application/octet-stream"]
+IMAGE_SIGNATURES = [
+  b"\xff\xd8\xff",
+  b"\x89PNG\r\n\x1a\n",
+]
+
+# rates are per second for the whole function. An empty table
+# name splits them between the reserved concurrent executions
+RATE_LIMIT_TABLE_NAME = os.getenv("RATE_LIMIT_TABLE_NAME", "")
+REKOGNITION_TPS = int(os.getenv("REKOGNITION_TPS", "0"))
+TAGGING_TPS = int(os.getenv("TAGGING_TPS", "0"))
+RESERVED_CONCURRENCY = int(os.getenv("RESERVED_CONCURRENCY", "1"))
+RATE_LIMIT_MAX_WAIT_SECONDS = int(os.getenv("RATE_LIMIT_MAX_WAIT_SECONDS", "20"))
+RETRY_MAX_ATTEMPTS = int(os.getenv("RETRY_MAX_ATTEMPTS", "8"))
+
+THROTTLING_ERROR_CODES = [
+  "ThrottlingException",
+  "ProvisionedThroughputExceededException",
+  "TooManyRequestsException",
+  "RequestLimitExceeded",
+  "SlowDown",
+]
+# errors a retry can't fix, e.g. objects deleted before they were
+# moderated or images Rekognition can't decode
+PERMANENT_ERROR_CODES = [
+  "NoSuchKey",
+  "NotFound",
+  "404",
+  "NoSuchBucket",
+  "InvalidS3ObjectException",
+  "InvalidImageFormatException",
+  "ImageTooLargeException",
+]
+
+# boto3 clients are thread safe, size their connection pools to
+# the number of workers sharing them. The adaptive retry mode
+# backs off and rate limits the client once it gets throttled
+_client_config = Config(
+  max_pool_connections=MAX_WORKERS,
+  retries={
+    "max_attempts": RETRY_MAX_ATTEMPTS,
+    "mode": "adaptive",
+  },
+)
+# clients are created on first use, so the init phase stays short
+# and events that never reach a service don't build its client
+_clients = {}
+_clients_lock = threading.Lock()
+
+def getClient(serviceName):
+  client = _clients.get(serviceName)
+  if client is None:
+    with _clients_lock:
+      client = _clients.get(serviceName)
+      if client is None:
+        client = boto3.client(serviceName, config=_client_config)
+        _clients[serviceName] = client
+  return client
+
+_rekognition_rate_limiter = createRateLimiter(
+  lambda: getClient("dynamodb"), RATE_LIMIT_TABLE_NAME, "DetectModerationLabels", REKOGNITION_TPS, RESERVED_CONCURRENCY
+)
+_tagging_rate_limiter = createRateLimiter(
+  lambda: getClient("dynamodb"), RATE_LIMIT_TABLE_NAME, "PutObjectTagging", TAGGING_TPS, RESERVED_CONCURRENCY
+)
+
+LOGGER = logging.getLogger()
+
+# stage metrics recorded by the workers and published per batch
+_metrics = MetricsBuffer()
+_cold_start = True
+
+def configureClients(s3Client=None, rekognitionClient=None, dynamodbClient=None):
+  # replaces the default clients, e.g. for the backfill command
+  for serviceName, client in [("s3", s3Client), ("rekognition", rekognitionClient), ("dynamodb", dynamodbClient)]:
+    if client is not None:
+      _clients[serviceName] = client
+
+def disableMetrics():
+  # the stage metrics are only published by the function
+  _metrics.disable()
+
+def configureRateLimiters(rekognitionRateLimiter=None, taggingRateLimiter=None):
+  global _rekognition_rate_limiter, _tagging_rate_limiter
+  _rekognition_rate_limiter = rekognitionRateLimiter
+  _tagging_rate_limiter = taggingRateLimiter
+
+class SkippedObject(Exception):
+  # raised for objects that are not moderated, e.g. non-images
+  pass
+
+class ThrottledObjects(Exception):
+  # raised to have Lambda retry an event whose objects were throttled
+  pass
+
+def isThrottlingError(e):
+  if isinstance(e, RateLimitExceeded):
+    return True
+  return isinstance(e, ClientError) and e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+
+def isPermanentError(e):
+  return isinstance(e, ClientError) and e.response.get("Error", {}).get("Code") in PERMANENT_ERROR_CODES
 
 def readObject(bucketName, objectKey):
   # reading file from s3 bucket and passing it as bytes
   try:
-    fileObj = _s3_client.get_object(
-      Bucket=bucketName,
-      Key=objectKey,
-    )
-    file_content = fileObj["Body"].read()
+    with _metrics.timer("S3ReadDuration"):
+      fileObj = getClient("s3").get_object(
+        Bucket=bucketName,
+        Key=objectKey,
+      )
+      file_content = fileObj["Body"].read()
+    _metrics.put("BytesRead", len(file_content), "Bytes")
     return file_content
   except Exception as e:
     LOGGER.error(f"{str(e)}")
     raise
 
-def detectLabels(objectFile):
-  res = _rekognition_client.detect_moderation_labels(
-    Image={
-      "Bytes": objectFile
-    },
-    MinConfidence=90
+def sniffImage(bucketName, objectKey):
+  # reading only the first bytes to check the file signature
+  fileObj = getClient("s3").get_object(
+    Bucket=bucketName,
+    Key=objectKey,
+    Range="bytes=0-7",
   )
+  header = fileObj["Body"].read()
+  return any(header.startswith(signature) for signature in IMAGE_SIGNATURES)
+
+def downscaleObject(bucketName, objectKey):
+  # streaming the object into a spooled file and decoding it at a
+  # reduced size, so only the downscaled image is kept in memory
+  with tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_SIZE) as spool:
+    with _metrics.timer("S3ReadDuration"):
+      fileObj = getClient("s3").get_object(
+        Bucket=bucketName,
+        Key=objectKey,
+      )
+      for chunk in fileObj["Body"].iter_chunks(chunk_size=1024 * 1024):
+        spool.write(chunk)
+    _metrics.put("BytesRead", spool.tell(), "Bytes")
+    spool.seek(0)
+
+    from PIL import Image
+
+    with Image.open(spool) as image:
+      # lets the JPEG decoder scale down while decoding
+      image.draft("RGB", (MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))
+      image = image.convert("RGB")
+      image.thumbnail((MAX_IMAGE_DIMENSION, MAX_IMAGE_DIMENSION))
+
+      output = io.BytesIO()
+      image.save(output, format="JPEG", quality=85)
+
+  return output.getvalue()
+
+def screenObject(bucketName, objectKey, head):
+  # raises SkippedObject for objects Rekognition can't moderate
+  contentType = head.get("ContentType", "").split(";")[0].strip().lower()
+  size = head["ContentLength"]
+
+  if contentType not in SUPPORTED_CONTENT_TYPES + GENERIC_CONTENT_TYPES:
+    raise SkippedObject(f"unsupported content type {contentType}")
+  if size == 0:
+    raise SkippedObject("empty object")
+  if not sniffImage(bucketName, objectKey):
+    raise SkippedObject("not a JPEG or PNG image")
+
+def prepareImage(bucketName, objectKey, head):
+  # building the Rekognition image argument for the object
+  size = head["ContentLength"]
+  s3ObjectImage = {
+    "S3Object": {
+      "Bucket": bucketName,
+      "Name": objectKey,
+    }
+  }
+
+  if IMAGE_SOURCE == "S3Object" and size <= S3_OBJECT_MAX_SIZE:
+    return s3ObjectImage
+  if IMAGE_SOURCE != "S3Object" and size <= BYTES_MAX_SIZE:
+    return {"Bytes": readObject(bucketName, objectKey)}
+  if PILLOW_AVAILABLE:
+    LOGGER.info(f"downscaling object {objectKey} of {size} bytes")
+    return {"Bytes": downscaleObject(bucketName, objectKey)}
+  if size <= S3_OBJECT_MAX_SIZE:
+    return s3ObjectImage
+  raise SkippedObject(f"image of {size} bytes is too large")
+
+def detectLabels(image):
+  if _rekognition_rate_limiter is not None:
+    _rekognition_rate_limiter.acquire(RATE_LIMIT_MAX_WAIT_SECONDS)
+  with _metrics.timer("RekognitionLatency"):
+    res = getClient("rekognition").detect_moderation_labels(
+      Image=image,
+      MinConfidence=90
+    )
   labels = []
-  LOGGER.info(f"received_label:{res}")
+  LOGGER.debug(f"received_label:{res}")
   try:
     if "ModerationLabels" in res:
       for label in res["ModerationLabels"]:
@@ -50,57 +276,185 @@ def detectLabels(objectFile):
 
 def setInappropriateContentTag(bucketName, objectKey, value):
   try:
-    _s3_client.put_object_tagging(
-      Bucket=bucketName,
-      Key=objectKey,
-      Tagging={
-        'TagSet': [
-          {
-            'Key': 'InappropriateContent',
-            'Value': value
-          },
-        ]
-      },
-    )
+    if _tagging_rate_limiter is not None:
+      _tagging_rate_limiter.acquire(RATE_LIMIT_MAX_WAIT_SECONDS)
+    with _metrics.timer("TaggingLatency"):
+      getClient("s3").put_object_tagging(
+        Bucket=bucketName,
+        Key=objectKey,
+        Tagging={
+          'TagSet': [
+            {
+              'Key': 'InappropriateContent',
+              'Value': value
+            },
+          ]
+        },
+      )
   except Exception as e:
     LOGGER.error(f"{str(e)}")
     raise
 
+def moderateObject(bucketName, objectKey):
+  # returns the labels and whether they came from the cache
+  if any(objectKey.startswith(prefix) for prefix in SKIP_PREFIXES):
+    raise SkippedObject("derived object")
+
+  head = getClient("s3").head_object(
+    Bucket=bucketName,
+    Key=objectKey,
+  )
+  screenObject(bucketName, objectKey, head)
+
+  cacheKey = getCacheKey(head)
+  labels = getCachedLabels(getClient, cacheKey)
+  cached = labels is not None
+  if not cached:
+    image = prepareImage(bucketName, objectKey, head)
+    labels = detectLabels(image)
+    putCachedLabels(getClient, cacheKey, labels)
+
+  LOGGER.info(f"tagging object {objectKey} on bucket {bucketName}")
+
+  if len(labels) > 0:
+    setInappropriateContentTag(bucketName, objectKey, 'true')
+    LOGGER.info(f"object {objectKey} on bucket {bucketName} has been tagged inappropriate")
+  else:
+    setInappropriateContentTag(bucketName, objectKey, 'false')
+    LOGGER.info(f"object {objectKey} on bucket {bucketName} is not inappropriate")
+
+  _metrics.put("LabelCount", len(labels), "Count")
+  return labels, cached
+
+def processRecord(record):
+  bucketName = record["s3"]["bucket"]["name"]
+  # object keys are URL encoded in S3 event notifications
+  objectKey = unquote_plus(record["s3"]["object"]["key"])
+
+  result = {
+    "bucket": bucketName,
+    "key": objectKey,
+  }
+  try:
+    result["labels"], result["cached"] = moderateObject(bucketName, objectKey)
+    result["status"] = "moderated"
+  except SkippedObject as e:
+    LOGGER.info(f"skipping object {objectKey} on bucket {bucketName}: {str(e)}")
+    result["status"] = "skipped"
+    result["reason"] = str(e)
+  except Exception as e:
+    if isPermanentError(e):
+      LOGGER.info(f"skipping object {objectKey} on bucket {bucketName}: {str(e)}")
+      result["status"] = "skipped"
+      result["reason"] = str(e)
+      return result
+    LOGGER.error(f"failed to moderate object {objectKey} on bucket {bucketName}: {str(e)}")
+    result["status"] = "failed"
+    result["error"] = str(e)
+    result["throttled"] = isThrottlingError(e)
+  return result
+
+def processRecords(records):
+  # one failing record does not stop the others, each record
+  # reports its own result
+  workers = max(1, min(MAX_WORKERS, len(records)))
+  traceEntity = xray_recorder.get_trace_entity() if xray_recorder is not None else None
+
+  def processTracedRecord(record):
+    # worker threads don't inherit the X-Ray trace context
+    if traceEntity is not None:
+      xray_recorder.set_trace_entity(traceEntity)
+    return processRecord(record)
+
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    results = list(executor.map(processTracedRecord, records))
+
+  moderated = [result for result in results if result["status"] == "moderated"]
+  cacheHits = len([result for result in moderated if result["cached"]])
+  _metrics.put("CacheHits", cacheHits, "Count")
+  _metrics.put("CacheMisses", len(moderated) - cacheHits, "Count")
+  _metrics.flush()
+  return results
+
+def processSqsMessages(messages):
+  # every message body holds an S3 event with one or more records
+  items = []
+  failedMessageIds = set()
+  for message in messages:
+    # malformed messages would fail the same way on every retry, they
+    # are dropped instead of being sent to the dead-letter queue
+    try:
+      body = json.loads(message["body"])
+      if not isinstance(body, dict):
+        raise ValueError("message body is not an object")
+    except ValueError as e:
+      LOGGER.error(f"skipping malformed message {message['messageId']}: {str(e)}")
+      continue
+    # S3 sends a s3:TestEvent without records when the
+    # notification is configured
+    for record in body.get("Records", []):
+      if "s3" in record:
+        items.append((message["messageId"], record))
+
+  results = processRecords([record for _, record in items])
+  for (messageId, _), result in zip(items, results):
+    if result["status"] == "failed":
+      failedMessageIds.add(messageId)
+
+  LOGGER.info(f"moderated {len(results)} objects from {len(messages)} messages, {len(failedMessageIds)} messages failed")
+
+  # only the messages with retryable failures become visible again
+  # on the queue, skipped objects are not retried
+  return {
+    "batchItemFailures": [
+      {"itemIdentifier": messageId} for messageId in failedMessageIds
+    ]
+  }
+
+def logEvent(event):
+  # logging a truncated sample of the events, or all of them when
+  # debugging
+  if LOGGER.isEnabledFor(logging.DEBUG) or random.random() < EVENT_LOG_SAMPLE_RATE:
+    LOGGER.info(f"received_event:{json.dumps(event)[:EVENT_LOG_MAX_BYTES]}")
+
 def lambda_handler(event, context):
-  global LOGGER
+  global LOGGER, _cold_start
   LOGGER = logging.getLogger()
   LOGGER.setLevel(level=os.getenv("LOG_LEVEL", "INFO").upper())
 
-  LOGGER.info(f"received_event:{event}")
+  _metrics.put("ColdStart", 1 if _cold_start else 0, "Count")
+  _cold_start = False
+
+  logEvent(event)
 
   try:
     if "Records" in event:
-      bucket = event["Records"][0]["s3"]["bucket"]
-      object = event["Records"][0]["s3"]["object"]
+      sqsMessages = [record for record in event["Records"] if record.get("eventSource") == "aws:sqs"]
+      if sqsMessages:
+        return processSqsMessages(sqsMessages)
 
-      bucketName = bucket["name"]
-      objectKey = object["key"]
+      records = [record for record in event["Records"] if "s3" in record]
+      results = processRecords(records)
+      failed = [result for result in results if result["status"] == "failed"]
 
-      file = readObject(bucketName, objectKey)
-      lables = detectLabels(file)
-      
-      LOGGER.info(f"tagging object {objectKey} on bucket {bucketName}")
+      LOGGER.info(f"moderated {len(results) - len(failed)} of {len(results)} objects")
 
-      if len(lables) > 0:
-        setInappropriateContentTag(bucketName, objectKey, 'true')
-        LOGGER.info(f"object {objectKey} on bucket {bucketName} has been tagged inappropriate")
-      else: 
-        setInappropriateContentTag(bucketName, objectKey, 'false')
-        LOGGER.info(f"object {objectKey} on bucket {bucketName} is not inappropriate")
+      # S3 invokes the function asynchronously, raising makes Lambda
+      # retry the event later. Objects moderated already are cache hits
+      throttled = [result for result in failed if result["throttled"]]
+      if throttled:
+        raise ThrottledObjects(f"{len(throttled)} objects were throttled")
 
       response = {
-        "statusCode": 200,
+        "statusCode": 400 if failed else 200,
         "body": json.dumps({"message": {
-          "labels": lables
+          "results": results
         }})
       }
       return response
 
+  except ThrottledObjects:
+    raise
   except Exception as e:
     LOGGER.error(f"{str(e)}")
     return {
@@ -0,0 +1,180 @@
+# This function generates responsive variants of the images uploaded
+# to the web shop content bucket. It is triggered by the S3
+# ObjectTagging:Put event notification of the "InappropriateContent"
+# tag the content moderator function sets, so images are only
+# processed once they have been moderated. Each image is resized to
+# the configured widths and encoded in the configured formats under
+# "<prefix>/<format>/<width>/<key>", which CloudFront picks from by
+# the Accept header. Variants of inappropriate images are removed
+import boto3
+import io
+import json
+import logging
+import os
+from urllib.parse import unquote_plus
+
+VARIANTS_PREFIX = os.getenv("VARIANTS_PREFIX", "variants")
+VARIANT_WIDTHS = [int(width) for width in os.getenv("VARIANT_WIDTHS", "320,640,1280").split(",")]
+# formats in order of preference, the last one is the fallback for
+# browsers accepting none of the others
+VARIANT_FORMATS = os.getenv("VARIANT_FORMATS", "avif,webp,jpeg").split(",")
+VARIANT_QUALITY = int(os.getenv("VARIANT_QUALITY", "80"))
+# larger images are skipped rather than decoded in memory
+SOURCE_MAX_SIZE = int(os.getenv("SOURCE_MAX_SIZE", str(20 * 1024 * 1024)))
+
+MODERATION_TAG_KEY = "InappropriateContent"
+SUPPORTED_CONTENT_TYPES = ["image/jpeg", "image/jpg", "image/png"]
+FORMATS = {
+  "avif": ("AVIF", "image/avif"),
+  "webp": ("WEBP", "image/webp"),
+  "jpeg": ("JPEG", "image/jpeg"),
+}
+
+LOGGER = logging.getLogger()
+
+class SkippedObject(Exception):
+  # raised for objects that get no variants
+  pass
+
+# the client is created on first use to keep the init phase short
+_s3_client = None
+
+def getS3Client():
+  global _s3_client
+  if _s3_client is None:
+    _s3_client = boto3.client("s3")
+  return _s3_client
+
+def getVariantKey(variantFormat, width, objectKey):
+  return f"{VARIANTS_PREFIX}/{variantFormat}/{width}/{objectKey}"
+
+def getModerationVerdict(bucketName, objectKey):
+  # returns "true", "false" or None when not moderated yet
+  res = getS3Client().get_object_tagging(
+    Bucket=bucketName,
+    Key=objectKey,
+  )
+  for tag in res["TagSet"]:
+    if tag["Key"] == MODERATION_TAG_KEY:
+      return tag["Value"]
+  return None
+
+def deleteVariants(bucketName, objectKey):
+  getS3Client().delete_objects(
+    Bucket=bucketName,
+    Delete={
+      "Objects": [
+        {"Key": getVariantKey(variantFormat, width, objectKey)}
+        for variantFormat in VARIANT_FORMATS
+        for width in VARIANT_WIDTHS
+      ],
+      "Quiet": True,
+    },
+  )
+
+def encodeVariant(image, variantFormat):
+  pillowFormat, _ = FORMATS[variantFormat]
+  if variantFormat == "jpeg" and image.mode != "RGB":
+    image = image.convert("RGB")
+  output = io.BytesIO()
+  image.save(output, format=pillowFormat, quality=VARIANT_QUALITY)
+  return output.getvalue()
+
+def generateVariants(bucketName, objectKey):
+  # Pillow is bundled with the function, it is imported here so
+  # that events which skip every object don't load it
+  from PIL import Image
+
+  obj = getS3Client().get_object(
+    Bucket=bucketName,
+    Key=objectKey,
+  )
+  contentType = obj.get("ContentType", "").split(";")[0].strip().lower()
+  if contentType not in SUPPORTED_CONTENT_TYPES:
+    raise SkippedObject(f"unsupported content type {contentType}")
+  if obj["ContentLength"] > SOURCE_MAX_SIZE:
+    raise SkippedObject(f"image of {obj['ContentLength']} bytes is too large")
+
+  variantKeys = []
+  with Image.open(io.BytesIO(obj["Body"].read())) as image:
+    image.load()
+    if image.mode not in ("RGB", "RGBA"):
+      image = image.convert("RGBA" if "transparency" in image.info or image.mode in ("LA", "PA") else "RGB")
+
+    formats = list(VARIANT_FORMATS)
+    for width in VARIANT_WIDTHS:
+      # images are never upscaled, narrower images are stored at
+      # their own size so that every variant key exists
+      resized = image
+      if image.width > width:
+        resized = image.resize((width, max(1, round(image.height * width / image.width))), Image.LANCZOS)
+      for variantFormat in list(formats):
+        try:
+          body = encodeVariant(resized, variantFormat)
+        except (KeyError, OSError) as e:
+          # e.g. a Pillow build without an AVIF encoder
+          LOGGER.warning(f"cannot encode {variantFormat} variants: {str(e)}")
+          formats.remove(variantFormat)
+          continue
+        variantKey = getVariantKey(variantFormat, width, objectKey)
+        getS3Client().put_object(
+          Bucket=bucketName,
+          Key=variantKey,
+          Body=body,
+          ContentType=FORMATS[variantFormat][1],
+          CacheControl="public, max-age=31536000",
+        )
+        variantKeys.append(variantKey)
+  return variantKeys
+
+def processRecord(record):
+  bucketName = record["s3"]["bucket"]["name"]
+  # object keys are URL encoded in S3 event notifications
+  objectKey = unquote_plus(record["s3"]["object"]["key"])
+
+  result = {
+    "bucket": bucketName,
+    "key": objectKey,
+  }
+  try:
+    if objectKey.startswith(f"{VARIANTS_PREFIX}/"):
+      raise SkippedObject("object is a variant")
+
+    verdict = getModerationVerdict(bucketName, objectKey)
+    if verdict == "true":
+      deleteVariants(bucketName, objectKey)
+      LOGGER.info(f"removed variants of inappropriate object {objectKey} on bucket {bucketName}")
+      result["status"] = "removed"
+    elif verdict == "false":
+      result["variants"] = generateVariants(bucketName, objectKey)
+      LOGGER.info(f"generated {len(result['variants'])} variants of object {objectKey} on bucket {bucketName}")
+      result["status"] = "generated"
+    else:
+      raise SkippedObject("object is not moderated yet")
+  except SkippedObject as e:
+    LOGGER.info(f"skipping object {objectKey} on bucket {bucketName}: {str(e)}")
+    result["status"] = "skipped"
+    result["reason"] = str(e)
+  except Exception as e:
+    LOGGER.error(f"failed to generate variants of object {objectKey} on bucket {bucketName}: {str(e)}")
+    result["status"] = "failed"
+    result["error"] = str(e)
+  return result
+
+def lambda_handler(event, context):
+  global LOGGER
+  LOGGER = logging.getLogger()
+  LOGGER.setLevel(level=os.getenv("LOG_LEVEL", "INFO").upper())
+
+  records = [record for record in event.get("Records", []) if "s3" in record]
+  results = [processRecord(record) for record in records]
+  failed = [result for result in results if result["status"] == "failed"]
+
+  LOGGER.info(f"processed {len(results) - len(failed)} of {len(results)} objects")
+
+  return {
+    "statusCode": 400 if failed else 200,
+    "body": json.dumps({"message": {
+      "results": results
+    }})
+  }
@@ -0,0 +1,75 @@
+# Publishes CloudWatch metrics by writing log lines in the
+# CloudWatch Embedded Metric Format, which needs no API call
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+METRICS_NAMESPACE = os.getenv("METRICS_NAMESPACE", "Magento/ContentModerator")
+# EMF accepts up to 100 values per metric in a single document
+MAX_VALUES_PER_METRIC = 100
+
+def emitMetrics(metrics, units):
+  # metrics maps metric names to a value or a list of values, units
+  # maps the same names to CloudWatch units, e.g. {"CacheHits": "Count"}
+  functionName = os.getenv("AWS_LAMBDA_FUNCTION_NAME", "local")
+  document = {
+    "_aws": {
+      "Timestamp": int(time.time() * 1000),
+      "CloudWatchMetrics": [
+        {
+          "Namespace": METRICS_NAMESPACE,
+          "Dimensions": [["FunctionName"]],
+          "Metrics": [
+            {"Name": name, "Unit": units.get(name, "None")} for name in metrics
+          ],
+        }
+      ],
+    },
+    "FunctionName": functionName,
+  }
+  document.update(metrics)
+  print(json.dumps(document))
+
+class MetricsBuffer:
+  # collects the values recorded by concurrent workers, so a batch
+  # is published with a few log lines instead of one per value
+  def __init__(self):
+    self._lock = threading.Lock()
+    self._values = {}
+    self._units = {}
+    self._enabled = True
+
+  def disable(self):
+    # values put afterwards are dropped
+    self._enabled = False
+
+  def put(self, name, value, unit):
+    if not self._enabled:
+      return
+    with self._lock:
+      self._values.setdefault(name, []).append(value)
+      self._units[name] = unit
+
+  @contextmanager
+  def timer(self, name):
+    startedAt = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.put(name, (time.perf_counter() - startedAt) * 1000, "Milliseconds")
+
+  def flush(self):
+    with self._lock:
+      values, self._values = self._values, {}
+      units = self._units
+
+    while values:
+      chunk = {name: metricValues[:MAX_VALUES_PER_METRIC] for name, metricValues in values.items()}
+      emitMetrics(chunk, units)
+      values = {
+        name: metricValues[MAX_VALUES_PER_METRIC:]
+        for name, metricValues in values.items()
+        if len(metricValues) > MAX_VALUES_PER_METRIC
+      }
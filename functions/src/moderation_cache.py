@@ -0,0 +1,59 @@
+# A DynamoDB backed cache of moderation results. Magento often
+# uploads identical images again, e.g. when regenerating them, so
+# results are keyed by the object content rather than its key and
+# expire through the DynamoDB TTL on "expiresAt"
+import json
+import logging
+import os
+import time
+
+LOGGER = logging.getLogger()
+
+# an empty table name disables the cache
+CACHE_TABLE_NAME = os.getenv("CACHE_TABLE_NAME", "")
+CACHE_TTL_DAYS = int(os.getenv("CACHE_TTL_DAYS", "30"))
+
+def getCacheKey(head):
+  # prefer a SHA-256 the uploader stored on the object and fall back
+  # to the ETag, which is the MD5 of single part uploads
+  metadata = head.get("Metadata", {})
+  if metadata.get("sha256"):
+    return f"sha256:{metadata['sha256']}"
+  etag = head["ETag"].strip('"')
+  return f"etag:{etag}"
+
+def getCachedLabels(getClient, cacheKey):
+  # returns None on a cache miss. Cache errors are treated as misses
+  # so that moderation never depends on the cache. getClient returns
+  # a boto3 client by service name
+  if not CACHE_TABLE_NAME:
+    return None
+  try:
+    res = getClient("dynamodb").get_item(
+      TableName=CACHE_TABLE_NAME,
+      Key={"cacheKey": {"S": cacheKey}},
+    )
+  except Exception as e:
+    LOGGER.warning(f"failed to read moderation cache: {str(e)}")
+    return None
+
+  item = res.get("Item")
+  # DynamoDB deletes expired items with a delay
+  if item is None or int(item["expiresAt"]["N"]) < time.time():
+    return None
+  return json.loads(item["labels"]["S"])
+
+def putCachedLabels(getClient, cacheKey, labels):
+  if not CACHE_TABLE_NAME:
+    return
+  try:
+    getClient("dynamodb").put_item(
+      TableName=CACHE_TABLE_NAME,
+      Item={
+        "cacheKey": {"S": cacheKey},
+        "labels": {"S": json.dumps(labels)},
+        "expiresAt": {"N": str(int(time.time()) + CACHE_TTL_DAYS * 86400)},
+      },
+    )
+  except Exception as e:
+    LOGGER.warning(f"failed to write moderation cache: {str(e)}")
@@ -0,0 +1,93 @@
+# Client side rate limiting for the APIs called by the moderator.
+# Concurrent invocations either share a per second DynamoDB counter,
+# or each invocation takes its share of the rate locally when the
+# function concurrency is capped by reserved concurrency
+import logging
+import random
+import threading
+import time
+from botocore.exceptions import ClientError
+
+LOGGER = logging.getLogger()
+
+class RateLimitExceeded(Exception):
+  # raised when no token could be acquired within the wait time
+  pass
+
+class TokenBucket:
+  # a token bucket local to this execution environment. clock and
+  # sleep can be replaced in tests
+  def __init__(self, rate, clock=time.monotonic, sleep=time.sleep):
+    self._rate = rate
+    self._capacity = max(1.0, rate)
+    self._clock = clock
+    self._sleep = sleep
+    self._tokens = self._capacity
+    self._updatedAt = clock()
+    self._lock = threading.Lock()
+
+  def acquire(self, maxWaitSeconds):
+    deadline = self._clock() + maxWaitSeconds
+    while True:
+      with self._lock:
+        now = self._clock()
+        self._tokens = min(self._capacity, self._tokens + (now - self._updatedAt) * self._rate)
+        self._updatedAt = now
+        if self._tokens >= 1:
+          self._tokens -= 1
+          return
+        wait = (1 - self._tokens) / self._rate
+      if self._clock() + wait > deadline:
+        raise RateLimitExceeded(f"no token available within {maxWaitSeconds} seconds")
+      self._sleep(wait)
+
+class SharedRateLimiter:
+  # a fixed one second window counter on DynamoDB shared by all
+  # invocations. Each window is a separate item expiring by TTL.
+  # getDynamodbClient is called on use, so the client is built lazily
+  def __init__(self, getDynamodbClient, tableName, name, rate, clock=time.time, sleep=time.sleep):
+    self._getDynamodbClient = getDynamodbClient
+    self._tableName = tableName
+    self._name = name
+    self._rate = rate
+    self._clock = clock
+    self._sleep = sleep
+
+  def acquire(self, maxWaitSeconds):
+    deadline = self._clock() + maxWaitSeconds
+    while True:
+      window = int(self._clock())
+      try:
+        self._getDynamodbClient().update_item(
+          TableName=self._tableName,
+          Key={"rateKey": {"S": f"{self._name}#{window}"}},
+          UpdateExpression="ADD tokens :one SET expiresAt = :expiresAt",
+          ConditionExpression="attribute_not_exists(tokens) OR tokens < :rate",
+          ExpressionAttributeValues={
+            ":one": {"N": "1"},
+            ":rate": {"N": str(self._rate)},
+            ":expiresAt": {"N": str(window + 300)},
+          },
+        )
+        return
+      except ClientError as e:
+        if e.response["Error"]["Code"] != "ConditionalCheckFailedException":
+          # the limiter fails open, the adaptive retries of the
+          # clients still back off on throttling
+          LOGGER.warning(f"failed to update rate limit counter: {str(e)}")
+          return
+
+      # wait for the next window with a jitter, so that waiting
+      # invocations don't all retry at the same instant
+      wait = window + 1 - self._clock() + random.uniform(0, 0.2)
+      if self._clock() + wait > deadline:
+        raise RateLimitExceeded(f"no {self._name} token available within {maxWaitSeconds} seconds")
+      self._sleep(wait)
+
+def createRateLimiter(getDynamodbClient, tableName, name, rate, reservedConcurrency):
+  # returns None when the rate is not limited
+  if rate <= 0:
+    return None
+  if tableName:
+    return SharedRateLimiter(getDynamodbClient, tableName, name, rate)
+  return TokenBucket(rate / max(1, reservedConcurrency))
@@ -0,0 +1,23 @@
+# the functions are deployed from functions/src without a package,
+# the tests import them the same way
+import os
+import sys
+
+os.environ.setdefault("AWS_ACCESS_KEY_ID", "testing")
+os.environ.setdefault("AWS_SECRET_ACCESS_KEY", "testing")
+os.environ.setdefault("AWS_DEFAULT_REGION", "us-east-1")
+os.environ["EVENT_LOG_SAMPLE_RATE"] = "0"
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+import boto3
+import pytest
+from moto import mock_aws
+
+from stubs import BUCKET_NAME
+
+@pytest.fixture
+def s3Client():
+  with mock_aws():
+    client = boto3.client("s3")
+    client.create_bucket(Bucket=BUCKET_NAME)
+    yield client
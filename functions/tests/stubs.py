@@ -0,0 +1,44 @@
+# test doubles shared by the function tests
+import threading
+
+from botocore.exceptions import ClientError
+
+BUCKET_NAME = "content-bucket"
+JPEG_BODY = b"\xff\xd8\xff\xe0\x00\x10JFIF\x00" + b"\x00" * 64
+
+class StubRekognition:
+  # labels the images whose key contains one of the labeled words
+  # and throttles the ones containing one of the throttled words,
+  # moto does not implement DetectModerationLabels
+  def __init__(self, labeled=(), throttled=()):
+    self._labeled = labeled
+    self._throttled = throttled
+    self._lock = threading.Lock()
+    self.calls = []
+
+  def detect_moderation_labels(self, Image, MinConfidence):
+    objectKey = Image["S3Object"]["Name"]
+    with self._lock:
+      self.calls.append(objectKey)
+    if any(word in objectKey for word in self._throttled):
+      raise ClientError(
+        {"Error": {"Code": "ThrottlingException", "Message": "Rate exceeded"}},
+        "DetectModerationLabels",
+      )
+    if any(word in objectKey for word in self._labeled):
+      return {"ModerationLabels": [{"Name": "Suggestive", "Confidence": 95.0}]}
+    return {"ModerationLabels": []}
+
+def putImage(s3Client, objectKey, tags=None):
+  s3Client.put_object(
+    Bucket=BUCKET_NAME,
+    Key=objectKey,
+    Body=JPEG_BODY,
+    ContentType="image/jpeg",
+    Tagging="&".join(f"{key}={value}" for key, value in (tags or {}).items()),
+  )
+
+def getTag(s3Client, objectKey, tagKey="InappropriateContent"):
+  res = s3Client.get_object_tagging(Bucket=BUCKET_NAME, Key=objectKey)
+  tags = {tag["Key"]: tag["Value"] for tag in res["TagSet"]}
+  return tags.get(tagKey)
@@ -0,0 +1,156 @@
+# Runs the backfill command against moto S3 and a stubbed Rekognition
+# client
+#
+#   $ pip install -r functions/tests/requirements.txt
+#   $ python -m pytest functions/tests
+import gzip
+import io
+import json
+
+import pytest
+
+import backfill
+import content_moderator
+from stubs import BUCKET_NAME, StubRekognition, getTag, putImage
+
+INVENTORY_BUCKET_NAME = "inventory-bucket"
+
+def runBackfill(s3Client, rekognitionClient, keys, tmp_path, **kwargs):
+  content_moderator.configureClients(s3Client=s3Client, rekognitionClient=rekognitionClient)
+  content_moderator.disableMetrics()
+  content_moderator.configureRateLimiters()
+  return backfill.backfill(
+    s3Client,
+    BUCKET_NAME,
+    keys,
+    workers=4,
+    checkpointPath=str(tmp_path / "backfill.checkpoint"),
+    output=io.StringIO(),
+    **kwargs,
+  )
+
+def putInventory(s3Client, rows, fileFormat="CSV"):
+  s3Client.create_bucket(Bucket=INVENTORY_BUCKET_NAME)
+  content = "".join(f'"{bucketName}","{objectKey}"\n' for bucketName, objectKey in rows)
+  s3Client.put_object(
+    Bucket=INVENTORY_BUCKET_NAME,
+    Key="inventory/data/part-0.csv.gz",
+    Body=gzip.compress(content.encode()),
+  )
+  s3Client.put_object(
+    Bucket=INVENTORY_BUCKET_NAME,
+    Key="inventory/manifest.json",
+    Body=json.dumps({
+      "fileFormat": fileFormat,
+      "fileSchema": "Bucket, Key",
+      "files": [{"key": "inventory/data/part-0.csv.gz"}],
+    }),
+  )
+  return f"s3://{INVENTORY_BUCKET_NAME}/inventory/manifest.json"
+
+def test_listKeys_paginates_below_prefix(s3Client):
+  for index in range(1005):
+    s3Client.put_object(Bucket=BUCKET_NAME, Key=f"media/catalog/{index}.jpg", Body=b"")
+  s3Client.put_object(Bucket=BUCKET_NAME, Key="variants/webp/320/a.jpg", Body=b"")
+
+  keys = list(backfill.listKeys(s3Client, BUCKET_NAME, "media/"))
+
+  assert len(keys) == 1005
+  assert all(key.startswith("media/catalog/") for key in keys)
+
+def test_listManifestKeys_filters_bucket_and_prefix(s3Client):
+  manifestUrl = putInventory(s3Client, [
+    (BUCKET_NAME, "media/a+b.jpg"),
+    (BUCKET_NAME, "media/c%2Bd.jpg"),
+    (BUCKET_NAME, "static/e.css"),
+    ("other-bucket", "media/f.jpg"),
+  ])
+
+  keys = list(backfill.listManifestKeys(s3Client, manifestUrl, BUCKET_NAME, "media/"))
+
+  # inventory keys are URL encoded
+  assert keys == ["media/a b.jpg", "media/c+d.jpg"]
+
+def test_listManifestKeys_rejects_other_formats(s3Client):
+  manifestUrl = putInventory(s3Client, [], fileFormat="Parquet")
+
+  with pytest.raises(ValueError):
+    list(backfill.listManifestKeys(s3Client, manifestUrl, BUCKET_NAME, ""))
+
+def test_loadCheckpoint(tmp_path):
+  checkpointPath = tmp_path / "backfill.checkpoint"
+  assert backfill.loadCheckpoint(None) == set()
+  assert backfill.loadCheckpoint(str(checkpointPath)) == set()
+
+  checkpointPath.write_text("media/a.jpg\n\nmedia/b.jpg\n")
+  assert backfill.loadCheckpoint(str(checkpointPath)) == {"media/a.jpg", "media/b.jpg"}
+
+def test_backfill_tags_untagged_objects(s3Client, tmp_path):
+  putImage(s3Client, "media/clean.jpg")
+  putImage(s3Client, "media/nsfw.jpg")
+  putImage(s3Client, "media/tagged.jpg", tags={backfill.TAG_KEY: "false"})
+  s3Client.put_object(Bucket=BUCKET_NAME, Key="media/notes.txt", Body=b"text", ContentType="text/plain")
+  rekognitionClient = StubRekognition(labeled=["nsfw"])
+
+  keys = backfill.listKeys(s3Client, BUCKET_NAME, "media/")
+  counts = runBackfill(s3Client, rekognitionClient, keys, tmp_path)
+
+  assert counts == {"moderated": 2, "tagged": 1, "skipped": 1}
+  assert sorted(rekognitionClient.calls) == ["media/clean.jpg", "media/nsfw.jpg"]
+  assert getTag(s3Client, "media/clean.jpg") == "false"
+  assert getTag(s3Client, "media/nsfw.jpg") == "true"
+
+def test_backfill_force_moderates_tagged_objects(s3Client, tmp_path):
+  putImage(s3Client, "media/tagged.jpg", tags={backfill.TAG_KEY: "false"})
+  rekognitionClient = StubRekognition(labeled=["tagged"])
+
+  counts = runBackfill(s3Client, rekognitionClient, ["media/tagged.jpg"], tmp_path, force=True)
+
+  assert counts == {"moderated": 1}
+  assert getTag(s3Client, "media/tagged.jpg") == "true"
+
+def test_backfill_encodes_keys_like_s3_events(s3Client, tmp_path):
+  putImage(s3Client, "media/summer sale+1.jpg")
+  rekognitionClient = StubRekognition()
+
+  counts = runBackfill(s3Client, rekognitionClient, ["media/summer sale+1.jpg"], tmp_path)
+
+  assert counts == {"moderated": 1}
+  assert getTag(s3Client, "media/summer sale+1.jpg") == "false"
+
+def test_backfill_resumes_from_checkpoint(s3Client, tmp_path):
+  keys = [f"media/{index}.jpg" for index in range(6)]
+  for objectKey in keys:
+    putImage(s3Client, objectKey)
+  (tmp_path / "backfill.checkpoint").write_text("".join(objectKey + "\n" for objectKey in keys[:4]))
+  rekognitionClient = StubRekognition()
+
+  counts = runBackfill(s3Client, rekognitionClient, keys, tmp_path)
+
+  assert counts == {"resumed": 4, "moderated": 2}
+  assert sorted(rekognitionClient.calls) == keys[4:]
+  assert backfill.loadCheckpoint(str(tmp_path / "backfill.checkpoint")) == set(keys)
+
+def test_backfill_does_not_checkpoint_failed_objects(s3Client, tmp_path):
+  putImage(s3Client, "media/clean.jpg")
+  putImage(s3Client, "media/throttled.jpg")
+  rekognitionClient = StubRekognition(throttled=["throttled"])
+
+  counts = runBackfill(s3Client, rekognitionClient, ["media/clean.jpg", "media/throttled.jpg"], tmp_path)
+
+  assert counts == {"moderated": 1, "failed": 1}
+  assert getTag(s3Client, "media/throttled.jpg") is None
+  assert backfill.loadCheckpoint(str(tmp_path / "backfill.checkpoint")) == {"media/clean.jpg"}
+
+def test_main_exit_code(s3Client, tmp_path):
+  putImage(s3Client, "media/clean.jpg")
+  putImage(s3Client, "other/throttled.jpg")
+  argv = [
+    "--bucket", BUCKET_NAME,
+    "--workers", "2",
+    "--rekognition-tps", "0",
+    "--checkpoint", str(tmp_path / "backfill.checkpoint"),
+  ]
+
+  assert backfill.main(argv + ["--prefix", "media/"], s3Client=s3Client, rekognitionClient=StubRekognition(throttled=["throttled"])) == 0
+  assert backfill.main(argv, s3Client=s3Client, rekognitionClient=StubRekognition(throttled=["throttled"])) == 1
@@ -0,0 +1,119 @@
+# Runs the content moderator handler on S3 and SQS events against
+# moto S3 and a stubbed Rekognition client
+import json
+
+import pytest
+
+import content_moderator
+from stubs import BUCKET_NAME, StubRekognition, getTag, putImage
+
+@pytest.fixture
+def rekognitionClient(s3Client):
+  client = StubRekognition(labeled=["nsfw"], throttled=["throttled"])
+  content_moderator.configureClients(s3Client=s3Client, rekognitionClient=client)
+  content_moderator.disableMetrics()
+  content_moderator.configureRateLimiters()
+  return client
+
+def buildS3Event(keys):
+  return {
+    "Records": [
+      {
+        "eventSource": "aws:s3",
+        "eventName": "ObjectCreated:Put",
+        "s3": {
+          "bucket": {"name": BUCKET_NAME},
+          "object": {"key": objectKey},
+        },
+      } for objectKey in keys
+    ]
+  }
+
+def buildSqsEvent(bodies):
+  return {
+    "Records": [
+      {
+        "eventSource": "aws:sqs",
+        "messageId": messageId,
+        "body": body if isinstance(body, str) else json.dumps(body),
+      } for messageId, body in bodies.items()
+    ]
+  }
+
+def getResults(response):
+  return {result["key"]: result for result in json.loads(response["body"])["message"]["results"]}
+
+def test_s3_event_tags_objects(s3Client, rekognitionClient):
+  putImage(s3Client, "media/clean.jpg")
+  putImage(s3Client, "media/nsfw.jpg")
+
+  response = content_moderator.lambda_handler(buildS3Event(["media/clean.jpg", "media/nsfw.jpg"]), None)
+
+  assert response["statusCode"] == 200
+  assert getTag(s3Client, "media/clean.jpg") == "false"
+  assert getTag(s3Client, "media/nsfw.jpg") == "true"
+
+def test_s3_event_skips_permanent_errors(s3Client, rekognitionClient):
+  putImage(s3Client, "media/clean.jpg")
+
+  # the missing object was deleted before it was moderated
+  response = content_moderator.lambda_handler(buildS3Event(["media/clean.jpg", "media/missing.jpg"]), None)
+
+  results = getResults(response)
+  assert response["statusCode"] == 200
+  assert results["media/clean.jpg"]["status"] == "moderated"
+  assert results["media/missing.jpg"]["status"] == "skipped"
+
+def test_s3_event_raises_on_throttled_objects(s3Client, rekognitionClient):
+  putImage(s3Client, "media/clean.jpg")
+  putImage(s3Client, "media/throttled.jpg")
+
+  # raising has Lambda retry the asynchronous S3 invocation
+  with pytest.raises(content_moderator.ThrottledObjects):
+    content_moderator.lambda_handler(buildS3Event(["media/clean.jpg", "media/throttled.jpg"]), None)
+
+  assert getTag(s3Client, "media/clean.jpg") == "false"
+  assert getTag(s3Client, "media/throttled.jpg") is None
+
+def test_sqs_event_returns_throttled_messages(s3Client, rekognitionClient):
+  putImage(s3Client, "media/clean.jpg")
+  putImage(s3Client, "media/throttled.jpg")
+
+  response = content_moderator.lambda_handler(buildSqsEvent({
+    "m1": buildS3Event(["media/clean.jpg"]),
+    "m2": buildS3Event(["media/throttled.jpg"]),
+  }), None)
+
+  assert response == {"batchItemFailures": [{"itemIdentifier": "m2"}]}
+  assert getTag(s3Client, "media/clean.jpg") == "false"
+
+def test_sqs_event_does_not_return_permanent_errors(s3Client, rekognitionClient):
+  putImage(s3Client, "media/clean.jpg")
+
+  response = content_moderator.lambda_handler(buildSqsEvent({
+    "m1": buildS3Event(["media/missing.jpg"]),
+    "m2": "not json",
+    "m3": "[]",
+    "m4": buildS3Event(["media/clean.jpg"]),
+  }), None)
+
+  assert response == {"batchItemFailures": []}
+  assert getTag(s3Client, "media/clean.jpg") == "false"
+
+def test_sqs_event_returns_message_once_per_failure(s3Client, rekognitionClient):
+  putImage(s3Client, "media/throttled-1.jpg")
+  putImage(s3Client, "media/throttled-2.jpg")
+
+  response = content_moderator.lambda_handler(buildSqsEvent({
+    "m1": buildS3Event(["media/throttled-1.jpg", "media/throttled-2.jpg"]),
+  }), None)
+
+  assert response == {"batchItemFailures": [{"itemIdentifier": "m1"}]}
+
+def test_sqs_test_event_is_ignored(s3Client, rekognitionClient):
+  response = content_moderator.lambda_handler(buildSqsEvent({
+    "m1": {"Service": "Amazon S3", "Event": "s3:TestEvent", "Bucket": BUCKET_NAME},
+  }), None)
+
+  assert response == {"batchItemFailures": []}
+  assert rekognitionClient.calls == []
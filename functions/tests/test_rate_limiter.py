@@ -0,0 +1,146 @@
+# Runs the rate limiters on a fake clock, the shared limiter against
+# moto DynamoDB
+import boto3
+import pytest
+from moto import mock_aws
+
+import rate_limiter
+
+TABLE_NAME = "rate-limit"
+
+class FakeClock:
+  # sleeping advances the clock instead of blocking
+  def __init__(self, now):
+    self.now = now
+    self.sleeps = []
+
+  def __call__(self):
+    return self.now
+
+  def sleep(self, seconds):
+    self.sleeps.append(seconds)
+    self.now += seconds
+
+@pytest.fixture
+def dynamodbClient():
+  with mock_aws():
+    client = boto3.client("dynamodb")
+    client.create_table(
+      TableName=TABLE_NAME,
+      KeySchema=[{"AttributeName": "rateKey", "KeyType": "HASH"}],
+      AttributeDefinitions=[{"AttributeName": "rateKey", "AttributeType": "S"}],
+      BillingMode="PAY_PER_REQUEST",
+    )
+    yield client
+
+def getTokens(dynamodbClient, name, window):
+  item = dynamodbClient.get_item(
+    TableName=TABLE_NAME,
+    Key={"rateKey": {"S": f"{name}#{window}"}},
+  )["Item"]
+  return int(item["tokens"]["N"]), int(item["expiresAt"]["N"])
+
+def test_token_bucket_starts_full_and_waits_for_refill():
+  clock = FakeClock(100.0)
+  bucket = rate_limiter.TokenBucket(2, clock=clock, sleep=clock.sleep)
+
+  bucket.acquire(10)
+  bucket.acquire(10)
+  assert clock.sleeps == []
+
+  bucket.acquire(10)
+  assert clock.sleeps == [pytest.approx(0.5)]
+
+def test_token_bucket_refill_is_capped_at_capacity():
+  clock = FakeClock(100.0)
+  bucket = rate_limiter.TokenBucket(2, clock=clock, sleep=clock.sleep)
+  bucket.acquire(10)
+  bucket.acquire(10)
+
+  # idle time does not accumulate more than one second of tokens
+  clock.now += 60
+  for _ in range(3):
+    bucket.acquire(10)
+
+  assert clock.sleeps == [pytest.approx(0.5)]
+
+def test_token_bucket_below_one_token_per_second():
+  clock = FakeClock(100.0)
+  bucket = rate_limiter.TokenBucket(0.25, clock=clock, sleep=clock.sleep)
+
+  bucket.acquire(10)
+  bucket.acquire(10)
+
+  assert clock.sleeps == [pytest.approx(4)]
+
+def test_token_bucket_times_out_without_sleeping():
+  clock = FakeClock(100.0)
+  bucket = rate_limiter.TokenBucket(0.1, clock=clock, sleep=clock.sleep)
+  bucket.acquire(5)
+
+  with pytest.raises(rate_limiter.RateLimitExceeded):
+    bucket.acquire(5)
+  assert clock.sleeps == []
+
+def test_shared_limiter_counts_per_window(dynamodbClient):
+  clock = FakeClock(1000.25)
+  limiter = rate_limiter.SharedRateLimiter(lambda: dynamodbClient, TABLE_NAME, "rekognition", 2, clock=clock, sleep=clock.sleep)
+
+  limiter.acquire(10)
+  limiter.acquire(10)
+
+  assert clock.sleeps == []
+  assert getTokens(dynamodbClient, "rekognition", 1000) == (2, 1300)
+
+def test_shared_limiter_retries_in_next_window(dynamodbClient):
+  clock = FakeClock(1000.25)
+  limiter = rate_limiter.SharedRateLimiter(lambda: dynamodbClient, TABLE_NAME, "rekognition", 2, clock=clock, sleep=clock.sleep)
+  limiter.acquire(10)
+  limiter.acquire(10)
+
+  # the condition check fails on the full window, the limiter waits
+  # for the next one and takes a token there
+  limiter.acquire(10)
+
+  assert len(clock.sleeps) == 1
+  assert 0.75 <= clock.sleeps[0] <= 0.95
+  assert getTokens(dynamodbClient, "rekognition", 1000) == (2, 1300)
+  assert getTokens(dynamodbClient, "rekognition", 1001) == (1, 1301)
+
+def test_shared_limiter_windows_are_per_name(dynamodbClient):
+  clock = FakeClock(1000.25)
+  rekognitionLimiter = rate_limiter.SharedRateLimiter(lambda: dynamodbClient, TABLE_NAME, "rekognition", 1, clock=clock, sleep=clock.sleep)
+  taggingLimiter = rate_limiter.SharedRateLimiter(lambda: dynamodbClient, TABLE_NAME, "tagging", 1, clock=clock, sleep=clock.sleep)
+
+  rekognitionLimiter.acquire(10)
+  taggingLimiter.acquire(10)
+
+  assert clock.sleeps == []
+
+def test_shared_limiter_times_out(dynamodbClient):
+  clock = FakeClock(1000.25)
+  limiter = rate_limiter.SharedRateLimiter(lambda: dynamodbClient, TABLE_NAME, "rekognition", 1, clock=clock, sleep=clock.sleep)
+  limiter.acquire(0.5)
+
+  with pytest.raises(rate_limiter.RateLimitExceeded):
+    limiter.acquire(0.5)
+  assert clock.sleeps == []
+
+def test_shared_limiter_fails_open(dynamodbClient):
+  clock = FakeClock(1000.25)
+  limiter = rate_limiter.SharedRateLimiter(lambda: dynamodbClient, "missing-table", "rekognition", 1, clock=clock, sleep=clock.sleep)
+
+  # errors other than the condition check don't block the caller
+  limiter.acquire(0)
+  limiter.acquire(0)
+
+  assert clock.sleeps == []
+
+def test_createRateLimiter(dynamodbClient):
+  assert rate_limiter.createRateLimiter(lambda: dynamodbClient, TABLE_NAME, "rekognition", 0, 4) is None
+  assert isinstance(rate_limiter.createRateLimiter(lambda: dynamodbClient, TABLE_NAME, "rekognition", 5, 4), rate_limiter.SharedRateLimiter)
+
+  bucket = rate_limiter.createRateLimiter(lambda: dynamodbClient, "", "rekognition", 8, 4)
+  assert isinstance(bucket, rate_limiter.TokenBucket)
+  # each reserved execution gets its share of the rate
+  assert bucket._rate == 2
@@ -20,7 +20,7 @@ setuptools.setup(
     packages=setuptools.find_packages(where="stacks"),
 
     install_requires=[
-        "aws-cdk.core==1.131.0",
+        "aws-cdk.core==1.150.0",
     ],
 
     python_requires=">=3.6",
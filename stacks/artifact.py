@@ -0,0 +1,192 @@
+import os.path
+from aws_cdk import core as cdk
+from aws_cdk import aws_s3 as _s3
+from aws_cdk import aws_ec2 as _ec2
+from aws_cdk import aws_s3_assets as _s3_assets
+from aws_cdk import aws_cloudfront as _cloudfront
+from aws_cdk import aws_codebuild as _codebuild
+from aws_cdk import aws_secretsmanager as _sm
+
+currentDirName = os.path.dirname(__file__)
+
+class ArtifactStack(cdk.Stack):
+  def __init__(
+    self,
+    scope: cdk.Construct,
+    construct_id: str,
+    vpc: _ec2.IVpc,
+    sg: _ec2.ISecurityGroup,
+    mysqlAddress: str,
+    mysqlSecret: _sm.ISecret,
+    buildConfigs,
+    **kwargs,
+  ) -> None:
+    super().__init__(scope, construct_id, **kwargs)
+
+    # extracting build configs
+    environment = buildConfigs["Environment"]
+    isProd = True if environment == "prod" else False
+    artifactConfigs = buildConfigs["Parameters"]["Artifact"]
+    magentoVersion = artifactConfigs["MagentoVersion"]
+    release = artifactConfigs["Release"]
+
+    # ensure retaining release artifacts on production environment
+    removalPolicy = cdk.RemovalPolicy.RETAIN if isProd else cdk.RemovalPolicy.DESTROY
+
+    # creating the bucket that stores versioned, ready-to-run
+    # Magento release tarballs
+    magentoArtifactBucket = _s3.Bucket(
+      self,
+      "magentoArtifactBucket",
+      versioned=True,
+      encryption=_s3.BucketEncryption.S3_MANAGED,
+      block_public_access=_s3.BlockPublicAccess.BLOCK_ALL,
+      removal_policy=removalPolicy,
+    )
+
+    # creating the bucket that stores the static content of every
+    # release under static/version<N>/, the path Magento signs static
+    # URLs with. CloudFront reads it through an origin access
+    # identity, which lives in this stack so that the bucket policy
+    # doesn't reference the distribution's stack
+    magentoStaticBucket = _s3.Bucket(
+      self,
+      "magentoStaticBucket",
+      encryption=_s3.BucketEncryption.S3_MANAGED,
+      block_public_access=_s3.BlockPublicAccess.BLOCK_ALL,
+      removal_policy=removalPolicy,
+    )
+
+    magentoStaticOai = _cloudfront.OriginAccessIdentity(
+      self,
+      "magentoStaticOai",
+      comment="Magento static content",
+    )
+    magentoStaticBucket.grant_read(magentoStaticOai)
+
+    # creating Magento's encryption key using Secrets Manager so
+    # that the build project and every web server share it
+    magentoCryptKey = _sm.Secret(
+      self,
+      "MagentoCryptKey",
+      secret_name="magento-crypt-key",
+      generate_secret_string=_sm.SecretStringGenerator(
+        exclude_punctuation=True,
+        include_space=False,
+        password_length=32,
+      ),
+    )
+
+    # packaging the release build scripts as the build source
+    releaseBuildSource = _s3_assets.Asset(
+      self,
+      "magentoReleaseBuildSource",
+      path="build/magento_release",
+    )
+
+    # creating the build project that installs Magento, compiles
+    # it once and uploads the result as a release tarball. It runs
+    # inside the VPC with the web server SG to reach the database
+    magentoReleaseBuild = _codebuild.Project(
+      self,
+      "magentoReleaseBuild",
+      description="Builds a ready-to-run Magento release artifact",
+      source=_codebuild.Source.s3(
+        bucket=releaseBuildSource.bucket,
+        path=releaseBuildSource.s3_object_key,
+      ),
+      build_spec=_codebuild.BuildSpec.from_source_filename("buildspec.yml"),
+      environment=_codebuild.BuildEnvironment(
+        build_image=_codebuild.LinuxBuildImage.AMAZON_LINUX_2_3,
+        compute_type=_codebuild.ComputeType.MEDIUM,
+      ),
+      environment_variables={
+        "MAGENTO_VERSION": _codebuild.BuildEnvironmentVariable(
+          value=magentoVersion,
+        ),
+        "MAGENTO_RELEASE": _codebuild.BuildEnvironmentVariable(
+          value=release,
+        ),
+        "ARTIFACT_BUCKET": _codebuild.BuildEnvironmentVariable(
+          value=magentoArtifactBucket.bucket_name,
+        ),
+        "STATIC_BUCKET": _codebuild.BuildEnvironmentVariable(
+          value=magentoStaticBucket.bucket_name,
+        ),
+        "MYSQL_INSTANCE_ADDRESS": _codebuild.BuildEnvironmentVariable(
+          value=mysqlAddress,
+        ),
+        "MYSQL_USER": _codebuild.BuildEnvironmentVariable(
+          type=_codebuild.BuildEnvironmentVariableType.SECRETS_MANAGER,
+          value=f"{mysqlSecret.secret_name}:username",
+        ),
+        "MYSQL_PWD": _codebuild.BuildEnvironmentVariable(
+          type=_codebuild.BuildEnvironmentVariableType.SECRETS_MANAGER,
+          value=f"{mysqlSecret.secret_name}:password",
+        ),
+        "MAGENTO_CRYPT_KEY": _codebuild.BuildEnvironmentVariable(
+          type=_codebuild.BuildEnvironmentVariableType.SECRETS_MANAGER,
+          value=magentoCryptKey.secret_name,
+        ),
+      },
+      vpc=vpc,
+      subnet_selection=_ec2.SubnetSelection(
+        subnet_type=_ec2.SubnetType.PRIVATE,
+      ),
+      security_groups=[sg],
+      timeout=cdk.Duration.minutes(60),
+    )
+
+    magentoArtifactBucket.grant_read_write(magentoReleaseBuild)
+    magentoStaticBucket.grant_read_write(magentoReleaseBuild)
+    mysqlSecret.grant_read(magentoReleaseBuild)
+    magentoCryptKey.grant_read(magentoReleaseBuild)
+
+    # assigning our resource to be able to reference it
+    # across stacks
+    self._magentoArtifactBucket = magentoArtifactBucket
+    self._magentoStaticBucket = magentoStaticBucket
+    self._magentoStaticOai = magentoStaticOai
+    self._magentoCryptKey = magentoCryptKey
+    self._magentoReleaseBuild = magentoReleaseBuild
+    self._release = release
+
+    # output resource
+    cdk.CfnOutput(
+      self,
+      "magentoArtifactBucketNameOutput",
+      value=magentoArtifactBucket.bucket_name,
+      export_name="magentoArtifactBucketName"
+    )
+    cdk.CfnOutput(
+      self,
+      "magentoStaticBucketNameOutput",
+      value=magentoStaticBucket.bucket_name,
+      export_name="magentoStaticBucketName"
+    )
+    cdk.CfnOutput(
+      self,
+      "magentoReleaseBuildProjectOutput",
+      value=magentoReleaseBuild.project_name,
+      export_name="magentoReleaseBuildProjectName",
+      description="Start this CodeBuild project to build a new Magento release artifact."
+    )
+
+  @property
+  def getArtifactBucket(self) -> _s3.IBucket:
+    return self._magentoArtifactBucket
+  @property
+  def getStaticBucket(self) -> _s3.IBucket:
+    return self._magentoStaticBucket
+  @property
+  def getStaticOriginAccessIdentity(self) -> _cloudfront.IOriginAccessIdentity:
+    return self._magentoStaticOai
+  @property
+  def getCryptKeySecret(self) -> _sm.ISecret:
+    return self._magentoCryptKey
+  @property
+  def getReleaseBuildProject(self) -> _codebuild.IProject:
+    return self._magentoReleaseBuild
+  @property
+  def getRelease(self) -> str:
+    return self._release
@@ -0,0 +1,68 @@
+from aws_cdk import core as cdk
+from aws_cdk import aws_ec2 as _ec2
+from aws_cdk import aws_elasticache as _elasticache
+
+class CacheStack(cdk.Stack):
+  def __init__(self, scope: cdk.Construct, construct_id: str, vpc: _ec2.IVpc, sg: _ec2.ISecurityGroup, buildConfigs, **kwargs) -> None:
+    super().__init__(scope, construct_id, **kwargs)
+
+    # extracting build configs
+    environment = buildConfigs["Environment"]
+    isProd = True if environment == "prod" else False
+
+    # reading cache configs from the project's cdk.json context
+    cacheConfigs = buildConfigs["Parameters"]["Cache"]
+    nodeType = cacheConfigs["NodeType"]
+    numCacheClusters = cacheConfigs["NumCacheClusters"]
+
+    # automatic failover needs at least one replica next to
+    # the primary node
+    automaticFailover = numCacheClusters > 1
+
+    # placing our redis nodes in the isolated subnets next to
+    # our DB instances
+    redisSubnetGroup = _elasticache.CfnSubnetGroup(
+      self,
+      "redisSubnetGroup",
+      description="Subnet group for Magento Redis replication group",
+      subnet_ids=vpc.select_subnets(
+        subnet_type=_ec2.SubnetType.ISOLATED,
+      ).subnet_ids,
+    )
+
+    # creating a replicated redis group used by Magento as the
+    # session store, default cache and page cache backend
+    redisReplicationGroup = _elasticache.CfnReplicationGroup(
+      self,
+      "redisReplicationGroup",
+      replication_group_description="Magento sessions, default cache and page cache",
+      engine="redis",
+      cache_node_type=nodeType,
+      num_cache_clusters=numCacheClusters,
+      automatic_failover_enabled=automaticFailover,
+      multi_az_enabled=automaticFailover and isProd,
+      cache_subnet_group_name=redisSubnetGroup.ref,
+      security_group_ids=[sg.security_group_id],
+      at_rest_encryption_enabled=True,
+      snapshot_retention_limit=7 if isProd else 0,
+    )
+    redisReplicationGroup.add_depends_on(redisSubnetGroup)
+
+    # assigning our resource to be able to reference it
+    # across stacks
+    self._redisReplicationGroup = redisReplicationGroup
+
+    # output resource
+    cdk.CfnOutput(
+      self,
+      "redisPrimaryEndpointOutput",
+      value=redisReplicationGroup.attr_primary_end_point_address,
+      export_name="redisPrimaryEndpointAddress"
+    )
+
+  @property
+  def getRedisEndpointAddress(self) -> str:
+    return self._redisReplicationGroup.attr_primary_end_point_address
+  @property
+  def getRedisEndpointPort(self) -> str:
+    return self._redisReplicationGroup.attr_primary_end_point_port
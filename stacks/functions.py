@@ -4,11 +4,60 @@ from aws_cdk import aws_s3 as _s3
 from aws_cdk import aws_ec2 as _ec2
 from aws_cdk import aws_iam as _iam
 from aws_cdk import aws_logs as _logs
+from aws_cdk import aws_sqs as _sqs
+from aws_cdk import aws_dynamodb as _dynamodb
 from aws_cdk import aws_lambda as _lambda
+from aws_cdk import aws_cloudwatch as _cloudwatch
+from aws_cdk import aws_applicationautoscaling as _appscaling
 from aws_cdk import aws_s3_notifications as _s3_notifications
+from aws_cdk import aws_cloudfront as _cloudfront
 
 currentDirName = os.path.dirname(__file__)
 
+# namespace of the metrics the content moderator function publishes
+# in the CloudWatch Embedded Metric Format
+CONTENT_MODERATOR_METRICS_NAMESPACE = "Magento/ContentModerator"
+
+def getContentModeratorCode(runtime: _lambda.Runtime, architecture: _lambda.Architecture, bundleDependencies: bool) -> _lambda.Code:
+  srcDirName = os.path.join(currentDirName, "../functions/src")
+  exclude = ["__pycache__", "backfill.py"]
+  if not bundleDependencies:
+    return _lambda.Code.from_asset(srcDirName, exclude=exclude)
+
+  # installing the optional dependencies of functions/src/requirements.txt
+  # as wheels for the target architecture and python version of the
+  # runtime, so arm64 packages can be bundled on x86_64 hosts too.
+  # Python 3.12 and later runtimes are based on Amazon Linux 2023,
+  # whose glibc also accepts manylinux_2_28 wheels
+  pythonVersion = runtime.name.replace("python", "")
+  machine = "aarch64" if architecture == _lambda.Architecture.ARM_64 else "x86_64"
+  platforms = f"--platform manylinux2014_{machine} --platform manylinux_2_28_{machine}"
+  return _lambda.Code.from_asset(
+    srcDirName,
+    exclude=exclude,
+    bundling=cdk.BundlingOptions(
+      image=runtime.bundling_image,
+      command=[
+        "bash", "-c",
+        f"pip install -r requirements.txt -t /asset-output {platforms} "
+        f"--implementation cp --python-version {pythonVersion} --only-binary=:all: "
+        "&& cp -au . /asset-output "
+        "&& rm -rf /asset-output/backfill.py /asset-output/requirements.txt /asset-output/__pycache__",
+      ],
+    ),
+  )
+
+def getContentModeratorMetric(functionName: str, metricName: str, statistic: str) -> _cloudwatch.Metric:
+  return _cloudwatch.Metric(
+    namespace=CONTENT_MODERATOR_METRICS_NAMESPACE,
+    metric_name=metricName,
+    dimensions_map={
+      "FunctionName": functionName,
+    },
+    statistic=statistic,
+    period=cdk.Duration.minutes(1),
+  )
+
 class FunctionsStack(cdk.Stack):
   def __init__(self, scope: cdk.Construct, construct_id: str, vpc: _ec2.IVpc,buildConfigs,  **kwargs) -> None:
     super().__init__(scope, construct_id, **kwargs)
@@ -21,13 +70,27 @@ class FunctionsStack(cdk.Stack):
   
     # ensure retaining file system on production environment
     removalPolicy = cdk.RemovalPolicy.RETAIN if isProd else cdk.RemovalPolicy.DESTROY
+    contentModeratorConfigs = buildConfigs["Parameters"]["ContentModerator"]
+    queueConfigs = contentModeratorConfigs["Queue"]
+    resultCacheConfigs = contentModeratorConfigs["ResultCache"]
+    rateLimitConfigs = contentModeratorConfigs["RateLimit"]
+    observabilityConfigs = contentModeratorConfigs["Observability"]
+    provisionedConcurrencyConfigs = contentModeratorConfigs["ProvisionedConcurrency"]
+    contentModeratorRuntime = _lambda.Runtime(
+      contentModeratorConfigs["Runtime"],
+      family=_lambda.RuntimeFamily.PYTHON,
+      bundling_docker_image=f"public.ecr.aws/sam/build-{contentModeratorConfigs['Runtime']}",
+    )
+    contentModeratorArchitecture = _lambda.Architecture.ARM_64 if contentModeratorConfigs["Architecture"] == "arm64" else _lambda.Architecture.X86_64
+    reservedConcurrency = contentModeratorConfigs["ReservedConcurrency"]
+    imageVariantsConfigs = buildConfigs["Parameters"]["ImageVariants"]
 
-    # read lambda function code
-    try:
-      with open("functions/src/content_moderator.py", mode="r") as file:
-        lambda_src = file.read()
-    except OSError:
-      print("Unable to read Lambda Function Code")
+    # the variants are encoded with Pillow, which is only part of the
+    # function code when the dependencies are bundled
+    if imageVariantsConfigs["Enabled"] and not contentModeratorConfigs["BundleDependencies"]:
+      raise Exception(
+        "ImageVariants requires ContentModerator BundleDependencies to be enabled"
+      )
 
     # configure proper permissions
     # create policy statement
@@ -47,21 +110,87 @@ class FunctionsStack(cdk.Stack):
       ]
     )
 
+    # create a table to cache moderation results by object content,
+    # expired results are evicted by the DynamoDB TTL
+    moderationCacheTable = None
+    if resultCacheConfigs["Enabled"]:
+      moderationCacheTable = _dynamodb.Table(
+        self,
+        "moderationCacheTable",
+        partition_key=_dynamodb.Attribute(
+          name="cacheKey",
+          type=_dynamodb.AttributeType.STRING,
+        ),
+        billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+        time_to_live_attribute="expiresAt",
+        removal_policy=cdk.RemovalPolicy.DESTROY,
+      )
+
+    # create a table for the per second request counters shared by
+    # all invocations to stay within the account API rates
+    rateLimitTable = None
+    if rateLimitConfigs["SharedCounter"]:
+      rateLimitTable = _dynamodb.Table(
+        self,
+        "moderationRateLimitTable",
+        partition_key=_dynamodb.Attribute(
+          name="rateKey",
+          type=_dynamodb.AttributeType.STRING,
+        ),
+        billing_mode=_dynamodb.BillingMode.PAY_PER_REQUEST,
+        time_to_live_attribute="expiresAt",
+        removal_policy=cdk.RemovalPolicy.DESTROY,
+      )
+
     # create the lambda function
     contentModeratorFn = _lambda.Function(
       self,
       "contentModeratorFn",
       function_name="contentModeratorFn",
       description="This function is called by S3 events and uses Amazon Rekognition API to check for inappropriate content",
-      runtime=_lambda.Runtime.PYTHON_3_7,
-      handler="index.lambda_handler",
-      code=_lambda.InlineCode(
-        lambda_src
+      runtime=contentModeratorRuntime,
+      architecture=contentModeratorArchitecture,
+      handler="content_moderator.lambda_handler",
+      # the function code outgrew the 4KB limit of inline code
+      code=getContentModeratorCode(
+        contentModeratorRuntime,
+        contentModeratorArchitecture,
+        contentModeratorConfigs["BundleDependencies"],
       ),
       vpc=vpc,
-      timeout=cdk.Duration.seconds(10),
+      memory_size=contentModeratorConfigs["MemorySize"],
+      # caps the concurrent executions sharing the API rates, 0
+      # leaves the function on the unreserved account concurrency
+      reserved_concurrent_executions=reservedConcurrency or None,
+      tracing=_lambda.Tracing.ACTIVE if observabilityConfigs["Tracing"] else _lambda.Tracing.DISABLED,
+      # a single invocation moderates every record of the event
+      timeout=cdk.Duration.seconds(contentModeratorConfigs["TimeoutSeconds"]),
       environment={
-        "LOG_LEVEL": "INFO"
+        "LOG_LEVEL": "INFO",
+        "MAX_WORKERS": str(contentModeratorConfigs["MaxWorkers"]),
+        "IMAGE_SOURCE": contentModeratorConfigs["ImageSource"],
+        "MAX_IMAGE_DIMENSION": str(contentModeratorConfigs["MaxImageDimension"]),
+        "CACHE_TABLE_NAME": moderationCacheTable.table_name if moderationCacheTable is not None else "",
+        "CACHE_TTL_DAYS": str(resultCacheConfigs["TtlDays"]),
+        "RATE_LIMIT_TABLE_NAME": rateLimitTable.table_name if rateLimitTable is not None else "",
+        "REKOGNITION_TPS": str(rateLimitConfigs["RekognitionTps"]),
+        "TAGGING_TPS": str(rateLimitConfigs["TaggingTps"]),
+        "RATE_LIMIT_MAX_WAIT_SECONDS": str(rateLimitConfigs["MaxWaitSeconds"]),
+        "RESERVED_CONCURRENCY": str(reservedConcurrency or 1),
+        "RETRY_MAX_ATTEMPTS": str(rateLimitConfigs["RetryMaxAttempts"]),
+        "METRICS_NAMESPACE": CONTENT_MODERATOR_METRICS_NAMESPACE,
+        "TRACING_ENABLED": "true" if observabilityConfigs["Tracing"] else "false",
+        "EVENT_LOG_SAMPLE_RATE": str(observabilityConfigs["EventLogSampleRate"]),
+        "EVENT_LOG_MAX_BYTES": str(observabilityConfigs["EventLogMaxBytes"]),
+        # resized copies Magento writes to the shared media storage
+        # derive from catalog images that are moderated already.
+        # Uploads land in media/tmp/ first and are moved (a copy and
+        # a delete on s3fs) to their final key, which is moderated.
+        # Captchas are generated images that expire quickly
+        "SKIP_PREFIXES": ",".join(
+          ["media/catalog/product/cache/", "media/tmp/", "media/captcha/"]
+          + ([f"{imageVariantsConfigs['Prefix']}/"] if imageVariantsConfigs["Enabled"] else [])
+        ),
       }
     )
     
@@ -70,6 +199,40 @@ class FunctionsStack(cdk.Stack):
       policy=rekognitionPolicy
     )
 
+    if moderationCacheTable is not None:
+      moderationCacheTable.grant_read_write_data(contentModeratorFn)
+    if rateLimitTable is not None:
+      rateLimitTable.grant_read_write_data(contentModeratorFn)
+
+    # keep initialized execution environments ready on an alias and
+    # scale them on utilization and on a schedule. Events are sent
+    # to the alias, the unqualified function has no provisioned
+    # concurrency
+    contentModeratorTarget = contentModeratorFn
+    if provisionedConcurrencyConfigs["Enabled"]:
+      contentModeratorAlias = _lambda.Alias(
+        self,
+        "contentModeratorLiveAlias",
+        alias_name="live",
+        version=contentModeratorFn.current_version,
+        provisioned_concurrent_executions=provisionedConcurrencyConfigs["MinCapacity"],
+      )
+      provisionedConcurrencyScaling = contentModeratorAlias.add_auto_scaling(
+        min_capacity=provisionedConcurrencyConfigs["MinCapacity"],
+        max_capacity=provisionedConcurrencyConfigs["MaxCapacity"],
+      )
+      provisionedConcurrencyScaling.scale_on_utilization(
+        utilization_target=provisionedConcurrencyConfigs["TargetUtilization"],
+      )
+      for schedule in provisionedConcurrencyConfigs["Schedules"]:
+        provisionedConcurrencyScaling.scale_on_schedule(
+          schedule["Name"],
+          schedule=_appscaling.Schedule.expression(schedule["Cron"]),
+          min_capacity=schedule.get("MinCapacity"),
+          max_capacity=schedule.get("MaxCapacity"),
+        )
+      contentModeratorTarget = contentModeratorAlias
+
     # create lambda function log group
     _logs.LogGroup(
       self,
@@ -79,15 +242,25 @@ class FunctionsStack(cdk.Stack):
       retention=_logs.RetentionDays.ONE_WEEK
     )
     
-    # create the s3 bucket
+    # create the s3 bucket. It holds Magento's whole pub/media,
+    # including customer uploads and downloadable product files, so
+    # it is private and CloudFront reads it through an origin access
+    # identity. The identity lives in this stack so that the bucket
+    # policy doesn't reference the distribution's stack
     webShopContentBucket = _s3.Bucket(
       self,
       "webShopContentBucket",
       versioned=True,
       encryption=_s3.BucketEncryption.S3_MANAGED,
-      public_read_access=True,
+      block_public_access=_s3.BlockPublicAccess.BLOCK_ALL,
       removal_policy=removalPolicy,
     )
+
+    webShopContentOai = _cloudfront.OriginAccessIdentity(
+      self,
+      "webShopContentOai",
+      comment="Magento media and image variants",
+    )
     
     webShopContentBucket.grant_read(
       contentModeratorFn.role,
@@ -110,19 +283,189 @@ class FunctionsStack(cdk.Stack):
       )
     )
 
-    # create S3 bucket notification
-    s3NotificationHandler = _s3_notifications.LambdaDestination(
-      contentModeratorFn
-    )
+    # create S3 bucket notification. With the queue enabled, S3
+    # events are buffered on SQS and consumed in batches at a
+    # bounded concurrency instead of one invocation per upload
+    moderationQueue = None
+    if queueConfigs["Enabled"]:
+      moderationDlq = _sqs.Queue(
+        self,
+        "contentModerationDlq",
+        retention_period=cdk.Duration.days(14),
+      )
+      moderationQueue = _sqs.Queue(
+        self,
+        "contentModerationQueue",
+        # AWS recommends six times the function timeout
+        visibility_timeout=cdk.Duration.seconds(6 * contentModeratorConfigs["TimeoutSeconds"]),
+        retention_period=cdk.Duration.days(4),
+        dead_letter_queue=_sqs.DeadLetterQueue(
+          max_receive_count=queueConfigs["MaxReceiveCount"],
+          queue=moderationDlq,
+        ),
+      )
+
+      s3NotificationHandler = _s3_notifications.SqsDestination(
+        moderationQueue
+      )
+
+      moderationQueue.grant_consume_messages(contentModeratorFn)
+      moderationEventSourceMapping = contentModeratorTarget.add_event_source_mapping(
+        "contentModerationQueueSource",
+        event_source_arn=moderationQueue.queue_arn,
+        batch_size=queueConfigs["BatchSize"],
+        max_batching_window=cdk.Duration.seconds(queueConfigs["MaxBatchingWindowSeconds"]),
+        report_batch_item_failures=True,
+      )
+      # the maximum concurrency of SQS event sources is not
+      # exposed by this CDK version yet
+      moderationEventSourceMapping.node.default_child.add_property_override(
+        "ScalingConfig",
+        {
+          "MaximumConcurrency": queueConfigs["MaxConcurrency"],
+        }
+      )
+    else:
+      s3NotificationHandler = _s3_notifications.LambdaDestination(
+        contentModeratorTarget
+      )
 
     webShopContentBucket.add_event_notification(
       _s3.EventType.OBJECT_CREATED, s3NotificationHandler
     )
 
+    # create the image variants function. S3 does not deliver the
+    # same event type to two destinations with overlapping filters,
+    # so it is triggered by the moderation tag the content moderator
+    # puts on each object, which also ensures images are moderated
+    # before any variant is published
+    imageVariantsFn = None
+    if imageVariantsConfigs["Enabled"]:
+      imageVariantsFn = _lambda.Function(
+        self,
+        "imageVariantsFn",
+        function_name="imageVariantsFn",
+        description="This function is called by S3 tagging events and generates responsive variants of moderated images",
+        runtime=contentModeratorRuntime,
+        architecture=contentModeratorArchitecture,
+        handler="image_variants.lambda_handler",
+        code=getContentModeratorCode(
+          contentModeratorRuntime,
+          contentModeratorArchitecture,
+          contentModeratorConfigs["BundleDependencies"],
+        ),
+        vpc=vpc,
+        memory_size=imageVariantsConfigs["MemorySize"],
+        timeout=cdk.Duration.seconds(imageVariantsConfigs["TimeoutSeconds"]),
+        environment={
+          "LOG_LEVEL": "INFO",
+          "VARIANTS_PREFIX": imageVariantsConfigs["Prefix"],
+          "VARIANT_WIDTHS": ",".join(str(width) for width in imageVariantsConfigs["Widths"]),
+          "VARIANT_FORMATS": ",".join(imageVariantsConfigs["Formats"]),
+          "VARIANT_QUALITY": str(imageVariantsConfigs["Quality"]),
+        }
+      )
+
+      _logs.LogGroup(
+        self,
+        "imageVariantsFnLogGroup",
+        log_group_name=f"/aws/lambda/{imageVariantsFn.function_name}",
+        removal_policy=cdk.RemovalPolicy.DESTROY,
+        retention=_logs.RetentionDays.ONE_WEEK
+      )
+
+      webShopContentBucket.grant_read_write(imageVariantsFn)
+      webShopContentBucket.grant_delete(imageVariantsFn)
+
+      webShopContentBucket.add_event_notification(
+        _s3.EventType.OBJECT_TAGGING_PUT,
+        _s3_notifications.LambdaDestination(imageVariantsFn),
+      )
+
+    # create a dashboard of the moderation stage metrics and p99
+    # latency alarms
+    functionName = contentModeratorFn.function_name
+    # with the S3Object image source Rekognition reads the images
+    # itself, so the function publishes no S3 read metrics
+    readsObjects = contentModeratorConfigs["ImageSource"] != "S3Object"
+    objectReadMetricNames = ["S3ReadDuration"] if readsObjects else []
+    stageLatencyMetricNames = [*objectReadMetricNames, "RekognitionLatency", "TaggingLatency"]
+    contentModeratorDashboard = _cloudwatch.Dashboard(
+      self,
+      "contentModeratorDashboard",
+      dashboard_name=f"{buildConfigs['App']}-{environment}-content-moderator",
+    )
+    contentModeratorDashboard.add_widgets(
+      *[
+        _cloudwatch.GraphWidget(
+          title=f"{metricName} (ms)",
+          left=[
+            getContentModeratorMetric(functionName, metricName, statistic)
+            for statistic in ["p50", "p90", "p99"]
+          ],
+        ) for metricName in stageLatencyMetricNames
+      ]
+    )
+    bytesReadWidgets = []
+    if readsObjects:
+      bytesReadWidgets.append(
+        _cloudwatch.GraphWidget(
+          title="Bytes read",
+          left=[getContentModeratorMetric(functionName, "BytesRead", "Sum")],
+        )
+      )
+    contentModeratorDashboard.add_widgets(
+      _cloudwatch.GraphWidget(
+        title="Function duration (ms)",
+        left=[
+          contentModeratorFn.metric_duration(statistic=statistic, period=cdk.Duration.minutes(1))
+          for statistic in ["p50", "p90", "p99"]
+        ],
+      ),
+      *bytesReadWidgets,
+      _cloudwatch.GraphWidget(
+        title="Labels, cache and cold starts",
+        left=[
+          getContentModeratorMetric(functionName, "LabelCount", "Sum"),
+          getContentModeratorMetric(functionName, "CacheHits", "Sum"),
+          getContentModeratorMetric(functionName, "CacheMisses", "Sum"),
+          getContentModeratorMetric(functionName, "ColdStart", "Sum"),
+        ],
+      ),
+    )
+
+    latencyAlarmConfigs = observabilityConfigs["P99AlarmThresholdsMs"]
+    for metricName in stageLatencyMetricNames:
+      _cloudwatch.Alarm(
+        self,
+        f"contentModerator{metricName}P99Alarm",
+        alarm_description=f"p99 {metricName} of the content moderator function is above {latencyAlarmConfigs[metricName]}ms",
+        metric=getContentModeratorMetric(functionName, metricName, "p99"),
+        threshold=latencyAlarmConfigs[metricName],
+        evaluation_periods=5,
+        datapoints_to_alarm=3,
+        comparison_operator=_cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+        treat_missing_data=_cloudwatch.TreatMissingData.NOT_BREACHING,
+      )
+    _cloudwatch.Alarm(
+      self,
+      "contentModeratorDurationP99Alarm",
+      alarm_description=f"p99 duration of the content moderator function is above {latencyAlarmConfigs['Duration']}ms",
+      metric=contentModeratorFn.metric_duration(statistic="p99", period=cdk.Duration.minutes(1)),
+      threshold=latencyAlarmConfigs["Duration"],
+      evaluation_periods=5,
+      datapoints_to_alarm=3,
+      comparison_operator=_cloudwatch.ComparisonOperator.GREATER_THAN_THRESHOLD,
+      treat_missing_data=_cloudwatch.TreatMissingData.NOT_BREACHING,
+    )
+
     # assigning our resource to be able to reference it
     # across stacks
     self._contentModeratorFn = contentModeratorFn
     self._webShopContentBucket = webShopContentBucket
+    self._webShopContentOai = webShopContentOai
+    self._moderationQueue = moderationQueue
+    self._imageVariantsFn = imageVariantsFn
     
     # output resource
     cdk.CfnOutput(
@@ -131,6 +474,13 @@ class FunctionsStack(cdk.Stack):
       value=webShopContentBucket.bucket_name,
       export_name="webShopContentBucketName"
     )
+    if moderationQueue is not None:
+      cdk.CfnOutput(
+        self,
+        "contentModerationQueueNameOutput",
+        value=moderationQueue.queue_name,
+        export_name="contentModerationQueueName"
+      )
 
   @property
   def getContentModeratorFn(self) -> _lambda.IFunction:
@@ -138,3 +488,21 @@ class FunctionsStack(cdk.Stack):
   @property
   def getWebShopContentBucket(self) -> _s3.IBucket:
     return self._webShopContentBucket
+  @property
+  def getWebShopContentOriginAccessIdentity(self) -> _cloudfront.IOriginAccessIdentity:
+    return self._webShopContentOai
+  @property
+  def getImageVariantsFn(self) -> _lambda.IFunction:
+    return self._imageVariantsFn
+  @property
+  def getModerationQueue(self) -> _sqs.IQueue:
+    return self._moderationQueue
+  @property
+  def getModerationQueueDepthMetric(self) -> _cloudwatch.IMetric:
+    # None when S3 events are delivered to the function directly
+    if self._moderationQueue is None:
+      return None
+    return self._moderationQueue.metric_approximate_number_of_messages_visible(
+      period=cdk.Duration.minutes(1),
+      statistic="Maximum",
+    )
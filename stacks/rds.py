@@ -1,11 +1,50 @@
 import json
+from typing import Union
 from aws_cdk import core as cdk
 from aws_cdk import aws_ec2 as _ec2
 from aws_cdk import aws_rds as _rds
 from aws_cdk import aws_secretsmanager as _sm
 
+MIB = 1024 * 1024
+
+def getMySqlParameters(profile) -> dict:
+  # memory bound values are RDS formulas, so they follow the
+  # memory of whatever instance class the DB runs on
+  bufferPoolPercent = profile["BufferPoolMemoryPercent"]
+  connectionMemory = profile["ConnectionMemoryMiB"] * MIB
+  tmpTableSize = profile["TmpTableSizeMiB"] * MIB
+
+  return {
+    "innodb_buffer_pool_size": f"{{DBInstanceClassMemory*{bufferPoolPercent}/100}}",
+    "max_connections": f"{{DBInstanceClassMemory/{connectionMemory}}}",
+    "innodb_log_file_size": str(profile["LogFileSizeMiB"] * MIB),
+    "innodb_flush_log_at_trx_commit": str(profile["FlushLogAtTrxCommit"]),
+    "tmp_table_size": str(tmpTableSize),
+    "max_heap_table_size": str(tmpTableSize),
+    "slow_query_log": "1",
+    "long_query_time": str(profile["LongQueryTimeSeconds"]),
+    "log_output": "FILE",
+  }
+
+def getAuroraMySqlParameters(profile) -> dict:
+  # Aurora manages the buffer pool, redo log and flushing on its
+  # own, so only the session and logging settings are tuned
+  auroraParameterNames = [
+    "max_connections",
+    "tmp_table_size",
+    "max_heap_table_size",
+    "slow_query_log",
+    "long_query_time",
+    "log_output",
+  ]
+  mysqlParameters = getMySqlParameters(profile)
+
+  return {
+    name: mysqlParameters[name] for name in auroraParameterNames
+  }
+
 class RDSStack(cdk.Stack):
-  def __init__(self, scope: cdk.Construct, construct_id: str, vpc: _ec2.IVpc, sg:_ec2.ISecurityGroup, buildConfigs,  **kwargs) -> None:
+  def __init__(self, scope: cdk.Construct, construct_id: str, vpc: _ec2.IVpc, sg:_ec2.ISecurityGroup, proxySg: _ec2.ISecurityGroup, buildConfigs,  **kwargs) -> None:
     super().__init__(scope, construct_id, **kwargs)
 
     # extracting build configs
@@ -18,7 +57,11 @@ class RDSStack(cdk.Stack):
     removalPolicy = cdk.RemovalPolicy.RETAIN if isProd else cdk.RemovalPolicy.DESTROY
     instanceSize = _ec2.InstanceSize.LARGE if isProd else _ec2.InstanceSize.SMALL
     storageSize = 100 if isProd else 20
-    
+    rdsConfigs = buildConfigs["Parameters"]["RDS"]
+    # either "mysql" for an RDS MySQL instance or "aurora-mysql"
+    # for an Aurora MySQL cluster
+    isAurora = rdsConfigs["Engine"] == "aurora-mysql"
+
     # creating mysql credentials using Secrets Manager
     mysqlSecret = _sm.Secret(
       self,
@@ -34,53 +77,172 @@ class RDSStack(cdk.Stack):
       ),
     )
 
-    #create MySQL RDS
-    rds_db = _rds.DatabaseInstance(
-      self, 
-      "MySQL_DB",
-      engine=_rds.DatabaseInstanceEngine.mysql(
+    if isAurora:
+      auroraConfigs = rdsConfigs["Aurora"]
+      isServerless = auroraConfigs["Serverless"]
+      # engine versions look like 5.7.mysql_aurora.2.11.2. Magento
+      # 2.3 supports MySQL 5.7, which is Aurora MySQL 2, while
+      # Serverless v2 is only available on Aurora MySQL 3 (MySQL 8.0)
+      auroraVersion = auroraConfigs["EngineVersion"]
+      if isServerless and not auroraVersion.startswith("8.0."):
+        raise Exception(
+          "Aurora Serverless requires an Aurora MySQL 3 (8.0) EngineVersion"
+        )
+      auroraEngine = _rds.DatabaseClusterEngine.aurora_mysql(
+        version=_rds.AuroraMysqlEngineVersion.of(
+          auroraVersion, auroraVersion.split(".mysql_aurora")[0]
+        ),
+      )
+
+      # creating an instance parameter group for Magento. Aurora
+      # manages the InnoDB buffer pool, redo log and flushing itself
+      auroraParameterGroup = _rds.ParameterGroup(
+        self,
+        "auroraParameterGroup",
+        engine=auroraEngine,
+        description=f"Magento tuned Aurora MySQL parameters for the {environment} environment",
+        parameters=getAuroraMySqlParameters(rdsConfigs["ParameterProfile"]),
+      )
+
+      # Serverless v2 instances use the db.serverless instance class
+      # and scale between the configured Aurora capacity units
+      auroraInstanceType = _ec2.InstanceType(
+        "serverless" if isServerless else auroraConfigs["InstanceType"]
+      )
+
+      #create Aurora MySQL cluster. Like Multi-AZ on RDS for MySQL,
+      # production gets a reader instance in a second AZ as failover
+      # target
+      rds_db = _rds.DatabaseCluster(
+        self,
+        "AuroraMySQL_Cluster",
+        engine=auroraEngine,
+        instances=2 if isProd else 1,
+        instance_props=_rds.InstanceProps(
+          instance_type=auroraInstanceType,
+          vpc=vpc,
+          vpc_subnets=_ec2.SubnetSelection(
+            subnet_type=_ec2.SubnetType.ISOLATED,
+          ),
+          security_groups=[sg],
+          parameter_group=auroraParameterGroup,
+        ),
+        default_database_name="webshop",
+        credentials=_rds.Credentials.from_secret(
+          secret=mysqlSecret,
+        ),
+        cloudwatch_logs_exports=[
+          "audit", "error", "general", "slowquery"
+        ],
+        storage_encrypted=True,
+        removal_policy=removalPolicy,
+        deletion_protection=isProd,
+        backup=_rds.BackupProps(
+          retention=cdk.Duration.days(7),
+        ),
+      )
+
+      if isServerless:
+        auroraCfnCluster = rds_db.node.default_child
+        auroraCfnCluster.add_property_override(
+          "ServerlessV2ScalingConfiguration",
+          {
+            "MinCapacity": auroraConfigs["MinCapacity"],
+            "MaxCapacity": auroraConfigs["MaxCapacity"],
+          }
+        )
+
+      rdsEndpointAddress = rds_db.cluster_endpoint.hostname
+    else:
+      mysqlEngine = _rds.DatabaseInstanceEngine.mysql(
         version=_rds.MysqlEngineVersion.VER_5_7_30,
-      ),
-      instance_type=_ec2.InstanceType.of(
-        _ec2.InstanceClass.BURSTABLE2, instanceSize
-      ),
-      vpc=vpc,
-      vpc_subnets=_ec2.SubnetSelection(
-        subnet_type=_ec2.SubnetType.ISOLATED,
-      ),
-      database_name="webshop",
-      multi_az=isProd,
-      security_groups=[sg],
-      allocated_storage=storageSize,
-      storage_type=_rds.StorageType.GP2,
-      credentials=_rds.Credentials.from_secret(
-        secret=mysqlSecret,
-      ),
-      cloudwatch_logs_exports=[
-        "audit", "error", "general", "slowquery"
-      ],
-      removal_policy=removalPolicy,
-      deletion_protection=isProd,
-      delete_automated_backups=isProd,
-      backup_retention=cdk.Duration.days(7),
-      parameter_group=_rds.ParameterGroup.from_parameter_group_name(
-        self, "para-group-mysql",
-        parameter_group_name="default.mysql5.7"
       )
-    )
-    
+
+      # creating a parameter group tuned for Magento from the
+      # environment's parameter profile
+      mysqlParameterGroup = _rds.ParameterGroup(
+        self,
+        "mysqlParameterGroup",
+        engine=mysqlEngine,
+        description=f"Magento tuned MySQL parameters for the {environment} environment",
+        parameters=getMySqlParameters(rdsConfigs["ParameterProfile"]),
+      )
+
+      #create MySQL RDS
+      rds_db = _rds.DatabaseInstance(
+        self, 
+        "MySQL_DB",
+        engine=mysqlEngine,
+        instance_type=_ec2.InstanceType.of(
+          _ec2.InstanceClass.BURSTABLE2, instanceSize
+        ),
+        vpc=vpc,
+        vpc_subnets=_ec2.SubnetSelection(
+          subnet_type=_ec2.SubnetType.ISOLATED,
+        ),
+        database_name="webshop",
+        multi_az=isProd,
+        security_groups=[sg],
+        allocated_storage=storageSize,
+        storage_type=_rds.StorageType.GP2,
+        credentials=_rds.Credentials.from_secret(
+          secret=mysqlSecret,
+        ),
+        cloudwatch_logs_exports=[
+          "audit", "error", "general", "slowquery"
+        ],
+        removal_policy=removalPolicy,
+        deletion_protection=isProd,
+        delete_automated_backups=isProd,
+        backup_retention=cdk.Duration.days(7),
+        parameter_group=mysqlParameterGroup,
+      )
+
+      rdsEndpointAddress = rds_db.db_instance_endpoint_address
+
+    # creating an RDS proxy to pool the connections opened by the
+    # PHP workers of all web servers
+    rdsProxy = None
+    if rdsConfigs["Proxy"]:
+      rdsProxy = rds_db.add_proxy(
+        "mysqlProxy",
+        secrets=[mysqlSecret],
+        vpc=vpc,
+        vpc_subnets=_ec2.SubnetSelection(
+          subnet_type=_ec2.SubnetType.ISOLATED,
+        ),
+        security_groups=[proxySg],
+        require_tls=False,
+        max_connections_percent=90,
+        idle_client_timeout=cdk.Duration.minutes(30),
+        # Magento sets the connection charset on every new
+        # connection, which would otherwise pin each session
+        session_pinning_filters=[
+          _rds.SessionPinningFilter.EXCLUDE_VARIABLE_SETS,
+        ],
+      )
+
     # assigning our resource to be able to reference it
     # across stacks
     self._rds_db = rds_db
     self._mysqlSecret = mysqlSecret
+    self._rdsEndpointAddress = rdsEndpointAddress
+    self._rdsProxy = rdsProxy
 
     # output RDS resource
     cdk.CfnOutput(
       self,
       "rdsOutput",
-      value=rds_db.db_instance_endpoint_address,
+      value=rdsEndpointAddress,
       export_name="rdsEndpointAddress"
     )
+    if rdsProxy is not None:
+      cdk.CfnOutput(
+        self,
+        "rdsProxyOutput",
+        value=rdsProxy.endpoint,
+        export_name="rdsProxyEndpointAddress"
+      )
 
     # output resource
     cdk.CfnOutput(
@@ -103,8 +265,15 @@ class RDSStack(cdk.Stack):
     )
 
   @property
-  def getRds(self) -> _rds.IDatabaseInstance:
+  def getRds(self) -> Union[_rds.IDatabaseInstance, _rds.IDatabaseCluster]:
     return self._rds_db
   @property
+  def getRdsEndpointAddress(self) -> str:
+    return self._rdsEndpointAddress
+  @property
   def getMySqlSecret(self) -> _sm.ISecret:
     return self._mysqlSecret
+  @property
+  def getProxyAddress(self) -> str:
+    # empty when no RDS proxy is provisioned
+    return self._rdsProxy.endpoint if self._rdsProxy is not None else ""
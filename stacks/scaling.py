@@ -0,0 +1,166 @@
+from datetime import datetime
+from aws_cdk import core as cdk
+from aws_cdk import aws_autoscaling as _asg
+from aws_cdk import aws_cloudwatch as _cloudwatch
+from aws_cdk import aws_elasticloadbalancingv2 as _elbv2
+
+# custom metric published by every web server with the "listen
+# queue" of its PHP-FPM status page, the requests waiting for a child
+QUEUE_DEPTH_NAMESPACE = "Magento/WebServers"
+QUEUE_DEPTH_METRIC_NAME = "ListenQueueDepth"
+
+def getRequestsPerMinuteTarget(scalingConfigs, utilizationPercent: int) -> int:
+  # a node is scaled to run at a fraction of the requests per second
+  # it serves at saturation. The shipped values are placeholders to
+  # be replaced by a load test of the actual shop
+  requestsPerSecond = scalingConfigs["PlaceholderRequestsPerSecondPerNode"]
+  utilization = utilizationPercent / 100
+
+  return max(1, int(requestsPerSecond * 60 * utilization))
+
+class WebServerScaling(cdk.Construct):
+  def __init__(
+    self,
+    scope: cdk.Construct,
+    construct_id: str,
+    asg: _asg.AutoScalingGroup,
+    targetGroup: _elbv2.ApplicationTargetGroup,
+    scalingConfigs,
+  ) -> None:
+    super().__init__(scope, construct_id)
+
+    responseTimeConfigs = scalingConfigs["ResponseTime"]
+    queueDepthConfigs = scalingConfigs["QueueDepth"]
+    predictiveConfigs = scalingConfigs["Predictive"]
+    scaleInConfigs = scalingConfigs["ScaleIn"]
+    requestsPerMinuteTarget = getRequestsPerMinuteTarget(scalingConfigs, scalingConfigs["TargetUtilizationPercent"])
+    scaleInRequestsPerMinute = getRequestsPerMinuteTarget(scalingConfigs, scaleInConfigs["UtilizationPercent"])
+
+    # track the request count per node derived from the per node
+    # capacity. Slow responses keep the request count per node low,
+    # so this policy only scales out. Scaling in from it would undo
+    # what the response time and queue depth policies scale out
+    asg.scale_on_request_count(
+      "requests-per-minute",
+      target_requests_per_minute=requestsPerMinuteTarget,
+      disable_scale_in=True,
+    )
+
+    # the only scale in policy. It removes a node once the request
+    # count per node stays well below the tracking target, the gap
+    # between both keeps the group from flapping. When a scale out
+    # policy is in alarm at the same time, Auto Scaling applies the
+    # policy resulting in the larger capacity
+    asg.scale_on_metric(
+      "requests-per-minute-scale-in",
+      metric=targetGroup.metric_request_count_per_target(
+        statistic="Sum",
+        period=cdk.Duration.minutes(1),
+      ),
+      scaling_steps=[
+        _asg.ScalingInterval(upper=scaleInRequestsPerMinute, change=-1),
+        _asg.ScalingInterval(lower=scaleInRequestsPerMinute, change=0),
+      ],
+      adjustment_type=_asg.AdjustmentType.CHANGE_IN_CAPACITY,
+      evaluation_periods=scaleInConfigs["EvaluationPeriods"],
+      cooldown=cdk.Duration.minutes(5),
+    )
+
+    # step scaling on the p95 target response time. Only scales out,
+    # the scale in policy brings the capacity back down
+    responseTimeTarget = responseTimeConfigs["P95TargetSeconds"]
+    responseTimeMetric = targetGroup.metric_target_response_time(
+      statistic="p95",
+      period=cdk.Duration.minutes(1),
+    )
+    asg.scale_on_metric(
+      "p95-response-time-scaling",
+      metric=responseTimeMetric,
+      scaling_steps=[
+        _asg.ScalingInterval(upper=responseTimeTarget, change=0),
+        _asg.ScalingInterval(lower=responseTimeTarget, change=+1),
+        _asg.ScalingInterval(lower=responseTimeTarget * 2, change=+2),
+        _asg.ScalingInterval(lower=responseTimeTarget * 4, change=+4),
+      ],
+      adjustment_type=_asg.AdjustmentType.CHANGE_IN_CAPACITY,
+      metric_aggregation_type=_asg.MetricAggregationType.MAXIMUM,
+      evaluation_periods=responseTimeConfigs["EvaluationPeriods"],
+      cooldown=cdk.Duration.minutes(3),
+    )
+
+    # step scaling on the FPM listen queue reported by the web
+    # servers, which grows before response times do once all
+    # children are busy
+    queueDepthMetric = None
+    if queueDepthConfigs["Enabled"]:
+      queueDepthThreshold = queueDepthConfigs["ScaleOutThreshold"]
+      queueDepthMetric = _cloudwatch.Metric(
+        namespace=QUEUE_DEPTH_NAMESPACE,
+        metric_name=QUEUE_DEPTH_METRIC_NAME,
+        dimensions_map={
+          "AutoScalingGroupName": asg.auto_scaling_group_name,
+        },
+        statistic="Average",
+        period=cdk.Duration.minutes(1),
+      )
+      asg.scale_on_metric(
+        "queue-depth-scaling",
+        metric=queueDepthMetric,
+        scaling_steps=[
+          _asg.ScalingInterval(upper=queueDepthThreshold, change=0),
+          _asg.ScalingInterval(lower=queueDepthThreshold, change=+1),
+          _asg.ScalingInterval(lower=queueDepthThreshold * 4, change=+2),
+        ],
+        adjustment_type=_asg.AdjustmentType.CHANGE_IN_CAPACITY,
+        evaluation_periods=queueDepthConfigs["EvaluationPeriods"],
+        cooldown=cdk.Duration.minutes(3),
+      )
+
+    # predictive scaling learns the daily and weekly traffic pattern
+    # from the request count and launches capacity ahead of it
+    if predictiveConfigs["Enabled"]:
+      _asg.CfnScalingPolicy(
+        self,
+        "predictiveScalingPolicy",
+        auto_scaling_group_name=asg.auto_scaling_group_name,
+        policy_type="PredictiveScaling",
+        predictive_scaling_configuration=_asg.CfnScalingPolicy.PredictiveScalingConfigurationProperty(
+          mode=predictiveConfigs["Mode"],
+          scheduling_buffer_time=predictiveConfigs["SchedulingBufferSeconds"],
+          metric_specifications=[
+            _asg.CfnScalingPolicy.PredictiveScalingMetricSpecificationProperty(
+              target_value=requestsPerMinuteTarget,
+              predefined_metric_pair_specification=_asg.CfnScalingPolicy.PredictiveScalingPredefinedMetricPairProperty(
+                predefined_metric_type="ALBRequestCount",
+                resource_label=f"{targetGroup.first_load_balancer_full_name}/{targetGroup.target_group_full_name}",
+              ),
+            ),
+          ],
+        ),
+      )
+
+    # scheduled capacity changes for known sale windows
+    for schedule in scalingConfigs["Schedules"]:
+      asg.scale_on_schedule(
+        schedule["Name"],
+        schedule=_asg.Schedule.expression(schedule["Cron"]),
+        min_capacity=schedule.get("MinCapacity"),
+        max_capacity=schedule.get("MaxCapacity"),
+        desired_capacity=schedule.get("DesiredCapacity"),
+        start_time=datetime.fromisoformat(schedule["StartTime"]) if schedule.get("StartTime") else None,
+        end_time=datetime.fromisoformat(schedule["EndTime"]) if schedule.get("EndTime") else None,
+      )
+
+    self._requestsPerMinuteTarget = requestsPerMinuteTarget
+    self._responseTimeMetric = responseTimeMetric
+    self._queueDepthMetric = queueDepthMetric
+
+  @property
+  def getRequestsPerMinuteTarget(self) -> int:
+    return self._requestsPerMinuteTarget
+  @property
+  def getResponseTimeMetric(self) -> _cloudwatch.IMetric:
+    return self._responseTimeMetric
+  @property
+  def getQueueDepthMetric(self) -> _cloudwatch.IMetric:
+    return self._queueDepthMetric
@@ -14,6 +14,15 @@ class SecurityGroupsStack(cdk.Stack):
       description="Security group for RDS"
     )
     
+    # Creating the SG for our RDS proxy
+    _rds_proxy_sg = _ec2.SecurityGroup(
+      self,
+      "rdsProxySG",
+      allow_all_outbound=True,
+      vpc=vpc,
+      description="Security group for RDS Proxy"
+    )
+
     # Creating the SG for our Bastion EC2 instances
     _bastion_ec2_sg = _ec2.SecurityGroup(
       self,
@@ -32,6 +41,15 @@ class SecurityGroupsStack(cdk.Stack):
       description="Security group for web server EC2 instances"
     )
 
+    # Creating the SG for our ElastiCache Redis nodes
+    _cache_sg = _ec2.SecurityGroup(
+      self,
+      "cacheSG",
+      allow_all_outbound=True,
+      vpc=vpc,
+      description="Security group for ElastiCache Redis"
+    )
+
     # Creating the SG for our internet-facing 
     # application load balancer
     _webserver_alb_sg = _ec2.SecurityGroup(
@@ -56,7 +74,37 @@ class SecurityGroupsStack(cdk.Stack):
       connection=_ec2.Port.tcp(3306),
       description="allow MySQL client access from web server EC2 SG"
     )
-    
+    # allow MySQL client access to port 3306 from RDS proxy SG
+    _rds_sg.add_ingress_rule(
+      peer=_rds_proxy_sg,
+      connection=_ec2.Port.tcp(3306),
+      description="allow MySQL client access from RDS proxy SG"
+    )
+
+    # adding ingress/egress rules for our RDS proxy SG
+
+    # allow MySQL client access to port 3306 from webservers SG
+    _rds_proxy_sg.add_ingress_rule(
+      peer=_webserver_ec2_sg,
+      connection=_ec2.Port.tcp(3306),
+      description="allow MySQL client access from web server EC2 SG"
+    )
+
+    # adding ingress/egress rules for our cache SG
+
+    # allow Redis client access to port 6379 from bastion EC2 SG
+    _cache_sg.add_ingress_rule(
+      peer=_bastion_ec2_sg,
+      connection=_ec2.Port.tcp(6379),
+      description="allow Redis client access from bastion EC2 SG"
+    )
+    # allow Redis client access to port 6379 from webservers SG
+    _cache_sg.add_ingress_rule(
+      peer=_webserver_ec2_sg,
+      connection=_ec2.Port.tcp(6379),
+      description="allow Redis client access from web server EC2 SG"
+    )
+
     # adding ingress/egress rules for our web server instances SG
 
     # allow SSH client access to port 22 from bastion EC2 SG
@@ -91,8 +139,10 @@ class SecurityGroupsStack(cdk.Stack):
     # across stacks
     self._bastion_ec2_sg = _bastion_ec2_sg
     self._rds_sg = _rds_sg
+    self._rds_proxy_sg = _rds_proxy_sg
     self._webserver_ec2_sg = _webserver_ec2_sg
     self._webserver_alb_sg = _webserver_alb_sg
+    self._cache_sg = _cache_sg
 
     # output SG resources
     cdk.CfnOutput(
@@ -101,6 +151,12 @@ class SecurityGroupsStack(cdk.Stack):
       value=_rds_sg.security_group_id,
       export_name="rdsSGId"
     )
+    cdk.CfnOutput(
+      self,
+      "rdsProxySGOutput",
+      value=_rds_proxy_sg.security_group_id,
+      export_name="rdsProxySGId"
+    )
     cdk.CfnOutput(
       self,
       "bastionEc2SGOutput",
@@ -119,11 +175,20 @@ class SecurityGroupsStack(cdk.Stack):
       value=_webserver_alb_sg.security_group_id,
       export_name="webserverAlbSGId"
     )
+    cdk.CfnOutput(
+      self,
+      "cacheSGOutput",
+      value=_cache_sg.security_group_id,
+      export_name="cacheSGId"
+    )
 
   @property
   def getRdsSg(self) -> _ec2.ISecurityGroup:
     return self._rds_sg
   @property
+  def getRdsProxySg(self) -> _ec2.ISecurityGroup:
+    return self._rds_proxy_sg
+  @property
   def getBastionEc2Sg(self) -> _ec2.ISecurityGroup:
     return self._bastion_ec2_sg
   @property
@@ -132,3 +197,6 @@ class SecurityGroupsStack(cdk.Stack):
   @property
   def getWebserverAlbSg(self) -> _ec2.ISecurityGroup:
     return self._webserver_alb_sg
+  @property
+  def getCacheSg(self) -> _ec2.ISecurityGroup:
+    return self._cache_sg
@@ -1,5 +1,8 @@
 import os.path
+import json
+import fnmatch
 from aws_cdk import core as cdk
+from aws_cdk import aws_s3 as _s3
 from aws_cdk import aws_ec2 as _ec2
 from aws_cdk import aws_iam as _iam
 from aws_cdk import aws_secretsmanager as _sm
@@ -7,17 +10,68 @@ from aws_cdk import aws_autoscaling as _asg
 from aws_cdk import aws_cloudfront as _cloudfront
 from aws_cdk import aws_cloudfront_origins as _cf_origins
 from aws_cdk import aws_elasticloadbalancingv2 as _elbv2
+from .scaling import WebServerScaling, QUEUE_DEPTH_NAMESPACE, QUEUE_DEPTH_METRIC_NAME
 
 currentDirName = os.path.dirname(__file__)
 
+# Magento's static and media base URLs. They point at these
+# CloudFront paths on every web server, so they have to match the
+# cache behaviors below
+STATIC_URL_PATH = "static"
+MEDIA_URL_PATH = "media"
+# pub/media directories Magento denies web access to
+PRIVATE_MEDIA_DIRS = ["customer", "downloadable", "import"]
+
 # web server EC2 Instance configs
-ec2_type = "t2.micro"
-linux_ami = _ec2.AmazonLinuxImage(
-  generation=_ec2.AmazonLinuxGeneration.AMAZON_LINUX_2,
-  edition=_ec2.AmazonLinuxEdition.STANDARD,
-  virtualization=_ec2.AmazonLinuxVirt.HVM,
-  storage=_ec2.AmazonLinuxStorage.GENERAL_PURPOSE
-)
+def getLinuxAmi(architecture: str) -> _ec2.IMachineImage:
+  # arm64 selects the Graviton build of Amazon Linux 2
+  cpuType = _ec2.AmazonLinuxCpuType.ARM_64 if architecture == "arm64" else _ec2.AmazonLinuxCpuType.X86_64
+
+  return _ec2.AmazonLinuxImage(
+    generation=_ec2.AmazonLinuxGeneration.AMAZON_LINUX_2,
+    edition=_ec2.AmazonLinuxEdition.STANDARD,
+    virtualization=_ec2.AmazonLinuxVirt.HVM,
+    storage=_ec2.AmazonLinuxStorage.GENERAL_PURPOSE,
+    cpu_type=cpuType,
+  )
+
+def getMemoryMb(phpSize: str) -> int:
+  # PHP shorthand sizes such as "768M" or "2G"
+  units = {"K": 1 / 1024, "M": 1, "G": 1024}
+  return int(int(phpSize[:-1]) * units[phpSize[-1].upper()])
+
+def getCfBehaviorPathPattern(pathPatterns: list, urlPath: str) -> str:
+  # CloudFront uses the first behavior whose path pattern matches,
+  # "*" matches any characters including "/"
+  for pathPattern in pathPatterns:
+    if fnmatch.fnmatchcase(urlPath, pathPattern):
+      return pathPattern
+  return None
+
+# CloudFront Function picking the image variant format from the
+# Accept header. Requests to "<prefix>/auto/<width>/<key>" are
+# rewritten to the first format the viewer accepts, or to the last
+# configured format, before the cache lookup
+def getVariantFormatFunctionCode(prefix: str, formats: list) -> str:
+  return f"""function handler(event) {{
+  var request = event.request;
+  var autoPath = "/{prefix}/auto/";
+  if (request.uri.indexOf(autoPath) !== 0) {{
+    return request;
+  }}
+  var accept = request.headers.accept ? request.headers.accept.value : "";
+  var formats = {json.dumps(formats[:-1])};
+  var format = {json.dumps(formats[-1])};
+  for (var i = 0; i < formats.length; i++) {{
+    if (accept.indexOf("image/" + formats[i]) !== -1) {{
+      format = formats[i];
+      break;
+    }}
+  }}
+  request.uri = "/{prefix}/" + format + "/" + request.uri.substring(autoPath.length);
+  return request;
+}}
+"""
 
 class WebServersStack(cdk.Stack):
   def __init__(
@@ -29,6 +83,10 @@ class WebServersStack(cdk.Stack):
     webserverAlbSG: _ec2.ISecurityGroup,
     mappings,
     mysqlSecret: _sm.ISecret,
+    contentBucket: _s3.IBucket,
+    contentOriginAccessIdentity: _cloudfront.IOriginAccessIdentity,
+    staticBucket: _s3.IBucket,
+    staticOriginAccessIdentity: _cloudfront.IOriginAccessIdentity,
     buildConfigs,
     **kwargs,
   ) -> None:
@@ -37,8 +95,45 @@ class WebServersStack(cdk.Stack):
     # extracting build configs
     environment = buildConfigs["Environment"]
     isProd = True if environment == "prod" else False
-    asgMinCapacity = 2 if isProd else 1
-    asgMaxCapacity = 4 if isProd else 2
+    cloudFrontConfigs = buildConfigs["Parameters"]["CloudFront"]
+    # an empty origin shield region disables origin shield
+    originShieldRegion = cloudFrontConfigs["OriginShieldRegion"] or None
+    edgeFullPageCache = cloudFrontConfigs["EdgeFullPageCache"]
+    edgeFullPageCacheTtl = cloudFrontConfigs["EdgeFullPageCacheTtl"]
+    imageVariantsConfigs = buildConfigs["Parameters"]["ImageVariants"]
+    # prebuilt releases upload their static content to S3
+    staticFromS3 = bool(buildConfigs["Parameters"]["Artifact"]["Release"])
+    webserverConfigs = buildConfigs["Parameters"]["WebServers"]
+    instanceType = webserverConfigs["InstanceType"]
+    linux_ami = getLinuxAmi(webserverConfigs["Architecture"])
+    spotConfigs = webserverConfigs["Spot"]
+    warmPoolConfigs = webserverConfigs["WarmPool"]
+    readinessConfigs = webserverConfigs["ReadinessCheck"]
+    runtimeProfileConfigs = webserverConfigs["RuntimeProfile"]
+    fpmConfigs = runtimeProfileConfigs["Fpm"]
+    opcacheConfigs = runtimeProfileConfigs["OpCache"]
+    readinessHookName = "webserverLaunchReadiness"
+    scalingConfigs = webserverConfigs["Scaling"]
+    asgMinCapacity = scalingConfigs["MinCapacity"]
+    asgMaxCapacity = scalingConfigs["MaxCapacity"]
+    publishQueueDepth = scalingConfigs["QueueDepth"]["Enabled"]
+
+    # AWS does not support warm pools on groups with a mixed
+    # instances policy
+    if warmPoolConfigs["Enabled"] and spotConfigs["Enabled"]:
+      raise Exception(
+        "WebServers WarmPool and Spot can not be enabled at the same time"
+      )
+    hibernate = warmPoolConfigs["Enabled"] and warmPoolConfigs["PoolState"] == "HIBERNATED"
+
+    # the FPM pool is sized by the average memory of a child, while
+    # the memory limit caps a single request. A request reaching the
+    # limit must still fit in the memory kept aside from the pool
+    fpmMemoryLimitMb = getMemoryMb(runtimeProfileConfigs["PhpMemoryLimit"])
+    if fpmMemoryLimitMb - fpmConfigs["ChildMemoryMb"] > fpmConfigs["ReservedMemoryMb"]:
+      raise Exception(
+        "WebServers PhpMemoryLimit can not exceed Fpm ChildMemoryMb plus ReservedMemoryMb"
+      )
 
     # Instance Role and SSM Managed Policy
     _role = _iam.Role(
@@ -81,21 +176,292 @@ class WebServersStack(cdk.Stack):
       security_group=webserverAlbSG,
     )
     
+    webserverAlbOrigin = _cf_origins.LoadBalancerV2Origin(
+      webserverALB,
+      protocol_policy=_cloudfront.OriginProtocolPolicy.HTTP_ONLY,
+      origin_shield_region=originShieldRegion,
+    )
+
     defaultCfBehavior = _cloudfront.BehaviorOptions(
       viewer_protocol_policy=_cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
-      origin=_cf_origins.LoadBalancerV2Origin(
-        webserverALB,
-        protocol_policy=_cloudfront.OriginProtocolPolicy.HTTP_ONLY,
+      origin=webserverAlbOrigin,
+    )
+    dynamicCfBehaviors = {}
+
+    if edgeFullPageCache:
+      # caching storefront HTML at edge. Magento marks cacheable
+      # pages as public and everything else as private/no-store, so
+      # the origin headers decide what is cached. Pages vary on the
+      # customer context cookie, store and currency only, the same
+      # way Magento's Varnish configuration does
+      edgeFpcCachePolicy = _cloudfront.CachePolicy(
+        self,
+        "edgeFpcCachePolicy",
+        comment="Magento storefront pages by customer context",
+        default_ttl=cdk.Duration.seconds(0),
+        min_ttl=cdk.Duration.seconds(0),
+        max_ttl=cdk.Duration.seconds(edgeFullPageCacheTtl),
+        query_string_behavior=_cloudfront.CacheQueryStringBehavior.all(),
+        header_behavior=_cloudfront.CacheHeaderBehavior.none(),
+        cookie_behavior=_cloudfront.CacheCookieBehavior.allow_list(
+          "X-Magento-Vary", "store", "currency",
+        ),
+        enable_accept_encoding_gzip=True,
+        enable_accept_encoding_brotli=True,
+      )
+
+      # on a miss all viewer cookies reach the web servers, like
+      # Varnish passes them to the backend. Magento needs the session
+      # to render the page for the customer context the X-Magento-Vary
+      # cookie in the cache key stands for. Web servers drop
+      # Set-Cookie from cacheable responses, so no session cookie is
+      # ever cached
+      edgeFpcOriginRequestPolicy = _cloudfront.OriginRequestPolicy(
+        self,
+        "edgeFpcOriginRequestPolicy",
+        comment="Magento storefront pages by customer context",
+        query_string_behavior=_cloudfront.OriginRequestQueryStringBehavior.all(),
+        header_behavior=_cloudfront.OriginRequestHeaderBehavior.allow_list(
+          "CloudFront-Forwarded-Proto",
+        ),
+        cookie_behavior=_cloudfront.OriginRequestCookieBehavior.all(),
+      )
+
+      # the public max-age of cacheable pages is meant for the edge.
+      # Browsers get the headers Magento's Varnish configuration sends,
+      # so they revalidate every page and never keep stale prices
+      edgeFpcResponseHeadersPolicy = _cloudfront.ResponseHeadersPolicy(
+        self,
+        "edgeFpcResponseHeadersPolicy",
+        comment="Keeps browsers from caching Magento storefront pages",
+        custom_headers_behavior=_cloudfront.ResponseCustomHeadersBehavior(
+          custom_headers=[
+            _cloudfront.ResponseCustomHeader(
+              header="Cache-Control",
+              value="no-store, no-cache, must-revalidate, max-age=0",
+              override=True,
+            ),
+            _cloudfront.ResponseCustomHeader(
+              header="Pragma",
+              value="no-cache",
+              override=True,
+            ),
+          ],
+        ),
+      )
+
+      defaultCfBehavior = _cloudfront.BehaviorOptions(
+        viewer_protocol_policy=_cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+        origin=webserverAlbOrigin,
+        cache_policy=edgeFpcCachePolicy,
+        origin_request_policy=edgeFpcOriginRequestPolicy,
+        response_headers_policy=edgeFpcResponseHeadersPolicy,
+        compress=True,
+      )
+
+      # checkout, customer account, admin and API requests are
+      # personalized, so they bypass the edge cache and receive all
+      # viewer cookies and headers
+      bypassCfBehavior = _cloudfront.BehaviorOptions(
+        viewer_protocol_policy=_cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+        origin=webserverAlbOrigin,
+        cache_policy=_cloudfront.CachePolicy.CACHING_DISABLED,
+        origin_request_policy=_cloudfront.OriginRequestPolicy.ALL_VIEWER,
+        allowed_methods=_cloudfront.AllowedMethods.ALLOW_ALL,
+      )
+      for pathPattern in ["checkout/*", "customer/*", "admin*", "rest/*", "graphql*"]:
+        dynamicCfBehaviors[pathPattern] = bypassCfBehavior
+
+    # cache policies for static assets and media. Query strings,
+    # headers and cookies are kept out of the cache key so every
+    # viewer shares the same cached object
+    versionedStaticCachePolicy = _cloudfront.CachePolicy(
+      self,
+      "versionedStaticCachePolicy",
+      comment="Versioned Magento static assets, immutable per deployed version",
+      default_ttl=cdk.Duration.days(365),
+      min_ttl=cdk.Duration.days(1),
+      max_ttl=cdk.Duration.days(365),
+      query_string_behavior=_cloudfront.CacheQueryStringBehavior.none(),
+      header_behavior=_cloudfront.CacheHeaderBehavior.none(),
+      cookie_behavior=_cloudfront.CacheCookieBehavior.none(),
+      enable_accept_encoding_gzip=True,
+      enable_accept_encoding_brotli=True,
+    )
+
+    staticCachePolicy = _cloudfront.CachePolicy(
+      self,
+      "staticCachePolicy",
+      comment="Unversioned Magento static assets",
+      default_ttl=cdk.Duration.days(1),
+      min_ttl=cdk.Duration.seconds(0),
+      max_ttl=cdk.Duration.days(30),
+      query_string_behavior=_cloudfront.CacheQueryStringBehavior.none(),
+      header_behavior=_cloudfront.CacheHeaderBehavior.none(),
+      cookie_behavior=_cloudfront.CacheCookieBehavior.none(),
+      enable_accept_encoding_gzip=True,
+      enable_accept_encoding_brotli=True,
+    )
+
+    mediaCachePolicy = _cloudfront.CachePolicy(
+      self,
+      "mediaCachePolicy",
+      comment="Magento catalog and CMS media",
+      default_ttl=cdk.Duration.days(30),
+      min_ttl=cdk.Duration.seconds(0),
+      max_ttl=cdk.Duration.days(365),
+      query_string_behavior=_cloudfront.CacheQueryStringBehavior.none(),
+      header_behavior=_cloudfront.CacheHeaderBehavior.none(),
+      cookie_behavior=_cloudfront.CacheCookieBehavior.none(),
+      enable_accept_encoding_gzip=True,
+      enable_accept_encoding_brotli=True,
+    )
+
+    staticOrigin = webserverAlbOrigin
+    if staticFromS3:
+      staticOrigin = _cf_origins.S3Origin(
+        staticBucket,
+        origin_access_identity=staticOriginAccessIdentity,
+        origin_shield_region=originShieldRegion,
+      )
+
+    def assetCfBehavior(cachePolicy: _cloudfront.ICachePolicy, origin: _cloudfront.IOrigin = webserverAlbOrigin) -> _cloudfront.BehaviorOptions:
+      return _cloudfront.BehaviorOptions(
+        viewer_protocol_policy=_cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+        origin=origin,
+        cache_policy=cachePolicy,
+        allowed_methods=_cloudfront.AllowedMethods.ALLOW_GET_HEAD,
+        cached_methods=_cloudfront.CachedMethods.CACHE_GET_HEAD,
+        compress=True,
       )
+
+    # media and image variants are served from the private content
+    # bucket through its origin access identity
+    contentBucketOrigin = _cf_origins.S3Origin(
+      contentBucket,
+      origin_access_identity=contentOriginAccessIdentity,
+      origin_shield_region=originShieldRegion,
     )
-    
+
+    # Magento keeps customer uploads, downloadable product files and
+    # import files in pub/media as well and denies web access to
+    # them. These paths go to the web servers, which deny them too,
+    # and must come before the media behavior
+    privateMediaCfBehaviors = {}
+    for privateMediaDir in PRIVATE_MEDIA_DIRS:
+      privateMediaCfBehaviors[f"{MEDIA_URL_PATH}/{privateMediaDir}/*"] = _cloudfront.BehaviorOptions(
+        viewer_protocol_policy=_cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+        origin=webserverAlbOrigin,
+        cache_policy=_cloudfront.CachePolicy.CACHING_DISABLED,
+      )
+
+    # web servers store pub/media on the content bucket. Resized
+    # catalog images Magento has not generated yet are missing from
+    # the bucket (403 without list permissions), so those requests
+    # fall back to the web servers, where Apache hands missing media
+    # files to pub/get.php, which creates them
+    mediaOrigin = _cf_origins.OriginGroup(
+      primary_origin=contentBucketOrigin,
+      fallback_origin=webserverAlbOrigin,
+      fallback_status_codes=[403, 404],
+    )
+
+    if imageVariantsConfigs["Enabled"]:
+      imageVariantFormatFn = _cloudfront.Function(
+        self,
+        "imageVariantFormatFn",
+        comment="Picks the image variant format from the Accept header",
+        code=_cloudfront.FunctionCode.from_inline(
+          getVariantFormatFunctionCode(imageVariantsConfigs["Prefix"], imageVariantsConfigs["Formats"])
+        ),
+      )
+      dynamicCfBehaviors[f"{imageVariantsConfigs['Prefix']}/*"] = _cloudfront.BehaviorOptions(
+        viewer_protocol_policy=_cloudfront.ViewerProtocolPolicy.REDIRECT_TO_HTTPS,
+        origin=contentBucketOrigin,
+        cache_policy=mediaCachePolicy,
+        allowed_methods=_cloudfront.AllowedMethods.ALLOW_GET_HEAD,
+        cached_methods=_cloudfront.CachedMethods.CACHE_GET_HEAD,
+        function_associations=[
+          _cloudfront.FunctionAssociation(
+            function=imageVariantFormatFn,
+            event_type=_cloudfront.FunctionEventType.VIEWER_REQUEST,
+          ),
+        ],
+      )
+
+    # behaviors are evaluated in order, so the versioned static
+    # path has to come before the generic static path and the
+    # private media paths before the generic media path
+    additionalCfBehaviors = {
+      f"{STATIC_URL_PATH}/version*": assetCfBehavior(versionedStaticCachePolicy, staticOrigin),
+      f"{STATIC_URL_PATH}/*": assetCfBehavior(staticCachePolicy, staticOrigin),
+      **privateMediaCfBehaviors,
+      f"{MEDIA_URL_PATH}/*": assetCfBehavior(mediaCachePolicy, mediaOrigin),
+      **dynamicCfBehaviors,
+    }
+
+    # the private media URLs Magento generates below its media base
+    # URL must reach the web servers, not the public media behavior
+    for privateMediaDir in PRIVATE_MEDIA_DIRS:
+      privateMediaUrlPath = f"{MEDIA_URL_PATH}/{privateMediaDir}/file.jpg"
+      if getCfBehaviorPathPattern(list(additionalCfBehaviors), privateMediaUrlPath) not in privateMediaCfBehaviors:
+        raise Exception(
+          f"CloudFront serves {privateMediaUrlPath} from the public media behavior"
+        )
+
     webserversCfDistribution = _cloudfront.Distribution(
       self, 
       "webserversCfDistribution",
       default_behavior=defaultCfBehavior,
+      additional_behaviors=additionalCfBehaviors,
+    )
+
+    # allowing web servers to invalidate the edge cache when
+    # Magento's cache is flushed
+    _role.add_to_policy(
+      _iam.PolicyStatement(
+        actions=[
+          "cloudfront:CreateInvalidation"
+        ],
+        effect=_iam.Effect.ALLOW,
+        resources=[
+          self.format_arn(
+            service="cloudfront",
+            region="",
+            resource="distribution",
+            resource_name=webserversCfDistribution.distribution_id,
+          )
+        ],
+      )
     )
     
     mappings["__CF_DISTRIBUTION_DOMAIN_NAME__"] = webserversCfDistribution.distribution_domain_name
+    mappings["__CF_DISTRIBUTION_ID__"] = webserversCfDistribution.distribution_id
+    mappings["__EDGE_FULL_PAGE_CACHE__"] = "true" if edgeFullPageCache else "false"
+    mappings["__EDGE_FULL_PAGE_CACHE_TTL__"] = str(edgeFullPageCacheTtl)
+    mappings["__MAGENTO_NODE_ROLE__"] = "web"
+    mappings["__STATIC_URL_PATH__"] = STATIC_URL_PATH
+    mappings["__MEDIA_URL_PATH__"] = MEDIA_URL_PATH
+    mappings["__PRIVATE_MEDIA_DIRS__"] = "|".join(PRIVATE_MEDIA_DIRS)
+    mappings["__LIFECYCLE_HOOK_NAME__"] = readinessHookName
+    mappings["__READINESS_PATHS__"] = " ".join(readinessConfigs["Paths"])
+    mappings["__QUEUE_DEPTH_METRIC__"] = "true" if publishQueueDepth else "false"
+    mappings["__QUEUE_DEPTH_NAMESPACE__"] = QUEUE_DEPTH_NAMESPACE
+    mappings["__QUEUE_DEPTH_METRIC_NAME__"] = QUEUE_DEPTH_METRIC_NAME
+    mappings["__PHP_MEMORY_LIMIT__"] = runtimeProfileConfigs["PhpMemoryLimit"]
+    mappings["__PHP_CLI_MEMORY_LIMIT__"] = runtimeProfileConfigs["PhpCliMemoryLimit"]
+    mappings["__FPM_PROCESS_MANAGER__"] = fpmConfigs["ProcessManager"]
+    mappings["__FPM_RESERVED_MEMORY_MB__"] = str(fpmConfigs["ReservedMemoryMb"])
+    mappings["__FPM_CHILD_MEMORY_MB__"] = str(fpmConfigs["ChildMemoryMb"])
+    mappings["__FPM_MAX_REQUESTS__"] = str(fpmConfigs["MaxRequests"])
+    mappings["__OPCACHE_MEMORY_MB__"] = str(opcacheConfigs["MemoryMb"])
+    mappings["__OPCACHE_INTERNED_STRINGS_BUFFER_MB__"] = str(opcacheConfigs["InternedStringsBufferMb"])
+    mappings["__OPCACHE_MAX_ACCELERATED_FILES__"] = str(opcacheConfigs["MaxAcceleratedFiles"])
+    mappings["__OPCACHE_VALIDATE_TIMESTAMPS__"] = "1" if opcacheConfigs["ValidateTimestamps"] else "0"
+    mappings["__REALPATH_CACHE_SIZE__"] = runtimeProfileConfigs["RealpathCache"]["Size"]
+    mappings["__REALPATH_CACHE_TTL__"] = str(runtimeProfileConfigs["RealpathCache"]["TtlSeconds"])
+    mappings["__KEEPALIVE_TIMEOUT__"] = str(runtimeProfileConfigs["KeepAlive"]["TimeoutSeconds"])
+    mappings["__MAX_KEEPALIVE_REQUESTS__"] = str(runtimeProfileConfigs["KeepAlive"]["MaxRequests"])
     
     with open("user_data/configure_webserver_instance.sh", 'r') as user_data_h:
       # Use a substitution
@@ -111,26 +477,125 @@ class WebServersStack(cdk.Stack):
       open=True,
     )
 
-    # Create web server instances auto scaling group
-    webserverASG = _asg.AutoScalingGroup(
-      self, 
-      "webserverASG",
-      vpc=vpc,
+    # Create web server instances launch template
+    webserverLaunchTemplate = _ec2.LaunchTemplate(
+      self,
+      "webserverLaunchTemplate",
       instance_type=_ec2.InstanceType(
-        instance_type_identifier=ec2_type
+        instance_type_identifier=instanceType
       ),
       role=_role,
       machine_image=linux_ami,
-      min_capacity=asgMinCapacity,
-      max_capacity=asgMaxCapacity,
       security_group=webserverEc2SG,
       user_data=_user_data,
+      # hibernated instances keep their memory on the encrypted
+      # root volume, so it has to fit the instance memory
+      hibernation_configured=hibernate,
+      block_devices=[
+        _ec2.BlockDevice(
+          device_name="/dev/xvda",
+          volume=_ec2.BlockDeviceVolume.ebs(
+            30,
+            encrypted=True,
+            volume_type=_ec2.EbsDeviceVolumeType.GP3,
+          ),
+        ),
+      ],
+    )
+
+    # mix on-demand and spot capacity across several instance
+    # families. All instance types have to match the AMI
+    # architecture
+    launchTemplate = webserverLaunchTemplate
+    mixedInstancesPolicy = None
+    if spotConfigs["Enabled"]:
+      launchTemplate = None
+      mixedInstancesPolicy = _asg.MixedInstancesPolicy(
+        launch_template=webserverLaunchTemplate,
+        launch_template_overrides=[
+          _asg.LaunchTemplateOverrides(
+            instance_type=_ec2.InstanceType(
+              instance_type_identifier=spotInstanceType
+            ),
+          ) for spotInstanceType in spotConfigs["InstanceTypes"]
+        ],
+        instances_distribution=_asg.InstancesDistribution(
+          on_demand_base_capacity=spotConfigs["OnDemandBaseCapacity"],
+          on_demand_percentage_above_base_capacity=spotConfigs["OnDemandPercentageAboveBaseCapacity"],
+          spot_allocation_strategy=_asg.SpotAllocationStrategy.CAPACITY_OPTIMIZED,
+        ),
+      )
+
+    # Create web server instances auto scaling group
+    webserverASG = _asg.AutoScalingGroup(
+      self,
+      "webserverASG",
+      vpc=vpc,
+      launch_template=launchTemplate,
+      mixed_instances_policy=mixedInstancesPolicy,
+      capacity_rebalance=spotConfigs["Enabled"],
+      min_capacity=asgMinCapacity,
+      max_capacity=asgMaxCapacity,
       vpc_subnets=_ec2.SubnetSelection(
         subnet_type=_ec2.SubnetType.PRIVATE,
       ),
     )
 
-    webserverAlbListener.add_targets(
+    # keep new instances in Pending:Wait until Magento answers
+    # locally, so only warmed instances receive traffic
+    webserverASG.add_lifecycle_hook(
+      "webserverLaunchReadinessHook",
+      lifecycle_hook_name=readinessHookName,
+      lifecycle_transition=_asg.LifecycleTransition.INSTANCE_LAUNCHING,
+      default_result=_asg.DefaultResult.ABANDON,
+      heartbeat_timeout=cdk.Duration.minutes(readinessConfigs["TimeoutMinutes"]),
+    )
+
+    _role.add_to_policy(
+      _iam.PolicyStatement(
+        actions=[
+          "autoscaling:CompleteLifecycleAction"
+        ],
+        effect=_iam.Effect.ALLOW,
+        resources=[webserverASG.auto_scaling_group_arn],
+      )
+    )
+    _role.add_to_policy(
+      _iam.PolicyStatement(
+        actions=[
+          "autoscaling:DescribeAutoScalingInstances"
+        ],
+        effect=_iam.Effect.ALLOW,
+        resources=["*"],
+      )
+    )
+
+    if publishQueueDepth:
+      _role.add_to_policy(
+        _iam.PolicyStatement(
+          actions=[
+            "cloudwatch:PutMetricData"
+          ],
+          effect=_iam.Effect.ALLOW,
+          resources=["*"],
+          conditions={
+            "StringEquals": {
+              "cloudwatch:namespace": QUEUE_DEPTH_NAMESPACE
+            }
+          },
+        )
+      )
+
+    # keep a pool of stopped or hibernated instances that already
+    # ran the user data, so scale-out only has to start them
+    if warmPoolConfigs["Enabled"]:
+      webserverASG.add_warm_pool(
+        min_size=warmPoolConfigs["MinSize"],
+        pool_state=_asg.PoolState[warmPoolConfigs["PoolState"]],
+        reuse_on_scale_in=True,
+      )
+
+    webserverTargetGroup = webserverAlbListener.add_targets(
       "webserverAlbHttpTargets",
       port=80,
       targets=[webserverASG],
@@ -142,15 +607,13 @@ class WebServersStack(cdk.Stack):
       )
     )
     
-    # add scaling policy for the Auto Scaling Group
-    webserverASG.scale_on_request_count(
-      "requests-per-minute",
-      target_requests_per_minute=60
-    )
-
-    webserverASG.scale_on_cpu_utilization(
-      "cpu-util-scaling",
-      target_utilization_percent=75
+    # add scaling policies for the Auto Scaling Group
+    webserverScaling = WebServerScaling(
+      self,
+      "webserverScaling",
+      asg=webserverASG,
+      targetGroup=webserverTargetGroup,
+      scalingConfigs=scalingConfigs,
     )
 
     # assigning our resource to be able to reference it
@@ -159,6 +622,7 @@ class WebServersStack(cdk.Stack):
     self._webserverASG = webserverASG
     self._webserversCfDistribution = webserversCfDistribution
     self._webserverRole = _role
+    self._webserverScaling = webserverScaling
 
     # output resource
     cdk.CfnOutput(
@@ -168,6 +632,12 @@ class WebServersStack(cdk.Stack):
       export_name="MagentoWebshopStoreFrontURL",
       description="This is the URL of the Magento webshop. The store loads once all the provisioning, installation, and configurations are successfully finished."
     )
+    cdk.CfnOutput(
+      self,
+      "webserverAsgNameOutput",
+      value=webserverASG.auto_scaling_group_name,
+      export_name="webserverAsgName"
+    )
 
   @property
   def getWebserverAlb(self) -> _elbv2.IApplicationLoadBalancer:
@@ -181,3 +651,6 @@ class WebServersStack(cdk.Stack):
   @property
   def getWebserverCfDistribution(self) -> _cloudfront.IDistribution:
     return self._webserversCfDistribution
+  @property
+  def getWebserverScaling(self) -> WebServerScaling:
+    return self._webserverScaling
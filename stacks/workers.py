@@ -0,0 +1,95 @@
+import os.path
+from aws_cdk import core as cdk
+from aws_cdk import aws_ec2 as _ec2
+from aws_cdk import aws_iam as _iam
+from aws_cdk import aws_autoscaling as _asg
+from .webservers import getLinuxAmi
+
+currentDirName = os.path.dirname(__file__)
+
+class WorkersStack(cdk.Stack):
+  def __init__(
+    self,
+    scope: cdk.Construct,
+    construct_id: str,
+    vpc: _ec2.IVpc,
+    workerEc2SG: _ec2.ISecurityGroup,
+    role: _iam.IRole,
+    mappings,
+    buildConfigs,
+    **kwargs,
+  ) -> None:
+    super().__init__(scope, construct_id, **kwargs)
+
+    # extracting build configs
+    workerConfigs = buildConfigs["Parameters"]["Workers"]
+    instanceType = workerConfigs["InstanceType"]
+    linux_ami = getLinuxAmi(workerConfigs["Architecture"])
+
+    # workers run the web server user data, which configures Magento
+    # the same way and then sets up cron and the queue consumers
+    # instead of serving requests
+    workerMappings = dict(mappings)
+    workerMappings["__MAGENTO_NODE_ROLE__"] = "worker"
+    workerMappings["__QUEUE_DEPTH_METRIC__"] = "false"
+
+    with open("user_data/configure_webserver_instance.sh", 'r') as user_data_h:
+      # Use a substitution
+      user_data_sub = cdk.Fn.sub(user_data_h.read(), workerMappings)
+
+    # Import substitution object into user_data set
+    _user_data = _ec2.UserData.custom(user_data_sub)
+
+    # Create worker instance launch template
+    workerLaunchTemplate = _ec2.LaunchTemplate(
+      self,
+      "workerLaunchTemplate",
+      instance_type=_ec2.InstanceType(
+        instance_type_identifier=instanceType
+      ),
+      role=role,
+      machine_image=linux_ami,
+      security_group=workerEc2SG,
+      user_data=_user_data,
+      block_devices=[
+        _ec2.BlockDevice(
+          device_name="/dev/xvda",
+          volume=_ec2.BlockDeviceVolume.ebs(
+            30,
+            encrypted=True,
+            volume_type=_ec2.EbsDeviceVolumeType.GP3,
+          ),
+        ),
+      ],
+    )
+
+    # a single on-demand instance is the single runner of cron and
+    # the consumers. The group replaces it when it fails its health
+    # checks and never scales it in during a reindex
+    workerASG = _asg.AutoScalingGroup(
+      self,
+      "workerASG",
+      vpc=vpc,
+      launch_template=workerLaunchTemplate,
+      min_capacity=1,
+      max_capacity=1,
+      vpc_subnets=_ec2.SubnetSelection(
+        subnet_type=_ec2.SubnetType.PRIVATE,
+      ),
+    )
+
+    # assigning our resource to be able to reference it
+    # across stacks
+    self._workerAsg = workerASG
+
+    # output resource
+    cdk.CfnOutput(
+      self,
+      "workerAsgNameOutput",
+      value=workerASG.auto_scaling_group_name,
+      export_name="workerAsgName"
+    )
+
+  @property
+  def getWorkerAsg(self) -> _asg.IAutoScalingGroup:
+    return self._workerAsg
@@ -8,11 +8,47 @@ AWS_ACCOUNT_ID="${__AWS_ACCOUNT_ID__}"
 AWS_REGION="${__AWS_REGION__}"
 MYSQL_INSTANCE_ADDRESS="${__MYSQL_INSTANCE_ADDRESS__}"
 MYSQL_SECRET_NAME="${__MYSQL_SECRET_NAME__}"
+MYSQL_PROXY_ADDRESS="${__MYSQL_PROXY_ADDRESS__}"
 CF_DISTRIBUTION_DOMAIN_NAME="${__CF_DISTRIBUTION_DOMAIN_NAME__}"
+CF_DISTRIBUTION_ID="${__CF_DISTRIBUTION_ID__}"
+EDGE_FULL_PAGE_CACHE="${__EDGE_FULL_PAGE_CACHE__}"
+EDGE_FULL_PAGE_CACHE_TTL="${__EDGE_FULL_PAGE_CACHE_TTL__}"
+REDIS_ENDPOINT_ADDRESS="${__REDIS_ENDPOINT_ADDRESS__}"
+REDIS_ENDPOINT_PORT="${__REDIS_ENDPOINT_PORT__}"
+MAGENTO_ARTIFACT_BUCKET="${__MAGENTO_ARTIFACT_BUCKET__}"
+MAGENTO_RELEASE="${__MAGENTO_RELEASE__}"
+MAGENTO_CRYPT_KEY_SECRET_NAME="${__MAGENTO_CRYPT_KEY_SECRET_NAME__}"
+WEBSHOP_CONTENT_BUCKET="${__WEBSHOP_CONTENT_BUCKET__}"
+LIFECYCLE_HOOK_NAME="${__LIFECYCLE_HOOK_NAME__}"
+READINESS_PATHS="${__READINESS_PATHS__}"
+QUEUE_DEPTH_METRIC="${__QUEUE_DEPTH_METRIC__}"
+QUEUE_DEPTH_NAMESPACE="${__QUEUE_DEPTH_NAMESPACE__}"
+QUEUE_DEPTH_METRIC_NAME="${__QUEUE_DEPTH_METRIC_NAME__}"
+PHP_MEMORY_LIMIT="${__PHP_MEMORY_LIMIT__}"
+PHP_CLI_MEMORY_LIMIT="${__PHP_CLI_MEMORY_LIMIT__}"
+FPM_PROCESS_MANAGER="${__FPM_PROCESS_MANAGER__}"
+FPM_RESERVED_MEMORY_MB="${__FPM_RESERVED_MEMORY_MB__}"
+FPM_CHILD_MEMORY_MB="${__FPM_CHILD_MEMORY_MB__}"
+FPM_MAX_REQUESTS="${__FPM_MAX_REQUESTS__}"
+OPCACHE_MEMORY_MB="${__OPCACHE_MEMORY_MB__}"
+OPCACHE_INTERNED_STRINGS_BUFFER_MB="${__OPCACHE_INTERNED_STRINGS_BUFFER_MB__}"
+OPCACHE_MAX_ACCELERATED_FILES="${__OPCACHE_MAX_ACCELERATED_FILES__}"
+OPCACHE_VALIDATE_TIMESTAMPS="${__OPCACHE_VALIDATE_TIMESTAMPS__}"
+REALPATH_CACHE_SIZE="${__REALPATH_CACHE_SIZE__}"
+REALPATH_CACHE_TTL="${__REALPATH_CACHE_TTL__}"
+MAGENTO_NODE_ROLE="${__MAGENTO_NODE_ROLE__}"
+STATIC_URL_PATH="${__STATIC_URL_PATH__}"
+MEDIA_URL_PATH="${__MEDIA_URL_PATH__}"
+PRIVATE_MEDIA_DIRS="${__PRIVATE_MEDIA_DIRS__}"
+KEEPALIVE_TIMEOUT="${__KEEPALIVE_TIMEOUT__}"
+MAX_KEEPALIVE_REQUESTS="${__MAX_KEEPALIVE_REQUESTS__}"
 
 echo "Hello from user-data!"
-# install the required packages
-yum update -y
+# install the required packages. Prebuilt releases are
+# launched as they are to keep the boot time short
+if [[ -z "${!MAGENTO_RELEASE}" ]]; then
+  yum update -y
+fi
 yum -y install mysql git httpd jq amazon-linux-extras amazon-efs-utils
 amazon-linux-extras enable php7.3
 yum clean metadata
@@ -35,10 +71,129 @@ mysql -h ${!MYSQL_INSTANCE_ADDRESS} -u ${!MYSQL_USER} \
 -p${!MYSQL_PWD} -e"quit" &&
 echo "connecting to MySQL server was successful"
 
-# configuring php memory limit
-sed -i 's/memory_limit\s*=.*/memory_limit=1024M/g' /etc/php.ini
-systemctl enable httpd
-systemctl start httpd
+# point Magento at the RDS proxy when one is provisioned
+MAGENTO_DB_HOST=${!MYSQL_INSTANCE_ADDRESS}
+if [[ -n "${!MYSQL_PROXY_ADDRESS}" ]]; then
+  MAGENTO_DB_HOST=${!MYSQL_PROXY_ADDRESS}
+fi
+
+# retriveing magento encryption key from secrets manager
+MAGENTO_CRYPT_KEY=$(aws secretsmanager get-secret-value \
+  --region ${!AWS_REGION} --secret-id ${!MAGENTO_CRYPT_KEY_SECRET_NAME} \
+--query SecretString --output text)
+
+# configuring the web runtime profile from Parameters.WebServers.RuntimeProfile.
+# Apache runs the event MPM and hands PHP requests to PHP-FPM.
+# php.ini holds the limit of the CLI, which compiles Magento and
+# runs cron, the pool overrides it with the per request limit
+sed -i "s/memory_limit\s*=.*/memory_limit=${!PHP_CLI_MEMORY_LIMIT}/g" /etc/php.ini
+
+# size the FPM pool to the memory of this instance, spot and mixed
+# instance types don't all have the same amount. FPM_CHILD_MEMORY_MB
+# is the average resident memory of a child, the memory limit caps
+# the few requests above it
+MEM_TOTAL_MB=$(awk '/MemTotal/ {print int($2 / 1024)}' /proc/meminfo)
+FPM_MAX_CHILDREN=$(( (MEM_TOTAL_MB - FPM_RESERVED_MEMORY_MB) / FPM_CHILD_MEMORY_MB ))
+if (( FPM_MAX_CHILDREN < 2 )); then
+  FPM_MAX_CHILDREN=2
+fi
+FPM_START_SERVERS=$(( FPM_MAX_CHILDREN / 4 > 1 ? FPM_MAX_CHILDREN / 4 : 1 ))
+
+# FPM listens on loopback TCP, its status page only reports the
+# listen queue of TCP sockets on Linux
+cat > /etc/php-fpm.d/www.conf <<EOF
+[www]
+user = apache
+group = apache
+listen = 127.0.0.1:9000
+listen.allowed_clients = 127.0.0.1
+pm.status_path = /fpm-status
+pm = ${!FPM_PROCESS_MANAGER}
+pm.max_children = ${!FPM_MAX_CHILDREN}
+pm.start_servers = ${!FPM_START_SERVERS}
+pm.min_spare_servers = ${!FPM_START_SERVERS}
+pm.max_spare_servers = $(( FPM_START_SERVERS * 2 ))
+pm.max_requests = ${!FPM_MAX_REQUESTS}
+php_admin_value[memory_limit] = ${!PHP_MEMORY_LIMIT}
+php_admin_value[error_log] = /var/log/php-fpm/www-error.log
+php_admin_flag[log_errors] = on
+EOF
+
+# Magento loads tens of thousands of PHP files. Without timestamp
+# validation code changes need an FPM reload, which this script
+# does once Magento is ready
+cat > /etc/php.d/99-magento-runtime.ini <<EOF
+opcache.enable=1
+opcache.memory_consumption=${!OPCACHE_MEMORY_MB}
+opcache.interned_strings_buffer=${!OPCACHE_INTERNED_STRINGS_BUFFER_MB}
+opcache.max_accelerated_files=${!OPCACHE_MAX_ACCELERATED_FILES}
+opcache.validate_timestamps=${!OPCACHE_VALIDATE_TIMESTAMPS}
+opcache.save_comments=1
+realpath_cache_size=${!REALPATH_CACHE_SIZE}
+realpath_cache_ttl=${!REALPATH_CACHE_TTL}
+EOF
+
+# switch Apache to the event MPM, mod_php is not thread safe
+sed -i -E 's/^(LoadModule mpm_(prefork|worker)_module)/#\1/; s/^#\s*(LoadModule mpm_event_module)/\1/' \
+/etc/httpd/conf.modules.d/00-mpm.conf
+if [[ -f /etc/httpd/conf.modules.d/15-php.conf ]]; then
+  mv /etc/httpd/conf.modules.d/15-php.conf /etc/httpd/conf.modules.d/15-php.conf.disabled
+fi
+
+# the keep-alive timeout has to be above the 60 seconds idle timeout
+# of the load balancer, otherwise Apache closes connections the load
+# balancer is about to reuse and clients get 502 errors
+cat > /etc/httpd/conf.d/zz-magento-runtime.conf <<EOF
+KeepAlive On
+KeepAliveTimeout ${!KEEPALIVE_TIMEOUT}
+MaxKeepAliveRequests ${!MAX_KEEPALIVE_REQUESTS}
+
+# Magento is installed in /var/www/html, but its static base URL is
+# the /static/ CloudFront path, which is only forwarded here when
+# CloudFront has no copy. Files are served from pub/static, with the
+# deployed version stripped, and missing files are deployed by
+# pub/static.php, like Magento's pub/static/.htaccess does
+RewriteEngine On
+RewriteRule ^/${!STATIC_URL_PATH}/version[^/]+/(.+)$ /${!STATIC_URL_PATH}/\$1
+RewriteCond /var/www/html/pub/static/\$1 !-f
+RewriteRule ^/${!STATIC_URL_PATH}/(.+)$ /pub/static.php?resource=\$1 [PT,L]
+RewriteRule ^/${!STATIC_URL_PATH}/(.+)$ /var/www/html/pub/static/\$1 [L]
+
+# the same for the /media/ CloudFront path, which falls back to the
+# web servers for resized catalog images missing on the content
+# bucket. pub/get.php creates them from the request URI, like
+# Magento's pub/media/.htaccess does. Private media is never served
+RewriteRule ^/${!MEDIA_URL_PATH}/(${!PRIVATE_MEDIA_DIRS})/ - [F]
+RewriteCond /var/www/html/pub/media/\$1 !-f
+RewriteRule ^/${!MEDIA_URL_PATH}/(.+)$ /pub/get.php [PT,L]
+RewriteRule ^/${!MEDIA_URL_PATH}/(.+)$ /var/www/html/pub/media/\$1 [L]
+
+<FilesMatch \.php$>
+  SetHandler "proxy:fcgi://127.0.0.1:9000"
+</FilesMatch>
+<Proxy "fcgi://127.0.0.1:9000">
+  ProxySet timeout=600
+</Proxy>
+
+# Magento's .htaccess files deny these media directories, deny them
+# regardless of AllowOverride. pub/media is on the shared bucket
+<LocationMatch "^/(pub/)?media/(${!PRIVATE_MEDIA_DIRS})/">
+  Require all denied
+</LocationMatch>
+
+<IfModule mod_deflate.c>
+  AddOutputFilterByType DEFLATE text/html text/plain text/css text/xml text/javascript
+  AddOutputFilterByType DEFLATE application/javascript application/json application/xml image/svg+xml
+</IfModule>
+EOF
+
+# workers don't serve requests
+if [[ "${!MAGENTO_NODE_ROLE}" == "web" ]]; then
+  systemctl enable php-fpm
+  systemctl start php-fpm
+  systemctl enable httpd
+  systemctl start httpd
+fi
 
 # adding ec2-user to the webservers group and setting correct
 # file and directory permissions on /var/www
@@ -49,45 +204,114 @@ chmod 2775 /var/www
 find /var/www -type d -exec chmod 2775 {} +
 find /var/www -type f -exec chmod 0664 {} +
 
-# installing php composer
-export COMPOSER_HOME=/root
-sudo curl -sS https://getcomposer.org/installer | sudo php
-mv composer.phar /usr/bin/composer
-chmod +x /usr/bin/composer
-
-# download magento 2.3.7 version, extract its content to
-# /var/www/html directory
-wget -c https://github.com/magento/magento2/archive/refs/tags/2.3.7.tar.gz -O - | tar -xz --directory /var/www/html/ --strip 1
-cd /var/www/html
-
-# installing magento 2 dependencies
-COMPOSER_ALLOW_SUPERUSER=1 /usr/bin/composer install
-
-# setting proper file and directory permissions for magento files
-find var generated vendor pub/static pub/media app/etc -type f -exec chmod g+w {} +
-
-find var generated vendor pub/static pub/media app/etc -type d -exec chmod g+ws {} +
-
-chown -R :apache .
-
-chmod u+x bin/magento
-
-# install magento
-bin/magento setup:install \
---base-url=http://${!CF_DISTRIBUTION_DOMAIN_NAME}/ \
---db-host=${!MYSQL_INSTANCE_ADDRESS} \
---db-name=webshop \
---db-user=${!MYSQL_USER} \
---db-password=${!MYSQL_PWD} \
---admin-firstname=admin \
---admin-lastname=admin \
---admin-email=admin@admin.com \
---admin-user=admin \
---admin-password=${!MYSQL_PWD}@ \
---language=en_US \
---currency=USD \
---timezone=America/Chicago \
---use-rewrites=1
+if [[ -n "${!MAGENTO_RELEASE}" ]]; then
+  # download the prebuilt magento release and extract its
+  # content to /var/www/html directory. Release artifacts are
+  # built once by the magento release CodeBuild project
+  aws s3 cp --region ${!AWS_REGION} \
+  s3://${!MAGENTO_ARTIFACT_BUCKET}/releases/${!MAGENTO_RELEASE}/magento.tar.gz - \
+  | tar -xz --directory /var/www/html/
+  cd /var/www/html
+
+  # setting proper file and directory permissions for magento files
+  find var generated pub/static pub/media app/etc -type d -exec chmod g+ws {} +
+  chown -R :apache .
+
+  # write the deployment configuration for this instance. The
+  # database has already been installed by the release build
+  php bin/magento setup:config:set --no-interaction \
+  --db-host=${!MAGENTO_DB_HOST} \
+  --db-name=webshop \
+  --db-user=${!MYSQL_USER} \
+  --db-password=${!MYSQL_PWD} \
+  --key=${!MAGENTO_CRYPT_KEY} \
+  --backend-frontname=admin
+else
+  # installing php composer
+  export COMPOSER_HOME=/root
+  sudo curl -sS https://getcomposer.org/installer | sudo php
+  mv composer.phar /usr/bin/composer
+  chmod +x /usr/bin/composer
+
+  # download magento 2.3.7 version, extract its content to
+  # /var/www/html directory
+  wget -c https://github.com/magento/magento2/archive/refs/tags/2.3.7.tar.gz -O - | tar -xz --directory /var/www/html/ --strip 1
+  cd /var/www/html
+
+  # installing magento 2 dependencies
+  COMPOSER_ALLOW_SUPERUSER=1 /usr/bin/composer install
+
+  # setting proper file and directory permissions for magento files
+  find var generated vendor pub/static pub/media app/etc -type f -exec chmod g+w {} +
+
+  find var generated vendor pub/static pub/media app/etc -type d -exec chmod g+ws {} +
+
+  chown -R :apache .
+
+  chmod u+x bin/magento
+
+  if [[ "${!MAGENTO_NODE_ROLE}" == "worker" ]]; then
+    # the web servers install the database, the worker waits for
+    # the admin user setup:install creates last and only writes
+    # its own deployment configuration
+    until mysql -h ${!MYSQL_INSTANCE_ADDRESS} -u ${!MYSQL_USER} \
+    -p${!MYSQL_PWD} -N -e"SELECT 1 FROM webshop.admin_user LIMIT 1" 2>/dev/null | grep -q 1; do
+      echo "waiting for the web servers to install the database"
+      sleep 30
+    done
+
+    # app/etc/config.php is not in the source archive, enabling
+    # every module writes the same module list setup:install does
+    php bin/magento module:enable --all
+    php bin/magento setup:config:set --no-interaction \
+    --db-host=${!MAGENTO_DB_HOST} \
+    --db-name=webshop \
+    --db-user=${!MYSQL_USER} \
+    --db-password=${!MYSQL_PWD} \
+    --key=${!MAGENTO_CRYPT_KEY} \
+    --backend-frontname=admin
+  else
+    # install magento
+    bin/magento setup:install \
+    --base-url=http://${!CF_DISTRIBUTION_DOMAIN_NAME}/ \
+    --db-host=${!MAGENTO_DB_HOST} \
+    --db-name=webshop \
+    --db-user=${!MYSQL_USER} \
+    --db-password=${!MYSQL_PWD} \
+    --key=${!MAGENTO_CRYPT_KEY} \
+    --admin-firstname=admin \
+    --admin-lastname=admin \
+    --admin-email=admin@admin.com \
+    --admin-user=admin \
+    --admin-password=${!MYSQL_PWD}@ \
+    --language=en_US \
+    --currency=USD \
+    --timezone=America/Chicago \
+    --use-rewrites=1
+  fi
+fi
+
+# share pub/media between all web servers by mounting the media/
+# prefix of the content bucket. Magento 2.3 has no remote storage
+# module, s3fs supports the renames Magento does on uploads.
+# CloudFront serves Magento's /media/ base URL from the bucket
+amazon-linux-extras install -y epel
+yum -y install s3fs-fuse
+MEDIA_DIR=/var/www/html/pub/media
+
+# seed the shared storage with the media files shipped with Magento
+# when the bucket has none yet
+if [[ -z "$(aws s3 ls --region ${!AWS_REGION} s3://${!WEBSHOP_CONTENT_BUCKET}/media/ | head -n 1)" ]]; then
+  aws s3 sync --region ${!AWS_REGION} ${!MEDIA_DIR} s3://${!WEBSHOP_CONTENT_BUCKET}/media/
+fi
+
+APACHE_UID=$(id -u apache)
+APACHE_GID=$(id -g apache)
+mkdir -p /var/cache/s3fs
+echo "${!WEBSHOP_CONTENT_BUCKET}:/media ${!MEDIA_DIR} fuse.s3fs _netdev,allow_other,iam_role=auto,endpoint=${!AWS_REGION},url=https://s3.${!AWS_REGION}.amazonaws.com,uid=${!APACHE_UID},gid=${!APACHE_GID},umask=0002,use_cache=/var/cache/s3fs,ensure_diskfree=2048,stat_cache_expire=60 0 0" >> /etc/fstab
+rm -rf ${!MEDIA_DIR}
+mkdir -p ${!MEDIA_DIR}
+mount ${!MEDIA_DIR}
 
 # configure Magento URLs
 php bin/magento config:set web/unsecure/base_url http://${!CF_DISTRIBUTION_DOMAIN_NAME}/
@@ -99,13 +323,309 @@ php bin/magento config:set web/secure/use_in_frontend 1
 php bin/magento config:set web/secure/use_in_adminhtml 1
 php bin/magento config:set web/url/redirect_to_base 0
 
-# clean magento cache and recompile static assets
-php bin/magento cache:clean
-php bin/magento setup:di:compile
-php bin/magento setup:static-content:deploy -f
+# static URLs point at the CloudFront static path. Prebuilt
+# releases keep their static content on S3, which CloudFront serves
+# there, otherwise CloudFront caches it from the web servers. Static
+# URLs are signed with the deployed version
+php bin/magento config:set dev/static/sign 1
+php bin/magento config:set web/unsecure/base_static_url http://${!CF_DISTRIBUTION_DOMAIN_NAME}/${!STATIC_URL_PATH}/
+php bin/magento config:set web/secure/base_static_url https://${!CF_DISTRIBUTION_DOMAIN_NAME}/${!STATIC_URL_PATH}/
+
+# media URLs point at the CloudFront media path, which serves them
+# from the content bucket the web servers mount as pub/media
+php bin/magento config:set web/unsecure/base_media_url http://${!CF_DISTRIBUTION_DOMAIN_NAME}/${!MEDIA_URL_PATH}/
+php bin/magento config:set web/secure/base_media_url https://${!CF_DISTRIBUTION_DOMAIN_NAME}/${!MEDIA_URL_PATH}/
+
+# use the shared redis replication group as the session store,
+# default cache and page cache backend so that all web servers
+# behind the ALB share the same sessions and caches
+php bin/magento setup:config:set --no-interaction \
+--session-save=redis \
+--session-save-redis-host=${!REDIS_ENDPOINT_ADDRESS} \
+--session-save-redis-port=${!REDIS_ENDPOINT_PORT} \
+--session-save-redis-db=2 \
+--cache-backend=redis \
+--cache-backend-redis-server=${!REDIS_ENDPOINT_ADDRESS} \
+--cache-backend-redis-port=${!REDIS_ENDPOINT_PORT} \
+--cache-backend-redis-db=0 \
+--page-cache=redis \
+--page-cache-redis-server=${!REDIS_ENDPOINT_ADDRESS} \
+--page-cache-redis-port=${!REDIS_ENDPOINT_PORT} \
+--page-cache-redis-db=1
+
+# a small helper to set a JSON value on a path of Magento's env.php,
+# e.g. magento-env-set cron_consumers_runner '{"cron_run": false}'
+cat > /usr/local/bin/magento-env-set <<'EOF'
+#!/usr/bin/env php
+<?php
+$file = '/var/www/html/app/etc/env.php';
+$env = include $file;
+$node = &$env;
+foreach (explode('/', $argv[1]) as $key) {
+  if (!isset($node[$key]) || !is_array($node[$key])) {
+    $node[$key] = [];
+  }
+  $node = &$node[$key];
+}
+$node = json_decode($argv[2], true);
+unset($node);
+file_put_contents($file, "<?php\nreturn " . var_export($env, true) . ";\n");
+EOF
+chmod +x /usr/local/bin/magento-env-set
+
+# queue consumers run as services on the worker instance, so
+# Magento's cron must not spawn them, on web servers neither
+magento-env-set cron_consumers_runner '{"cron_run": false}'
+
+if [[ "${!EDGE_FULL_PAGE_CACHE}" == "true" ]]; then
+  # let CloudFront act as the full page cache. In this mode
+  # Magento sends public cache headers for cacheable pages and
+  # purge requests to the configured HTTP cache hosts
+  php bin/magento config:set system/full_page_cache/caching_application 2
+  php bin/magento config:set system/full_page_cache/ttl ${!EDGE_FULL_PAGE_CACHE_TTL}
+  php bin/magento setup:config:set --no-interaction --http-cache-hosts=127.0.0.1:6081
+
+  # cacheable pages must not set cookies, otherwise CloudFront would
+  # cache one visitor's session cookie and hand it to everyone.
+  # Magento's Varnish configuration drops them the same way
+  cat > /etc/httpd/conf.d/zz-magento-edge-cache.conf <<'EOF'
+Header unset Set-Cookie "expr=%{resp:Cache-Control} =~ /public/"
+Header always unset Set-Cookie "expr=%{resp:Cache-Control} =~ /public/"
+EOF
+  if [[ "${!MAGENTO_NODE_ROLE}" == "web" ]]; then
+    systemctl reload httpd
+  fi
+
+  # a small local listener that turns Magento's full cache flush
+  # purges into CloudFront invalidations. Tag based purges are
+  # ignored and expire with the edge cache TTL
+  yum -y install python3
+  cat > /usr/local/bin/magento-cdn-purge <<'EOF'
+#!/usr/bin/env python3
+import subprocess
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+DISTRIBUTION_ID = sys.argv[1]
+
+class PurgeHandler(BaseHTTPRequestHandler):
+  def do_PURGE(self):
+    pattern = self.headers.get("X-Magento-Tags-Pattern", "")
+    if pattern in ("", ".*"):
+      subprocess.run([
+        "aws", "cloudfront", "create-invalidation",
+        "--distribution-id", DISTRIBUTION_ID,
+        "--paths", "/*",
+      ])
+    self.send_response(200)
+    self.end_headers()
+
+HTTPServer(("127.0.0.1", 6081), PurgeHandler).serve_forever()
+EOF
+  chmod +x /usr/local/bin/magento-cdn-purge
+
+  cat > /etc/systemd/system/magento-cdn-purge.service <<EOF
+[Unit]
+Description=Turns Magento cache flushes into CloudFront invalidations
+After=network.target
+
+[Service]
+Environment=AWS_DEFAULT_REGION=${!AWS_REGION}
+ExecStart=/usr/bin/python3 /usr/local/bin/magento-cdn-purge ${!CF_DISTRIBUTION_ID}
+Restart=always
+
+[Install]
+WantedBy=multi-user.target
+EOF
+  # the listener is started once this instance is set up, so the
+  # cache cleaning below doesn't invalidate the distribution
+  systemctl daemon-reload
+  systemctl enable magento-cdn-purge
+fi
+
+# all cache types are stored on the shared redis replication group,
+# only the configuration written by this script has to be reloaded.
+# Flushing everything would wipe the caches of every running instance
+if [[ -n "${!MAGENTO_RELEASE}" ]]; then
+  # prebuilt releases are already compiled and their static content
+  # is on S3
+  php bin/magento cache:clean config
+else
+  # recompile static assets
+  php bin/magento cache:clean config
+  php bin/magento setup:di:compile
+  php bin/magento setup:static-content:deploy -f
+fi
+
+if [[ "${!EDGE_FULL_PAGE_CACHE}" == "true" ]]; then
+  systemctl start magento-cdn-purge
+fi
+
+if [[ "${!MAGENTO_NODE_ROLE}" == "worker" ]]; then
+  # the worker Auto Scaling group runs a single instance, which is
+  # the only one running Magento's cron, indexers and consumers.
+  # Indexers update from the changelog tables by cron instead of
+  # reindexing on every save
+  #
+  # cron and the consumers run as the web server user, like PHP-FPM,
+  # so the files they write under var/ and generated/ stay writable
+  # by every Magento process. From here on bin/magento runs as that
+  # user too, so it creates no root owned files there
+  chown -R apache:apache var generated
+  touch /var/log/magento-cron.log
+  chown apache:apache /var/log/magento-cron.log
+  sudo -u apache php bin/magento indexer:set-mode schedule
+
+  # flock keeps a slow cron run from overlapping the next one
+  cat > /etc/cron.d/magento <<'EOF'
+* * * * * apache flock -n /var/www/html/var/magento-cron.lock php /var/www/html/bin/magento cron:run >> /var/log/magento-cron.log 2>&1
+EOF
+
+  # one service per consumer. --single-thread takes a Magento lock,
+  # so a consumer never runs twice while the worker is replaced.
+  # Consumers exit after max-messages to release memory and are
+  # restarted, consumers whose connection is not configured (e.g.
+  # AMQP) give up after the start limit
+  cat > /etc/systemd/system/magento-consumer@.service <<'EOF'
+[Unit]
+Description=Magento queue consumer %i
+After=network-online.target
+Wants=network-online.target
+
+[Service]
+User=apache
+Group=apache
+WorkingDirectory=/var/www/html
+ExecStart=/usr/bin/php bin/magento queue:consumers:start %i --single-thread --max-messages=10000
+Restart=always
+RestartSec=10
+StartLimitInterval=600
+StartLimitBurst=10
+
+[Install]
+WantedBy=multi-user.target
+EOF
+  systemctl daemon-reload
+  for consumer in $(sudo -u apache php bin/magento queue:consumers:list); do
+    systemctl enable magento-consumer@${!consumer}
+    systemctl start magento-consumer@${!consumer}
+  done
+
+  # workers are not behind the load balancer, the rest of this
+  # script only concerns web servers
+  exit 0
+fi
+
+# drop the code cached by OPcache while Magento was being set up
+systemctl reload php-fpm
+
+# publish the number of requests waiting for a free PHP-FPM child
+# every minute. The Auto Scaling group scales out on it before all
+# children being busy shows in the response times. The status page
+# is queried over FastCGI directly, it is not exposed by Apache
+if [[ "${!QUEUE_DEPTH_METRIC}" == "true" ]]; then
+  yum -y install fcgi
+  cat > /usr/local/bin/magento-queue-depth <<'EOF'
+#!/bin/bash
+TOKEN=$(curl -s -X PUT http://169.254.169.254/latest/api/token \
+  -H "X-aws-ec2-metadata-token-ttl-seconds: 60")
+INSTANCE_ID=$(curl -s -H "X-aws-ec2-metadata-token: $TOKEN" \
+  http://169.254.169.254/latest/meta-data/instance-id)
+ASG_NAME=$(aws autoscaling describe-auto-scaling-instances \
+  --instance-ids $INSTANCE_ID \
+  --query "AutoScalingInstances[0].AutoScalingGroupName" --output text)
+
+# "listen queue" is the number of requests in the FPM accept queue
+QUEUE_DEPTH=$(SCRIPT_NAME=/fpm-status SCRIPT_FILENAME=/fpm-status REQUEST_METHOD=GET \
+  cgi-fcgi -bind -connect 127.0.0.1:9000 | awk -F': *' '/^listen queue:/ { print $2 + 0 }')
+
+aws cloudwatch put-metric-data \
+  --namespace "$1" \
+  --metric-name "$2" \
+  --dimensions AutoScalingGroupName=$ASG_NAME \
+  --unit Count \
+  --value ${!QUEUE_DEPTH:-0}
+EOF
+  chmod +x /usr/local/bin/magento-queue-depth
+
+  echo "* * * * * root AWS_DEFAULT_REGION=${!AWS_REGION} /usr/local/bin/magento-queue-depth ${!QUEUE_DEPTH_NAMESPACE} ${!QUEUE_DEPTH_METRIC_NAME}" \
+  > /etc/cron.d/magento-queue-depth
+fi
+
+# a readiness check that completes the launch lifecycle action once
+# Magento answers locally. It runs on every boot and on every resume
+# from hibernation, so instances that leave the warm pool are warmed
+# up before they receive traffic too
+cat > /etc/magento-lifecycle-ready.env <<EOF
+AWS_DEFAULT_REGION=${!AWS_REGION}
+LIFECYCLE_HOOK_NAME=${!LIFECYCLE_HOOK_NAME}
+READINESS_PATHS="${!READINESS_PATHS}"
+READINESS_HOST=${!CF_DISTRIBUTION_DOMAIN_NAME}
+EOF
+
+cat > /usr/local/bin/magento-lifecycle-ready <<'EOF'
+#!/bin/bash -x
+TOKEN=$(curl -s -X PUT http://169.254.169.254/latest/api/token \
+  -H "X-aws-ec2-metadata-token-ttl-seconds: 300")
+imds() {
+  curl -s -H "X-aws-ec2-metadata-token: $TOKEN" \
+    http://169.254.169.254/latest/meta-data/$1
+}
+
+INSTANCE_ID=$(imds instance-id)
+TARGET_LIFECYCLE_STATE=$(imds autoscaling/target-lifecycle-state)
+ASG_NAME=$(aws autoscaling describe-auto-scaling-instances \
+  --instance-ids $INSTANCE_ID \
+  --query "AutoScalingInstances[0].AutoScalingGroupName" --output text)
+
+# instances going to the warm pool are stopped right away, only
+# instances going into service need warmed caches and opcache
+if [[ "$TARGET_LIFECYCLE_STATE" == "InService" ]]; then
+  for path in $READINESS_PATHS; do
+    until curl -sf -o /dev/null -H "Host: $READINESS_HOST" "http://127.0.0.1$path"; do
+      sleep 5
+    done
+  done
+fi
+
+aws autoscaling complete-lifecycle-action \
+  --lifecycle-action-result CONTINUE \
+  --lifecycle-hook-name $LIFECYCLE_HOOK_NAME \
+  --auto-scaling-group-name $ASG_NAME \
+  --instance-id $INSTANCE_ID || true
+EOF
+chmod +x /usr/local/bin/magento-lifecycle-ready
+
+cat > /etc/systemd/system/magento-lifecycle-ready.service <<'EOF'
+[Unit]
+Description=Completes the Auto Scaling launch lifecycle action once Magento is ready
+After=network-online.target httpd.service
+Wants=network-online.target
+
+[Service]
+Type=oneshot
+EnvironmentFile=/etc/magento-lifecycle-ready.env
+ExecStart=/usr/local/bin/magento-lifecycle-ready
+
+[Install]
+WantedBy=multi-user.target
+EOF
+systemctl daemon-reload
+systemctl enable magento-lifecycle-ready
+
+# instances leaving a hibernated warm pool resume without booting,
+# systemd runs the sleep hooks with "post" once they are resumed
+cat > /usr/lib/systemd/system-sleep/magento-lifecycle-ready <<'EOF'
+#!/bin/bash
+if [[ "$1" == "post" ]]; then
+  systemctl --no-block start magento-lifecycle-ready
+fi
+EOF
+chmod +x /usr/lib/systemd/system-sleep/magento-lifecycle-ready
 
-# a hacky workaround to fix 404 error issue for static assets after
-# installation
-static_version=$(cat pub/static/deployed_version.txt)
-mkdir -p pub/static/version${!static_version}
-cp -R pub/static/frontend pub/static/version${!static_version}/
+# the service only runs on the following boots, so run the check
+# for this first boot here
+set -a
+source /etc/magento-lifecycle-ready.env
+set +a
+/usr/local/bin/magento-lifecycle-ready